@@ -181,6 +181,18 @@ class VilBertVisualBertModel(nn.Module):
         # TODO: Do manual inspection
         if not self.training:
             return sample
+
+        def writable(v):
+            # Features may be shared with the memory cache or be read-only feature pack views, augment a private copy
+            if isinstance(v, torch.Tensor):
+                return v.clone()
+            if isinstance(v, np.ndarray):
+                return np.array(v)
+            if isinstance(v, dict):
+                return {k: writable(x) for k, x in v.items()}
+            return v
+
+        sample = Sample({k: writable(v) for k, v in sample.items()})
         swaps = self.bbox_swaps
         copies = self.bbox_copies
         deletes = self.bbox_deletes
@@ -24,7 +24,7 @@ from torchnlp.word_to_vector import BPEmb
 
 from ...training import get_auc_dice_loss
 from ...utils import init_fc, GaussianNoise, stack_and_pad_tensors, get_torchvision_classification_models, get_device, get_image_info_fn, Transpose, \
-    dict2sampleList, loss_calculator, get_loss_by_task, clean_memory, pad_tensor, random_word_mask, load_stored_params, LinearHead, get_regularization_layers, \
+    dict2sampleList, loss_calculator, get_loss_by_task, maybe_clean_memory, pad_tensor, random_word_mask, load_stored_params, LinearHead, get_regularization_layers, \
     WordMasking, FeatureDropout, MLMPretraining, BertLMPredictionHead
 from ..classifiers import CNN1DFeaturizer, GRUFeaturizer, TransformerFeaturizer
 from ..text_models import Fasttext1DCNNModel, LangFeaturesModel
@@ -192,6 +192,18 @@ class VilBertVisualBertModelV2(nn.Module):
         # TODO: Do manual inspection
         if not self.training:
             return sample
+
+        def writable(v):
+            # Features may be shared with the memory cache or be read-only feature pack views, augment a private copy
+            if isinstance(v, torch.Tensor):
+                return v.clone()
+            if isinstance(v, np.ndarray):
+                return np.array(v)
+            if isinstance(v, dict):
+                return {k: writable(x) for k, x in v.items()}
+            return v
+
+        sample = Sample({k: writable(v) for k, v in sample.items()})
         swaps = self.bbox_swaps
         copies = self.bbox_copies
         deletes = self.bbox_deletes
@@ -323,14 +335,14 @@ class VilBertVisualBertModelV2(nn.Module):
         params.pop("image_dim")
         params = {"input_ids": params["input_ids"], "image_feature": params["image_feature"], "image_location": params["image_location"],
                   "token_type_ids": params["token_type_ids"], "attention_mask": params["attention_mask"], "image_attention_mask": params["image_attention_mask"]}
-        clean_memory()
+        maybe_clean_memory()
         params = {k: v.to(self.devices["vilbert"]) if type(v) == torch.Tensor else v for k, v in params.items()}
         return params
 
     def vilbert_processor(self, sample_list: SampleList):
         sample_list = sample_list.to(self.devices["vilbert"])
         params = self.__vilbert_preprocessing__(sample_list)
-        clean_memory()
+        maybe_clean_memory()
         # GPUtil.showUtilization()
 
         (
@@ -350,7 +362,7 @@ class VilBertVisualBertModelV2(nn.Module):
             output_all_attention_masks=False,
         )
         del params
-        clean_memory()
+        maybe_clean_memory()
         if self.vilbert.model.fusion_method == "sum":
             pooled_output = self.vilbert.model.dropout(pooled_output_t + pooled_output_v)
         elif self.vilbert.model.fusion_method == "mul":
@@ -557,7 +569,7 @@ class VilBertVisualBertModelV2(nn.Module):
         pooled_output = self.one_view_reducer(pooled_output)
         pooled_logits = self.one_view_layer(pooled_output)
         pooled_logits = pooled_logits / pooled_logits.norm(dim=1, keepdim=True).clamp(min=1e-5)
-        clean_memory()
+        maybe_clean_memory()
         sequence_output = [seq[:, :seq_length].contiguous() for seq in sequence_output]
         return logit, pooled_logits, pooled_output, sequence_output
 
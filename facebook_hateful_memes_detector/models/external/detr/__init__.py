@@ -96,6 +96,7 @@ class DETRTransferBase(nn.Module, ObjectDETPlotting):
         ])
         self.model_name = model_name
         self.device = device
+        self.im_size = im_size
 
     @classmethod
     def set_seeds(cls, seed=0):
@@ -108,7 +109,10 @@ class DETRTransferBase(nn.Module, ObjectDETPlotting):
             assert len(image_path.size()) == 3
             return image_path.unsqueeze(0).to(self.device)
         elif "PIL" in str(type(image_path)) or type(image_path) == str:
-            return self.to_tensor(self.read_image(image_path)).unsqueeze(0).to(self.device)
+            from ....utils.image_pyramid import get_image_pyramid
+            pyramid = get_image_pyramid()
+            resized = pyramid.load(image_path, self.im_size) if pyramid is not None else None
+            return self.to_tensor(resized if resized is not None else self.read_image(image_path)).unsqueeze(0).to(self.device)
         else:
             raise NotImplementedError()
 
@@ -327,7 +331,8 @@ class DETR(DETRTransferBase):
         if not hasattr(self, "model"):
             self.build_model()
 
-        samples = self.get_pil_image(images)
+        is_batch = type(images) == list
+        samples = torch.cat([self.get_pil_image(i) for i in images], 0) if is_batch else self.get_pil_image(images)
         samples = nested_tensor_from_tensor_list(samples)
         samples.to(self.device)
         self.set_seeds()
@@ -391,24 +396,37 @@ class DETR(DETRTransferBase):
                     outputs_coord = self.model.bbox_embed(hs[-1]).sigmoid()
                     return {'pred_logits': outputs_class, 'pred_boxes': outputs_coord}
             # enc_repr = enc_repr.flatten(2, 3).transpose(1, 2)
+            if is_batch:
+                return torch.cat((h, enc_repr.flatten(2, 3).transpose(1, 2)), dim=1)
             return torch.cat((h.squeeze(), enc_repr.squeeze().flatten(1, 2).transpose(0, 1)), dim=0)
 
 
 def get_detr_model(device: torch.device, model_name: str, decoder_layer=-2, im_size=360, cache_allow_writes=True):
-    from ....utils import persistent_caching_fn, clean_memory
+    from ....utils import persistent_caching_fn, maybe_clean_memory
+    from ....utils.feature_pack import get_feature_pack
     model = DETR(device, model_name, decoder_layer, im_size, False)
 
     def detr_fn(image):
-        clean_memory()
+        maybe_clean_memory()
         return model(image)
 
-    detr_cache_fn = persistent_caching_fn(detr_fn, model_name, cache_allow_writes=cache_allow_writes)
+    def detr_batch_fn(images: List):
+        maybe_clean_memory()
+        return list(model(images))
 
-    def batch_detr_fn(images: List, ignore_cache: List[bool]=None):
-        ignore_cache = ([False] * len(images)) if ignore_cache is None else ignore_cache
-        results = [detr_cache_fn(i, ignore_cache=ic) for i, ic in zip(images, ignore_cache)]
+    detr_cache_fn = persistent_caching_fn(detr_fn, model_name, cache_allow_writes=cache_allow_writes, batch_fn=detr_batch_fn)
+
+    detr_pack = get_feature_pack(model_name)
+
+    def compute_batch_detr_fn(images: List, ignore_cache: List[bool]=None):
+        results = detr_cache_fn.compute_missing(images, ignore_cache)
         return torch.stack(results, 0)
 
+    def batch_detr_fn(images: List, ignore_cache: List[bool]=None):
+        if detr_pack is not None and (ignore_cache is None or not any(ignore_cache)):
+            return detr_pack.gather(images, "features", compute_batch_detr_fn).to(device)
+        return compute_batch_detr_fn(images, ignore_cache)
+
     return {"model": model, "detr_fn": detr_fn, "batch_detr_fn": batch_detr_fn}
 
 
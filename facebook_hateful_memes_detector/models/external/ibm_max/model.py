@@ -128,7 +128,9 @@ def convert_examples_to_features(examples, max_seq_length, tokenizer):
 
 
 import os
+import pickle
 import logging
+from collections import OrderedDict
 MODEL_NAME = 'BERT_PyTorch'
 DIR = os.path.dirname(os.path.realpath(__file__))
 DEFAULT_MODEL_PATH = f'{DIR}/assets/{MODEL_NAME}/'
@@ -147,14 +149,29 @@ import os
 
 
 class ModelWrapper():
-    def __init__(self):
-        """Instantiate the BERT model."""
+    def __init__(self, eval_batch_size=16, cache_file=None, quantize=False, max_recent=10000):
+        """
+        Instantiate the BERT model.
+        `predict` scores each unique text once: missing texts are sorted by length and batched with padding to the longest
+        text of the batch. Scores of texts given to `build` (the dataset) are kept for good and persisted to `cache_file`,
+        any other text (e.g. augmented variants) goes to an LRU of at most `max_recent` entries.
+        Fill `cache_file` once with `python -m facebook_hateful_memes_detector.models.external.ibm_max.model --data_dir ...`.
+        `quantize` uses int8 dynamic quantization of the Linear layers (CPU only), scores differ slightly so keep a separate cache file.
+        """
 
         # Load the model
         # 1. set the appropriate parameters
-        self.eval_batch_size = 16
+        self.eval_batch_size = eval_batch_size
         self.max_seq_length = 64
         self.do_lower_case = True
+        self.quantize = quantize
+        self.cache_file = cache_file
+        self.cache = dict()
+        self.recent = OrderedDict()
+        self.max_recent = max_recent
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file, "rb") as f:
+                self.cache = pickle.load(f)
 
         # 2. Initialize the PyTorch model
         model_state_dict = torch.load(DEFAULT_MODEL_PATH+'pytorch_model.bin', map_location='cpu')
@@ -167,6 +184,8 @@ class ModelWrapper():
 
         # 3. Set the layers to evaluation mode
         self.model.eval()
+        if quantize:
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
 
     def _pre_process(self, input):
         # Converting the input to features
@@ -213,14 +232,95 @@ class ModelWrapper():
         # Return the predictions
         return all_logits
 
+    def _tokenize(self, text):
+        tokens = self.tokenizer.tokenize(str(text))[:self.max_seq_length - 2]
+        return self.tokenizer.convert_tokens_to_ids(["[CLS]"] + tokens + ["[SEP]"])
+
+    def _score(self, texts):
+        """(len(texts), 6) probabilities, batches padded to their longest text."""
+        input_ids = [self._tokenize(t) for t in texts]
+        order = np.argsort([len(ids) for ids in input_ids], kind="stable")
+        result = torch.zeros(len(texts), len(LABEL_LIST))
+        # inference_mode where the installed torch has it
+        inference = torch.inference_mode if hasattr(torch, "inference_mode") else torch.no_grad
+        with inference():
+            for start in range(0, len(order), self.eval_batch_size):
+                batch = order[start:start + self.eval_batch_size]
+                length = max([len(input_ids[i]) for i in batch])
+                ids = torch.zeros(len(batch), length, dtype=torch.long)
+                mask = torch.zeros(len(batch), length, dtype=torch.long)
+                for j, i in enumerate(batch):
+                    ids[j, :len(input_ids[i])] = torch.tensor(input_ids[i], dtype=torch.long)
+                    mask[j, :len(input_ids[i])] = 1
+                ids, mask = ids.to(self.device), mask.to(self.device)
+                logits = self.model(ids, torch.zeros_like(ids), mask)
+                result[torch.from_numpy(batch)] = logits.sigmoid().float().cpu()
+        return result
+
+    def lookup(self, text):
+        if text in self.cache:
+            return self.cache[text]
+        if text in self.recent:
+            self.recent.move_to_end(text)
+            return self.recent[text]
+        return None
+
     def predict(self, x):
-        pre_x = self._pre_process(x)
-        prediction = self._predict(pre_x)
-        # result = self._post_process(prediction)
-        return prediction
+        texts = [str(t) for t in x]
+        scores = {t: self.lookup(t) for t in dict.fromkeys(texts)}
+        missing = [t for t, v in scores.items() if v is None]
+        if len(missing) > 0:
+            scores.update(zip(missing, self._score(missing).numpy()))
+            for t in missing:
+                self.recent[t] = scores[t]
+            while len(self.recent) > self.max_recent:
+                self.recent.popitem(last=False)
+        return torch.tensor(np.stack([scores[t] for t in texts]) if len(texts) > 0 else np.zeros((0, len(LABEL_LIST)), dtype=np.float32))
+
+    def build(self, texts, batch_size=1024):
+        """Score every text once, keep the scores for good and persist them, e.g. the whole dataset before training."""
+        from tqdm.auto import tqdm
+        texts = list(dict.fromkeys([str(t) for t in texts]))
+        for i in tqdm(range(0, len(texts), batch_size), "Scoring ibm_max"):
+            batch = texts[i:i + batch_size]
+            self.cache.update(zip(batch, self.predict(batch).numpy()))
+        self.save()
+        return self
+
+    def save(self):
+        if self.cache_file is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)), exist_ok=True)
+        tmp = self.cache_file + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(self.cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.cache_file)
 
 import time
 if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Score every dataset text once into an ibm_max cache file for LangFeaturesModel(ibm_max_cache=...), "
+                                                 "or time predict when --data_dir is not given")
+    parser.add_argument("--data_dir", default=None)
+    parser.add_argument("--cache_file", default=None, help="Default cache_dir/ibm_max_scores[_int8].pkl as LangFeaturesModel(ibm_max_cache=True)")
+    parser.add_argument("--cache_dir", default=None)
+    parser.add_argument("--quantize", action="store_true")
+    parser.add_argument("--batch_size", type=int, default=64)
+    a = parser.parse_args()
+    if a.data_dir is not None:
+        import pandas as pd
+        from ....utils import set_global, get_global
+        from ....preprocessing import get_datasets
+        if a.cache_dir is not None:
+            set_global("cache_dir", a.cache_dir)
+        cache_file = a.cache_file if a.cache_file is not None else os.path.join(get_global("cache_dir"), "ibm_max_scores%s.pkl" % ("_int8" if a.quantize else ""))
+        data = get_datasets(a.data_dir, cache_images=False)
+        texts = pd.concat([data[k]["text"] for k in ["train", "dev", "test", "dev_unseen", "test_unseen"] if data.get(k) is not None]).tolist()
+        model = ModelWrapper(eval_batch_size=a.batch_size, cache_file=cache_file, quantize=a.quantize)
+        start = time.time()
+        model.build(texts)
+        print("Scored %s texts into %s in %.1f s" % (len(model.cache), cache_file, time.time() - start))
+        exit()
     TEST_SENTENCES = ['I love mom\'s cooking',
                       'I love how you never reply back..',
                       'I love cruising with my homies',
@@ -239,8 +339,8 @@ if __name__=="__main__":
     import random
     big_list = list(flatten([list(map(lambda x: x + str(random.randint(0, 1e6)), TEST_SENTENCES)) for i in range(50)]))
     start = time.time()
-    # Test 10 times
-    _ = [model.predict(big_list) for _ in range(10)]
+    # Test 10 times, cleared cache so every run scores the full list
+    _ = [(model.recent.clear(), model.predict(big_list)) for _ in range(10)]
     end = time.time() - start
     print("Time taken = ", (end/10), "For list size = ", len(big_list))
 
@@ -16,7 +16,7 @@ from torchnlp.word_to_vector import BPEmb
 
 from ...training import get_auc_dice_loss
 from ...utils import init_fc, GaussianNoise, stack_and_pad_tensors, get_torchvision_classification_models, get_image_info_fn, LambdaLayer, get_device, \
-    dict2sampleList, clean_memory, get_vgg_face_model, load_stored_params, get_regularization_layers
+    dict2sampleList, maybe_clean_memory, get_vgg_face_model, load_stored_params, get_regularization_layers
 from ..classifiers import TransformerEnsembleFeaturizer
 from ..text_models import Fasttext1DCNNModel, LangFeaturesModel
 from ..external.detr import get_detr_model
@@ -154,7 +154,7 @@ class MultiImageMultiTextAttentionEarlyFusionModel(nn.Module):
             text_repr = r[2] if self.tx_methods[k] == "__call__" else r
             text_repr = self.post_procs[k](text_repr)
             vectors[k] = text_repr.to(get_device())
-            clean_memory()
+            maybe_clean_memory()
 
         del sampleList
 
@@ -166,12 +166,12 @@ class MultiImageMultiTextAttentionEarlyFusionModel(nn.Module):
         else:
             del img
 
-        clean_memory()
+        maybe_clean_memory()
         for k, m in self.im_models.items():
             im_repr = m(image if k in self.require_raw_img else img)
             im_repr = self.post_procs[k](im_repr)
             vectors[k] = im_repr.to(get_device())
-            clean_memory()
+            maybe_clean_memory()
 
         vectors = self.featurizer(vectors)
         return vectors
@@ -181,7 +181,7 @@ class MultiImageMultiTextAttentionEarlyFusionModel(nn.Module):
         labels = torch.tensor(sampleList.label, dtype=float).to(get_device())
         vectors = self.get_vectors(sampleList)
         del sampleList
-        clean_memory()
+        maybe_clean_memory()
         logits, loss = self.final_layer(vectors, labels)
         if self.training:
             loss += self.auc_dice_loss(logits, labels)
@@ -17,7 +17,8 @@ from torchnlp.word_to_vector import CharNGram
 from torchnlp.word_to_vector import BPEmb
 from ...utils import get_device, GaussianNoise, random_word_mask, load_stored_params, ExpandContract, Transformer, PositionalEncoding, LambdaLayer, get_global, \
     get_torchvision_classification_models, get_image_info_fn, LambdaLayer, get_vgg_face_model, PositionalEncoding2D, Transpose, init_fc, dict2sampleList, \
-    clean_memory, get_regularization_layers, WordMasking, FeatureDropout
+    clean_memory, get_regularization_layers, WordMasking, FeatureDropout, tokenize_and_pad, pretokenized
+from ...preprocessing.token_cache import token_cache_key
 from ..external.detr import get_detr_model, DETRShim
 import transformers
 import os
@@ -122,6 +123,7 @@ class TransformerImageV2Model(nn.Module):
         global_dir = get_global("models_dir")
         model = os.path.join(global_dir, model) if model in os.listdir(global_dir) else model
         self.tokenizer = tokenizer_class.from_pretrained(model)
+        self.token_key = token_cache_key(model, n_tokens_in)
         self.model = model_class.from_pretrained(model)
         print("Pick stored Model", model, "Model Class = ", type(self.model), "Tokenizer Class = ", type(self.tokenizer))
         if featurizer == "transformer":
@@ -149,13 +151,17 @@ class TransformerImageV2Model(nn.Module):
         tokenizer = self.tokenizer
         n_tokens_in = self.text_tokens
         texts = self.word_masking(texts)
-        converted_texts = tokenizer.batch_encode_plus(texts, add_special_tokens=True, pad_to_max_length=True, max_length=n_tokens_in, truncation=True)
-        input_ids, attention_mask = converted_texts["input_ids"], converted_texts["attention_mask"]
+        input_ids, attention_mask = tokenize_and_pad(tokenizer, texts, n_tokens_in, self.min_text_length())
         return torch.tensor(input_ids).to(get_device()), torch.tensor(attention_mask).to(get_device())
 
+    def min_text_length(self):
+        # MLM heads read a fixed n_tokens_in text span, so only pad to the batch's longest text when not pretraining
+        return None if self.do_mlm else max(1, self.featurizer.n_tokens_out - (self.total_tokens - self.text_tokens))
+
     def get_vectors(self, sampleList: SampleList):
         sampleList = dict2sampleList(sampleList, device=get_device())
-        input_ids, attention_mask = self.tokenise(sampleList.text)
+        tokens = pretokenized(sampleList, self.token_key, self.word_masking, self.min_text_length())
+        input_ids, attention_mask = self.tokenise(sampleList.text) if tokens is None else tokens
         word_embeddings = self.model.embeddings(input_ids)  # B, S, C
         embeddings = word_embeddings
         if hasattr(sampleList, "torchvision_image"):
@@ -12,8 +12,10 @@ import torchvision.models as models
 from torchnlp.word_to_vector import CharNGram
 from torchnlp.word_to_vector import BPEmb
 from ...utils import get_device, GaussianNoise, random_word_mask, load_stored_params, ExpandContract, Transformer, PositionalEncoding, LambdaLayer, get_global, \
-    get_regularization_layers, WordMasking
+    get_regularization_layers, WordMasking, dict2sampleList, pretokenized, tokenize_and_pad
+from ...utils.sample import SampleList
 from ...training import fb_1d_loss_builder
+from ...preprocessing.token_cache import token_cache_key
 import os
 import random
 import math
@@ -38,6 +40,7 @@ class AlbertClassifer(Fasttext1DCNNModel):
             global_dir = get_global("models_dir")
             model = os.path.join(global_dir, model) if model in os.listdir(global_dir) else model
             self.tokenizer = AutoTokenizer.from_pretrained(model)
+            self.token_key = token_cache_key(model, n_tokens_in)
             self.model = AutoModel.from_pretrained(model)
             print("Pick stored Model", model, "Model Class = ", type(self.model), "Tokenizer Class = ", type(self.tokenizer))
             if featurizer == "cnn":
@@ -71,12 +74,28 @@ class AlbertClassifer(Fasttext1DCNNModel):
         tokenizer = self.tokenizer
         n_tokens_in = self.n_tokens_in
         texts = self.word_masking(texts)
-        converted_texts = tokenizer.batch_encode_plus(texts, add_special_tokens=True, pad_to_max_length=True, max_length=n_tokens_in, truncation=True)
-        input_ids, attention_mask = converted_texts["input_ids"], converted_texts["attention_mask"]
+        input_ids, attention_mask = tokenize_and_pad(tokenizer, texts, n_tokens_in, self.min_text_length())
         return torch.tensor(input_ids).to(self.device), torch.tensor(attention_mask).to(self.device)
 
-    def get_word_vectors(self, texts: List[str]):
-        input_ids, attention_mask = self.tokenise(texts)
+    def min_text_length(self):
+        # Only the transformer featurizer works on fewer than n_tokens_in tokens
+        return self.featurizer.n_tokens_out if isinstance(self.featurizer, TransformerFeaturizer) else None
+
+    def forward(self, sampleList: SampleList):
+        sampleList = dict2sampleList(sampleList, device=get_device())
+        labels = torch.tensor(sampleList.label).to(get_device())
+        tokens = pretokenized(sampleList, getattr(self, "token_key", None), self.word_masking, self.min_text_length())
+        vectors = self.get_word_vectors(sampleList.text, tokens)
+        del sampleList
+        vectors = self.featurizer(vectors)
+        logits, loss = self.final_layer(vectors, labels) if self.final_layer is not None else (None, None)
+
+        if self.training:
+            loss += self.auc_dice_loss(logits, labels)
+        return logits, vectors.mean(1), vectors, loss
+
+    def get_word_vectors(self, texts: List[str], tokens=None):
+        input_ids, attention_mask = self.tokenise(texts) if tokens is None else tokens
         outputs = self.model(input_ids, attention_mask=attention_mask)
         last_hidden_states = outputs[0]
         pooled_output = outputs[1]
@@ -12,7 +12,7 @@ import torchvision.models as models
 from torchnlp.word_to_vector import CharNGram
 from torchnlp.word_to_vector import BPEmb
 from ...utils import get_device, GaussianNoise, random_word_mask, load_stored_params, ExpandContract, Transformer, PositionalEncoding, LambdaLayer, get_global, \
-    get_regularization_layers, WordMasking
+    get_regularization_layers, WordMasking, tokenize_and_pad, trim_padding
 from ...training import fb_1d_loss_builder
 import os
 import random
@@ -93,13 +93,14 @@ class BERTClassifier(nn.Module):
     def tokenise(self, ids, texts: List[str]):
         tokenizer = self.tokenizer
         n_tokens_in = self.n_tokens_in
+        min_length = self.featurizer.n_tokens_out
         if self.token_cache is None:
-            converted_texts = tokenizer.batch_encode_plus(texts, add_special_tokens=True, pad_to_max_length=True, max_length=n_tokens_in, truncation=True)
-            input_ids, attention_mask = converted_texts["input_ids"], converted_texts["attention_mask"]
+            input_ids, attention_mask = tokenize_and_pad(tokenizer, texts, n_tokens_in, min_length)
+            input_ids, attention_mask = torch.tensor(input_ids), torch.tensor(attention_mask)
         else:
             input_ids, attention_mask = zip(*[self.token_cache[id] for id in ids])
+            input_ids, attention_mask = trim_padding(torch.tensor(input_ids), torch.tensor(attention_mask), min_length)
 
-        input_ids, attention_mask = torch.tensor(input_ids), torch.tensor(attention_mask)
         if self.training or self.force_masking:
             input_ids, _ = self.mask_tokens(input_ids)
         return input_ids.to(self.device), attention_mask.to(self.device)
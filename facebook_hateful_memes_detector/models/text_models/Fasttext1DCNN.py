@@ -11,8 +11,9 @@ from torchnlp.word_to_vector import CharNGram
 from torchnlp.word_to_vector import BPEmb
 
 from ...training import get_auc_dice_loss
-from ...utils import init_fc, GaussianNoise, stack_and_pad_tensors, ExpandContract, get_device, dict2sampleList, load_stored_params, get_regularization_layers
+from ...utils import init_fc, GaussianNoise, stack_and_pad_tensors, dynamic_pad_length, ExpandContract, get_device, dict2sampleList, load_stored_params, get_regularization_layers
 from ..classifiers import CNN1DFeaturizer, GRUFeaturizer, TransformerFeaturizer, BasicFeaturizer
+from ...preprocessing.vocab_embeddings import VocabEmbeddings
 
 
 class Fasttext1DCNNModel(nn.Module):
@@ -26,6 +27,7 @@ class Fasttext1DCNNModel(nn.Module):
         super(Fasttext1DCNNModel, self).__init__()
         fasttext_file = kwargs.pop("fasttext_file", "crawl-300d-2M-subword.bin")  # "wiki-news-300d-1M-subword.bin"
         fasttext_model = kwargs.pop("fasttext_model", None)
+        vocab_embeddings = kwargs.pop("vocab_embeddings", None)
         assert fasttext_file is not None or fasttext_model is not None or use_as_super
         self.num_classes = num_classes
         self.binary = num_classes == 2
@@ -45,6 +47,7 @@ class Fasttext1DCNNModel(nn.Module):
                                            use_layer_norm=True, unit_norm=False, groups=(8, 4))
             self.bpe = BPEmb(dim=200)
             self.cngram = CharNGram()
+            self.vocab_embeddings = VocabEmbeddings.from_config(vocab_embeddings, [self.text_model, self.bpe, self.cngram])
 
             if featurizer == "cnn":
                 self.featurizer = CNN1DFeaturizer(n_tokens_in, embedding_dims, n_tokens_out, classifier_dims, internal_dims, n_layers, gaussian_noise, dropout)
@@ -124,31 +127,26 @@ class Fasttext1DCNNModel(nn.Module):
         cngram = self.cngram
         tm = self.text_model
         n_tokens_in = self.n_tokens_in
-        result = self.get_fasttext_vectors(texts, n_tokens_in, fasttext_crawl=tm, bpe=bpe, cngram=cngram,)
+        min_length = self.featurizer.n_tokens_out if isinstance(getattr(self, "featurizer", None), TransformerFeaturizer) else None
+        if getattr(self, "vocab_embeddings", None) is not None:
+            result = self.vocab_embeddings(texts, n_tokens_in, min_length, device=get_device())
+        else:
+            result = self.get_fasttext_vectors(texts, n_tokens_in, fasttext_crawl=tm, bpe=bpe, cngram=cngram, min_length=min_length)
         result = self.crawl_nn(result)
         return result
 
     @classmethod
     def get_fasttext_vectors(cls, texts: List[str], n_tokens_in,
                              fasttext_crawl=None, fasttext_wiki=None,
-                             bpe=None, cngram=None,):
+                             bpe=None, cngram=None, min_length=None):
+        # min_length given: pad to the longest text in the batch (see dynamic_pad_length) instead of n_tokens_in
+        vectors = [[cls.get_one_sentence_vector(m, text) for text in texts] for m in [fasttext_crawl, fasttext_wiki, bpe, cngram] if m]
+        length = dynamic_pad_length([v.size(0) for vs in vectors for v in vs], n_tokens_in, min_length)
         result = []
-        if fasttext_crawl:
-            res0 = stack_and_pad_tensors([cls.get_one_sentence_vector(fasttext_crawl, text) for text in texts], n_tokens_in)
-            res0 = res0 / res0.norm(dim=2, keepdim=True).clamp(min=1e-5)  # Normalize in word dimension
-            result.append(res0)
-        if fasttext_wiki:
-            res1 = stack_and_pad_tensors([cls.get_one_sentence_vector(fasttext_wiki, text) for text in texts], n_tokens_in)
-            res1 = res1 / res1.norm(dim=2, keepdim=True).clamp(min=1e-5)  # Normalize in word dimension
-            result.append(res1)
-        if bpe:
-            res2 = stack_and_pad_tensors([cls.get_one_sentence_vector(bpe, text) for text in texts], n_tokens_in)
-            res2 = res2 / res2.norm(dim=2, keepdim=True).clamp(min=1e-5)
-            result.append(res2)
-        if cngram:
-            res3 = stack_and_pad_tensors([cls.get_one_sentence_vector(cngram, text) for text in texts], n_tokens_in)
-            res3 = res3 / res3.norm(dim=2, keepdim=True).clamp(min=1e-5)
-            result.append(res3)
+        for vs in vectors:
+            res = stack_and_pad_tensors(vs, length)
+            res = res / res.norm(dim=2, keepdim=True).clamp(min=1e-5)  # Normalize in word dimension
+            result.append(res)
         result = torch.cat(result, 2)
         result = result.to(get_device())
 
@@ -15,6 +15,7 @@ from ...utils import init_fc, GaussianNoise, stack_and_pad_tensors, ExpandContra
     get_regularization_layers, WordMasking
 from ..classifiers import CNN1DFeaturizer, GRUFeaturizer, TransformerFeaturizer, BasicFeaturizer
 from ...training import fb_1d_loss_builder
+from ...preprocessing.vocab_embeddings import VocabEmbeddings
 import fasttext
 import random
 
@@ -54,6 +55,7 @@ class FasttextCNN(nn.Module):
         self.n_tokens_out = n_tokens_out
         self.device = device
         self.word_masking_proba = kwargs.pop("word_masking_proba", 0.0)
+        vocab_embeddings = kwargs.pop("vocab_embeddings", None)
         embedding_dims = classifier_dims // 2
         internal_dims = classifier_dims
 
@@ -73,6 +75,8 @@ class FasttextCNN(nn.Module):
 
         self.bpe = BPEmb(dim=300)
         self.cngram = CharNGram()
+        self.vocab_embeddings = VocabEmbeddings.from_config(vocab_embeddings, [self.text_model, self.text_model_2, self.bpe, self.cngram],
+                                                            normalize=False)
 
         self.featurizer = GRUFeaturizer(n_tokens_in, internal_dims, n_tokens_out, classifier_dims, internal_dims, n_layers, gaussian_noise, dropout)
         self.final_layer = fb_1d_loss_builder(classifier_dims, n_tokens_out, num_classes, dropout, **kwargs)
@@ -123,6 +127,8 @@ class FasttextCNN(nn.Module):
         if self.training:
             texts = [random_whole_word_mask(t, self.word_masking_proba) for t in texts]
         n_tokens_in = self.n_tokens_in
+        if self.vocab_embeddings is not None:
+            return self.vocab_embeddings(texts, n_tokens_in, device=self.device, split=True)
         result = []
 
         res0 = stack_and_pad_tensors([self.get_one_sentence_vector(self.text_model, text) for text in texts], n_tokens_in)
@@ -12,6 +12,7 @@ from torchnlp.word_to_vector import BPEmb
 from flair.data import Sentence
 from flair.embeddings import FlairEmbeddings, BytePairEmbeddings, CharacterEmbeddings, WordEmbeddings, TransformerWordEmbeddings, StackedEmbeddings
 from flair.models import SequenceTagger
+import os
 import re
 import json
 import csv
@@ -24,10 +25,11 @@ from nltk.chunk import ne_chunk
 import spacy
 
 from ...utils import init_fc, GaussianNoise, stack_and_pad_tensors, get_pos_tag_indices, pad_tensor, \
-    get_penn_treebank_pos_tag_indices, get_all_tags, has_words, ExpandContract, get_device, clean_memory, get_regularization_layers
-from ...utils import get_universal_deps_indices, has_digits, load_stored_params
+    get_penn_treebank_pos_tag_indices, get_all_tags, has_words, ExpandContract, get_device, maybe_clean_memory, get_regularization_layers
+from ...utils import get_universal_deps_indices, has_digits, load_stored_params, get_global
 from ..external import get_pytextrank_wc_keylen, get_rake_nltk_wc, get_rake_nltk_phrases
 from ..classifiers import CNN1DFeaturizer, GRUFeaturizer, BasicFeaturizer, TransformerFeaturizer
+from ...preprocessing.vocab_embeddings import VocabEmbeddings
 from .Fasttext1DCNN import Fasttext1DCNNModel
 import pytextrank
 import gensim.downloader as api
@@ -35,6 +37,11 @@ from operator import itemgetter
 import nltk
 from nltk.corpus import stopwords
 from nltk.sentiment.vader import SentimentIntensityAnalyzer
+from ...preprocessing.annotation_store import AnnotationStore, annotation_config
+from ...preprocessing.annotation_pool import AnnotationPool
+
+# Capabilities whose raw features come from `annotate` and can be precomputed into an AnnotationStore
+ANNOTATED_CAPABILITIES = ["spacy", "key_phrases", "nltk", "snlp", "full_view", "ibm_max", "tmoji"]
 
 
 class LangFeaturesModel(Fasttext1DCNNModel):
@@ -65,11 +72,26 @@ class LangFeaturesModel(Fasttext1DCNNModel):
         all_dims = sum([cap_to_dim_map[c] for c in capabilities])
         self.cap_to_dim_map = cap_to_dim_map
         self.all_dims = all_dims
+        annotation_store = kwargs["annotation_store"] if "annotation_store" in kwargs else None
+        self.annotation_store = AnnotationStore(annotation_store) if annotation_store is not None else None
+        # Rows are keyed by text only, so the store must come from an annotator configured like this model
+        assert self.annotation_store is None or self.annotation_store.config == annotation_config(n_tokens_in, kwargs), \
+            "Annotation store %s was built with %s, model has %s" % (annotation_store, self.annotation_store.config, annotation_config(n_tokens_in, kwargs))
+        annotation_workers = kwargs["annotation_workers"] if "annotation_workers" in kwargs else 0
+        self.annotation_pool = None
+        if annotation_workers > 0:
+            worker_kwargs = {k: kwargs[k] for k in ["fasttext_file", "rake_dims", "yake_dims", "ibm_max_cache", "ibm_max_quantize"] if k in kwargs}
+            self.annotation_pool = AnnotationPool([c for c in capabilities if c in ANNOTATED_CAPABILITIES], n_tokens_in, annotation_workers,
+                                                  **worker_kwargs)
+        # Pool workers run the spaCy / stanza / nltk pipelines, this process only builds the learned layers
+        pooled = self.annotation_pool is not None
+        self.annotation_worker = kwargs["annotation_worker"] if "annotation_worker" in kwargs else False
 
         if "spacy" in capabilities:
-            tr = pytextrank.TextRank(token_lookback=7)
-            self.nlp = spacy.load("en_core_web_lg", disable=[])
-            self.nlp.add_pipe(tr.PipelineComponent, name="textrank", last=True)
+            if not pooled:
+                tr = pytextrank.TextRank(token_lookback=7)
+                self.nlp = spacy.load("en_core_web_lg", disable=[])
+                self.nlp.add_pipe(tr.PipelineComponent, name="textrank", last=True)
             spacy_in_dims = (96*2) + (11 * embedding_dim) + 2
             self.spacy_nn = ExpandContract(spacy_in_dims, cap_to_dim_map["spacy"], dropout, use_layer_norm=use_layer_norm, groups=(2, 4))
 
@@ -78,12 +100,16 @@ class LangFeaturesModel(Fasttext1DCNNModel):
             self.cngram = CharNGram()
             fasttext_crawl_file = kwargs["fasttext_crawl_file"] if "fasttext_crawl_file" in kwargs else "crawl-300d-2M-subword.bin"
             self.crawl = fasttext.load_model(fasttext_crawl_file)
+            self.crawl_vocab_embeddings = VocabEmbeddings.from_config(kwargs.get("crawl_vocab_embeddings"), [self.crawl, self.bpe, self.cngram],
+                                                                      normalize=False)
             self.crawl_nn = ExpandContract(200+300+100, cap_to_dim_map["fasttext_crawl"], dropout, use_layer_norm=use_layer_norm, groups=(4, 4))
 
         if "gensim" in capabilities:
             gensim = [api.load("glove-twitter-50"), api.load("glove-wiki-gigaword-50"),
                       api.load("word2vec-google-news-300"), api.load("conceptnet-numberbatch-17-06-300")]
             self.gensim = gensim
+            lookups = [lambda w, m=m: m[w][:150] if w in m else np.zeros(min(m.vector_size, 150)) for m in gensim]
+            self.gensim_vocab_embeddings = VocabEmbeddings.from_config(kwargs.get("gensim_vocab_embeddings"), gensim, lookups, normalize=False)
             self.gensim_nn = ExpandContract(400, cap_to_dim_map["gensim"], dropout, use_layer_norm=use_layer_norm, groups=(4, 4))
 
         if "full_view" in capabilities:
@@ -91,16 +117,18 @@ class LangFeaturesModel(Fasttext1DCNNModel):
             self.full_sent_nn = ExpandContract(full_sent_in_dims, cap_to_dim_map["full_view"], dropout, use_layer_norm=use_layer_norm, groups=(4, 4))
 
         if "snlp" in capabilities:
-            import stanza
-            self.snlp = stanza.Pipeline('en', processors='tokenize,pos,lemma,depparse,ner', use_gpu=False,
-                                    pos_batch_size=2048)
+            if not pooled:
+                import stanza
+                self.snlp = stanza.Pipeline('en', processors='tokenize,pos,lemma,depparse,ner', use_gpu=False,
+                                            pos_batch_size=2048)
             self.snlp_nn = ExpandContract(embedding_dim * 5, cap_to_dim_map["snlp"], dropout,
                                           use_layer_norm=use_layer_norm)
         if "key_phrases" in capabilities:
-            import yake
-            self.kw_extractor = yake.KeywordExtractor(lan="en", n=3, dedupLim=0.9,
-                                                 dedupFunc='seqm', windowsSize=3,
-                                                 top=10, features=None)
+            if not pooled:
+                import yake
+                self.kw_extractor = yake.KeywordExtractor(lan="en", n=3, dedupLim=0.9,
+                                                          dedupFunc='seqm', windowsSize=3,
+                                                          top=10, features=None)
 
             self.key_occ_cnt_pytextrank = nn.Embedding(8, embedding_dim)
             nn.init.normal_(self.key_occ_cnt_pytextrank.weight, std=1 / embedding_dim)
@@ -124,7 +152,8 @@ class LangFeaturesModel(Fasttext1DCNNModel):
             self.keyphrase_nn = ExpandContract(keyphrases_dim, cap_to_dim_map["key_phrases"], dropout, use_layer_norm=use_layer_norm, groups=(4, 4))
 
         fasttext_file = kwargs["fasttext_file"] if "fasttext_file" in kwargs else "wiki-news-300d-1M-subword.bin"
-        if not set(capabilities).isdisjoint({"key_phrases", "full_view", "nltk"}):
+        # With a pool, the parent only needs fasttext to look up nltk token vectors
+        if not set(capabilities).isdisjoint({"nltk"} if pooled else {"key_phrases", "full_view", "nltk"}):
             self.text_model = fasttext.load_model(fasttext_file)
 
         self.pdict = get_all_tags()
@@ -155,21 +184,27 @@ class LangFeaturesModel(Fasttext1DCNNModel):
         nn.init.normal_(self.wc_emb.weight, std=1 / embedding_dim)
 
         if "nltk" in capabilities:
-            import rake_nltk
-            from textblob import TextBlob
-            from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer as VaderSentimentIntensityAnalyzer
-            self.stop_words = set(stopwords.words('english'))
-            self.rake_nltk = rake_nltk.Rake()
+            if not pooled:
+                import rake_nltk
+                from textblob import TextBlob
+                from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer as VaderSentimentIntensityAnalyzer
+                self.stop_words = set(stopwords.words('english'))
+                self.rake_nltk = rake_nltk.Rake()
+                self.nltk_sid = SentimentIntensityAnalyzer()
+                self.vader_sid = VaderSentimentIntensityAnalyzer()
             self.key_wc_rake_nltk = nn.Embedding(4, embedding_dim)
             nn.init.normal_(self.key_wc_rake_nltk.weight, std=1 / embedding_dim)
-            self.nltk_sid = SentimentIntensityAnalyzer()
-            self.vader_sid = VaderSentimentIntensityAnalyzer()
             in_dims = 310 + 5 * embedding_dim
             self.nltk_nn = ExpandContract(in_dims, cap_to_dim_map["nltk"], dropout, use_layer_norm=use_layer_norm, groups=(2, 4))
 
         if "ibm_max" in capabilities:
             from ..external import ModelWrapper
-            self.ibm_max = ModelWrapper()
+            # Scores are cached by text, True persists them under cache_dir, a str is the cache file
+            ibm_max_cache = kwargs["ibm_max_cache"] if "ibm_max_cache" in kwargs else None
+            ibm_max_quantize = kwargs["ibm_max_quantize"] if "ibm_max_quantize" in kwargs else False
+            if ibm_max_cache is True:
+                ibm_max_cache = os.path.join(get_global("cache_dir"), "ibm_max_scores%s.pkl" % ("_int8" if ibm_max_quantize else ""))
+            self.ibm_max = ModelWrapper(eval_batch_size=64, cache_file=ibm_max_cache or None, quantize=ibm_max_quantize)
             for p in self.ibm_max.model.parameters():
                 p.requires_grad = False
             self.ibm_nn = ExpandContract(6, cap_to_dim_map["ibm_max"], dropout, use_layer_norm=use_layer_norm, groups=(1, 1))
@@ -230,6 +265,8 @@ class LangFeaturesModel(Fasttext1DCNNModel):
         cngram = self.cngram
         tm = self.crawl
         n_tokens_in = self.n_tokens_in
+        if self.crawl_vocab_embeddings is not None:
+            return self.crawl_nn(self.crawl_vocab_embeddings(texts, n_tokens_in, device=get_device()))
         result = stack_and_pad_tensors([self.get_one_crawl_sentence_vector(tm, text) for text in texts], n_tokens_in)
         res2 = stack_and_pad_tensors([self.get_one_crawl_sentence_vector(bpe, text) for text in texts], n_tokens_in)
         res3 = stack_and_pad_tensors([self.get_one_crawl_sentence_vector(cngram, text) for text in texts], n_tokens_in)
@@ -252,6 +289,8 @@ class LangFeaturesModel(Fasttext1DCNNModel):
 
     def get_gensim_word_vectors(self, texts: List[str]):
         n_tokens_in = self.n_tokens_in
+        if self.gensim_vocab_embeddings is not None:
+            return self.gensim_nn(self.gensim_vocab_embeddings(texts, n_tokens_in, device=get_device()))
         result = []
         for m in self.gensim:
             r = stack_and_pad_tensors([self.get_one_sentence_vector(m, text) for text in texts], n_tokens_in)
@@ -262,7 +301,8 @@ class LangFeaturesModel(Fasttext1DCNNModel):
         result = self.gensim_nn(result)
         return result
 
-    def get_nltk_vectors(self, texts: List[str]):
+
+    def annotate_nltk(self, texts: List[str]):
         # https://gist.github.com/japerk/1909413
         from textblob import TextBlob
         sid = self.nltk_sid
@@ -271,232 +311,194 @@ class LangFeaturesModel(Fasttext1DCNNModel):
         n_tokens_in = self.n_tokens_in
         rake = self.rake_nltk
         nltk_texts = [fasttext.tokenize(text) for text in texts]
-        textblob_sentiments = [[sentiment.polarity, sentiment.subjectivity] for sentiment in [TextBlob(text).sentiment for text in texts]]
-        textblob_sentiments = torch.tensor(textblob_sentiments).unsqueeze(1).expand(len(texts), n_tokens_in, 2)
-        textblob_sentiments = textblob_sentiments.to(get_device())
-
+        textblob_sentiments = torch.tensor([[sentiment.polarity, sentiment.subjectivity] for sentiment in [TextBlob(text).sentiment for text in texts]])
         mask = stack_and_pad_tensors(list(map(lambda x: torch.ones(len(x), dtype=int), nltk_texts)), n_tokens_in)
-        mask = mask.to(get_device())
-        mask = self.is_mask_em(mask)
         has_digit = stack_and_pad_tensors(
             list(map(lambda x: torch.tensor([has_digits(str(t)) for t in x]), nltk_texts)), n_tokens_in)
-        has_digit = has_digit.to(get_device())
-        has_digit = self.has_digit_em(has_digit)
-
-        m = self.text_model
-        nltk_emb = stack_and_pad_tensors([torch.tensor([m[t] for t in sent]) for sent in nltk_texts], n_tokens_in) # if t in m else np.zeros(m.vector_size)
-        nltk_emb = nltk_emb.to(get_device())
         sid_vec = torch.tensor([list(sid.polarity_scores(t).values()) for t in texts])
-        sid_vec = sid_vec.unsqueeze(1).expand(len(texts), n_tokens_in, sid_vec.size(1))
-        sid_vec = sid_vec.to(get_device())
         vsid_vec = torch.tensor([list(vsid.polarity_scores(t).values()) for t in texts])
-        vsid_vec = vsid_vec.unsqueeze(1).expand(len(texts), n_tokens_in, vsid_vec.size(1))
-        vsid_vec = vsid_vec.to(get_device())
         conlltags = [[ptags for ptags in nltk.tree2conlltags(ne_chunk(pos_tag(x)))] for x in nltk_texts]
-
         pos = stack_and_pad_tensors(
             list(map(lambda x: torch.tensor([pdict[tag.lower()] for token, tag, ne in x]), conlltags)), n_tokens_in)
-        pos = pos.to(get_device())
-        pos_emb = self.tag_em(pos)
         ner = stack_and_pad_tensors(
             list(map(lambda x: torch.tensor([pdict[ne.lower().split("-")[-1]] for token, tag, ne in x]), conlltags)), n_tokens_in)
-        ner = ner.to(get_device())
-        ner_emb = self.tag_em(ner)
-
         phrases = [get_rake_nltk_phrases(rake, t) for t in texts]
+        key_wc_rake_nltk = stack_and_pad_tensors([get_rake_nltk_wc(tokens, phr) for tokens, phr in zip(nltk_texts, phrases)], n_tokens_in)
+        result = dict(textblob=textblob_sentiments, mask=mask, has_digit=has_digit, sid=sid_vec, vsid=vsid_vec,
+                      pos=pos, ner=ner, key_wc_rake_nltk=key_wc_rake_nltk)
+        if not self.annotation_worker:
+            result["nltk_emb"] = self.get_nltk_token_vectors(texts)
+        return result
 
-        key_wc_rake_nltk = [get_rake_nltk_wc(tokens, phr) for tokens, phr in zip(nltk_texts, phrases)]
-        key_wc_rake_nltk = stack_and_pad_tensors(key_wc_rake_nltk, self.n_tokens_in)
-        key_wc_rake_nltk = key_wc_rake_nltk.to(get_device())
-        nltk_rake_vectors = self.key_wc_rake_nltk(key_wc_rake_nltk)
+    def get_nltk_token_vectors(self, texts: List[str]):
+        m = self.text_model
+        return stack_and_pad_tensors([torch.tensor([m[t] for t in fasttext.tokenize(text)]) for text in texts], self.n_tokens_in)
 
-        result = torch.cat([vsid_vec, nltk_emb, textblob_sentiments, pos_emb, ner_emb, nltk_rake_vectors, sid_vec, mask, has_digit], 2)
-        result = result.to(get_device())
-        result = self.nltk_nn(result)
-        return result
+    def embed_nltk(self, a):
+        B, L = a["mask"].size()
+        result = torch.cat([a["vsid"].unsqueeze(1).expand(B, L, a["vsid"].size(1)), a["nltk_emb"],
+                            a["textblob"].unsqueeze(1).expand(B, L, 2), self.tag_em(a["pos"]), self.tag_em(a["ner"]),
+                            self.key_wc_rake_nltk(a["key_wc_rake_nltk"]), a["sid"].unsqueeze(1).expand(B, L, a["sid"].size(1)),
+                            self.is_mask_em(a["mask"]), self.has_digit_em(a["has_digit"])], 2)
+        return self.nltk_nn(result)
 
-    def get_sentence_vector(self, texts: List[str]):
+    def annotate_full_view(self, texts: List[str]):
         tm = self.text_model
-        n_tokens_in = self.n_tokens_in
-        result = torch.tensor([tm.get_sentence_vector(text) for text in texts])
-        result = result.to(get_device())
-        result = self.full_sent_nn(result)
-        result = result.unsqueeze(1).expand(len(texts), n_tokens_in, result.size(1))
-        return result
+        return dict(sentence=torch.tensor([tm.get_sentence_vector(text) for text in texts]))
+
+    def embed_full_view(self, a):
+        result = self.full_sent_nn(a["sentence"])
+        return result.unsqueeze(1).expand(result.size(0), self.n_tokens_in, result.size(1))
 
-    def get_stanford_nlp_vectors(self, texts: List[str]):
+    def get_sentence_vector(self, texts: List[str]):
+        return self.embed_full_view({k: v.to(get_device()) for k, v in self.annotate(texts, ["full_view"])["full_view"].items()})
+
+    def annotate_snlp(self, texts: List[str]):
         snlp = self.snlp
         pdict = self.pdict
         n_tokens_in = self.n_tokens_in
         docs = [list(map(lambda x: dict(**x.to_dict()[0], ner=x.ner), snlp(doc).iter_tokens())) for doc in texts]
 
-        upos = stack_and_pad_tensors(
-            list(map(lambda x: torch.tensor([pdict[token["upos"].lower()] for token in x]), docs)), n_tokens_in)
-        upos_emb = self.tag_em(upos)
-
-        xpos = stack_and_pad_tensors(
-            list(map(lambda x: torch.tensor([pdict[token["xpos"].lower()] for token in x]), docs)), n_tokens_in)
-        xpos_emb = self.tag_em(xpos)
-
-        deprel = stack_and_pad_tensors(
-            list(map(lambda x: torch.tensor([pdict[token["deprel"].split(":")[0].lower()] for token in x]), docs)),
-            n_tokens_in)
-        deprel_emb = self.tag_em(deprel)
+        def tags(fn):
+            return stack_and_pad_tensors(list(map(lambda x: torch.tensor([fn(token) for token in x]), docs)), n_tokens_in)
 
-        deprel2 = stack_and_pad_tensors(
-            list(map(lambda x: torch.tensor(
-                [pdict[token["deprel"].split(":")[1].lower()] if ":" in token["deprel"] else 0 for token in x]), docs)),
-            n_tokens_in)
-        deprel_emb2 = self.tag_em(deprel2)
+        return dict(upos=tags(lambda token: pdict[token["upos"].lower()]),
+                    xpos=tags(lambda token: pdict[token["xpos"].lower()]),
+                    deprel=tags(lambda token: pdict[token["deprel"].split(":")[0].lower()]),
+                    deprel2=tags(lambda token: pdict[token["deprel"].split(":")[1].lower()] if ":" in token["deprel"] else 0),
+                    sner=tags(lambda token: pdict[token["ner"].split("-")[1].lower()] if "-" in token["ner"] else 0))
 
-        sner = stack_and_pad_tensors(
-            list(map(lambda x: torch.tensor(
-                [pdict[token["ner"].split("-")[1].lower()] if "-" in token["ner"] else 0 for token in x]), docs)),
-            n_tokens_in)
-        sner_emb = self.tag_em(sner)
-
-        result = torch.cat(
-            [upos_emb, xpos_emb, deprel_emb, sner_emb, deprel_emb2], 2)
-        result = result.to(get_device())
-        result = self.snlp_nn(result)
-        return result
+    def embed_snlp(self, a):
+        result = torch.cat([self.tag_em(a["upos"]), self.tag_em(a["xpos"]), self.tag_em(a["deprel"]), self.tag_em(a["sner"]),
+                            self.tag_em(a["deprel2"])], 2)
+        return self.snlp_nn(result)
 
-    def get_spacy_nlp_vectors(self, texts: List[str]):
+    def annotate_spacy(self, spacy_texts):
         pdict = self.pdict
-        nlp = self.nlp
         n_tokens_in = self.n_tokens_in
+
+        def tokens(fn):
+            return stack_and_pad_tensors(list(map(lambda x: torch.tensor([fn(token) for token in x]), spacy_texts)), n_tokens_in)
+
         with torch.no_grad():
-            spacy_texts = list(nlp.pipe(texts, n_process=1))
-            text_tensors = list(map(lambda x: torch.tensor(x.tensor), spacy_texts))
-            text_tensors = stack_and_pad_tensors(text_tensors, n_tokens_in)
+            text_tensors = stack_and_pad_tensors(list(map(lambda x: torch.tensor(x.tensor), spacy_texts)), n_tokens_in)
             head_tensors = stack_and_pad_tensors(list(map(lambda x: torch.tensor([t.head.tensor for t in x]), spacy_texts)), n_tokens_in)
-            text_tensors = text_tensors.to(get_device())
-            head_tensors = head_tensors.to(get_device())
-        wl = stack_and_pad_tensors(
-            list(map(lambda x: torch.tensor([len(token) - 1 for token in x]).clamp(0, 15), spacy_texts)), n_tokens_in)
-        wl = wl.to(get_device())
-        wl_emb = self.w_len(wl)
-        wc = (torch.tensor(list(map(len, spacy_texts))) // 10).long().unsqueeze(1).expand(len(texts), n_tokens_in)
-        wc = wc.to(get_device())
-        wc_emb = self.wc_emb(wc)
-
-        mask = stack_and_pad_tensors(list(map(lambda x: torch.ones(len(x), dtype=int), spacy_texts)), n_tokens_in)
-        mask = mask.to(get_device())
-        mask = self.is_mask_em(mask)
-        has_digit = stack_and_pad_tensors(list(map(lambda x: torch.tensor([has_digits(str(t)) for t in x]), spacy_texts)), n_tokens_in)
-        has_digit = has_digit.to(get_device())
-        has_digit = self.has_digit_em(has_digit)
+        return dict(text_tensors=text_tensors, head_tensors=head_tensors,
+                    wl=stack_and_pad_tensors(list(map(lambda x: torch.tensor([len(token) - 1 for token in x]).clamp(0, 15), spacy_texts)), n_tokens_in),
+                    wc=(torch.tensor(list(map(len, spacy_texts))) // 10).long(),
+                    mask=stack_and_pad_tensors(list(map(lambda x: torch.ones(len(x), dtype=int), spacy_texts)), n_tokens_in),
+                    has_digit=tokens(lambda token: has_digits(str(token))),
+                    pos=tokens(lambda token: pdict[token.pos_.lower()]),
+                    tag=tokens(lambda token: pdict[token.tag_.lower()]),
+                    dep=tokens(lambda token: pdict[token.dep_.lower()]),
+                    sw=tokens(lambda token: int(token.is_stop)),
+                    ner=tokens(lambda token: pdict[token.ent_type_.lower()]),
+                    is_oov=tokens(lambda token: int(token.is_oov)),
+                    sent_start=tokens(lambda token: int(token.sent_start)),
+                    head_dist=tokens(lambda token: float(token.idx - token.head.idx)))
+
+    def embed_spacy(self, a):
+        B, L = a["mask"].size()
+        result = torch.cat(
+            [a["text_tensors"], self.tag_em(a["pos"]), self.tag_em(a["tag"]), self.tag_em(a["dep"]), self.sw_em(a["sw"]),
+             self.tag_em(a["ner"]), self.w_len(a["wl"]), self.wc_emb(a["wc"].unsqueeze(1).expand(B, L)), self.is_mask_em(a["mask"]),
+             self.has_digit_em(a["has_digit"]), self.is_oov_em(a["is_oov"]), self.sent_start_em(a["sent_start"]),
+             a["head_dist"].unsqueeze(2).expand(B, L, 2), a["head_tensors"]], 2)
+        return self.spacy_nn(result)
 
-        pos = stack_and_pad_tensors(
-            list(map(lambda x: torch.tensor([pdict[token.pos_.lower()] for token in x]), spacy_texts)), n_tokens_in)
-        pos = pos.to(get_device())
-        pos_emb = self.tag_em(pos)
-        tag = stack_and_pad_tensors(
-            list(map(lambda x: torch.tensor([pdict[token.tag_.lower()] for token in x]), spacy_texts)), n_tokens_in)
-        tag = tag.to(get_device())
-        tag_emb = self.tag_em(tag)
-        dep = stack_and_pad_tensors(
-            list(map(lambda x: torch.tensor([pdict[token.dep_.lower()] for token in x]), spacy_texts)), n_tokens_in)
-        dep = dep.to(get_device())
-        dep_emb = self.tag_em(dep)
-        sw = stack_and_pad_tensors(list(map(lambda x: torch.tensor([int(token.is_stop) for token in x]), spacy_texts)),
-                                   n_tokens_in)
-        sw = sw.to(get_device())
-        sw_emb = self.sw_em(sw)
-        ner = stack_and_pad_tensors(
-            list(map(lambda x: torch.tensor([pdict[token.ent_type_.lower()] for token in x]), spacy_texts)), n_tokens_in)
-        ner = ner.to(get_device())
-        ner_emb = self.tag_em(ner)
-
-        is_oov = stack_and_pad_tensors(
-            list(map(lambda x: torch.tensor([int(token.is_oov) for token in x]), spacy_texts)),
-            n_tokens_in)
-        is_oov = is_oov.to(get_device())
-        is_oov_em = self.is_oov_em(is_oov)
-
-        sent_start = stack_and_pad_tensors(
-            list(map(lambda x: torch.tensor([int(token.sent_start) for token in x]), spacy_texts)),
-            n_tokens_in)
-        sent_start = sent_start.to(get_device())
-        sent_start_em = self.sent_start_em(sent_start)
-
-        head_dist = stack_and_pad_tensors(
-            list(map(lambda x: torch.tensor([float(token.idx - token.head.idx) for token in x]), spacy_texts)),
-            n_tokens_in)
-        head_dist = head_dist.to(get_device())
-        head_dist = head_dist.unsqueeze(2).expand(len(texts), n_tokens_in, 2)
+    def annotate_ibm_max(self, texts: List[str]):
+        return dict(probas=self.ibm_max.predict(texts))
 
-        result = torch.cat(
-            [text_tensors, pos_emb, tag_emb, dep_emb, sw_emb, ner_emb, wl_emb,
-             wc_emb, mask, has_digit, is_oov_em, sent_start_em, head_dist, head_tensors], 2)
-        result = result.to(get_device())
-        result = self.spacy_nn(result)
-        return result, spacy_texts
+    def embed_ibm_max(self, a):
+        result = self.ibm_nn(a["probas"])
+        return result.unsqueeze(1).expand(result.size(0), self.n_tokens_in, result.size(1))
 
-    def get_ibm_max(self, texts: List[str]):
-        with torch.no_grad():
-            result = self.ibm_max.predict(texts)
-        result = result.to(get_device())
-        result = self.ibm_nn(result)
-        result = result.unsqueeze(1).expand(len(texts), self.n_tokens_in, result.size(1))
-        return result
+    def annotate_tmoji(self, texts: List[str]):
+        return dict(probas=self.get_torchmoji_probas(texts).cpu())
 
-    def get_tmoji(self, texts: List[str]):
-        with torch.no_grad():
-            tm_probas = self.get_torchmoji_probas(texts)
-        tm_probas = self.tm_nn(tm_probas)
-        tm_probas = tm_probas.unsqueeze(1).expand(len(texts), self.n_tokens_in, tm_probas.size(1))
-        return tm_probas
+    def embed_tmoji(self, a):
+        tm_probas = self.tm_nn(a["probas"])
+        return tm_probas.unsqueeze(1).expand(tm_probas.size(0), self.n_tokens_in, tm_probas.size(1))
 
-    def get_keyphrases(self, texts: List[str], spacy_texts):
+    def keyphrase_vectors(self, texts: List[str], extract):
         tm = self.text_model
+        embs = [[tm.get_sentence_vector(s) for s in map(itemgetter(0), extract(t))] if has_words(t) else [np.zeros(300)] for t in texts]
+        return torch.tensor([np.average(e, axis=0, weights=softmax(list(range(len(e), 0, -1)))).astype(np.float32) if len(e) > 0 else np.zeros(tm.get_dimension(), dtype=np.float32) for e in embs])
+
+    def annotate_key_phrases(self, texts: List[str], spacy_texts):
         results = [get_pytextrank_wc_keylen(i) for i in spacy_texts]
         key_wc_pytextrank, key_occ_cnt_pytextrank = zip(*results)
-        key_wc_pytextrank = stack_and_pad_tensors(key_wc_pytextrank, self.n_tokens_in)
-        key_occ_cnt_pytextrank = stack_and_pad_tensors(key_occ_cnt_pytextrank, self.n_tokens_in)
-        key_occ_cnt_pytextrank = key_occ_cnt_pytextrank.to(get_device())
-        key_wc_pytextrank = key_wc_pytextrank.to(get_device())
-        pytextrank_vectors = torch.cat((self.key_wc_pytextrank(key_wc_pytextrank), self.key_occ_cnt_pytextrank(key_occ_cnt_pytextrank)), 2)  # 16
-        pytextrank_vectors = pytextrank_vectors.to(get_device())
-        yake_ke = self.kw_extractor
-        yake_embs = [[tm.get_sentence_vector(s) for s in map(itemgetter(0), yake_ke.extract_keywords(t))] if has_words(t) else [np.zeros(300)] for t in texts]
-        yake_embs = torch.tensor([np.average(yk, axis=0, weights=softmax(list(range(len(yk), 0, -1)))).astype(np.float32) if len(yk) > 0 else np.zeros(tm.get_dimension(), dtype=np.float32) for yk in yake_embs])
-        yake_embs = yake_embs.to(get_device())
-        yake_embs = self.yake_nn(yake_embs).unsqueeze(1).expand(len(texts), self.n_tokens_in, self.yake_dims)
+        result = dict(key_wc_pytextrank=stack_and_pad_tensors(key_wc_pytextrank, self.n_tokens_in),
+                      key_occ_cnt_pytextrank=stack_and_pad_tensors(key_occ_cnt_pytextrank, self.n_tokens_in),
+                      yake=self.keyphrase_vectors(texts, self.kw_extractor.extract_keywords))
+        if self.rake is not None:
+            result["rake"] = self.keyphrase_vectors(texts, self.rake.apply)
+        return result
 
+    def embed_key_phrases(self, a):
+        B, L = a["key_wc_pytextrank"].size()
+        vectors = [self.key_wc_pytextrank(a["key_wc_pytextrank"]), self.key_occ_cnt_pytextrank(a["key_occ_cnt_pytextrank"]),
+                   self.yake_nn(a["yake"]).unsqueeze(1).expand(B, L, self.yake_dims)]
         if self.rake is not None:
-            rake_ke = self.rake
-            rake_embs = [[tm.get_sentence_vector(s) for s in map(itemgetter(0), rake_ke.apply(t))] if has_words(t) else [np.zeros(300)] for
-                         t in texts]
-            rake_embs = torch.tensor(
-                [np.average(rk, axis=0, weights=softmax(list(range(len(rk), 0, -1)))).astype(np.float32) if len(rk) > 0 else np.zeros(tm.get_dimension(), dtype=np.float32) for rk in rake_embs])
-            rake_embs = rake_embs.to(get_device())
-            rake_embs = self.rake_nn(rake_embs).unsqueeze(1).expand(len(texts), self.n_tokens_in, self.rake_dims)
-            result = torch.cat([pytextrank_vectors, yake_embs, rake_embs], 2)
-        else:
-            result = torch.cat([pytextrank_vectors, yake_embs], 2)
-        result = result.to(get_device())
-        result = self.keyphrase_nn(result)
+            vectors.append(self.rake_nn(a["rake"]).unsqueeze(1).expand(B, L, self.rake_dims))
+        return self.keyphrase_nn(torch.cat(vectors, 2))
+
+    def annotate(self, texts: List[str], capabilities=None):
+        """Raw (not learned) features of each annotated capability, CPU tensors with token fields padded to n_tokens_in."""
+        capabilities = [c for c in self.capabilities if c in ANNOTATED_CAPABILITIES] if capabilities is None else capabilities
+        if self.annotation_pool is not None:
+            result = self.annotation_pool.annotate(texts, capabilities)
+            if "nltk" in result:
+                # Per token fasttext vectors are looked up here rather than sent back by the workers
+                result["nltk"]["nltk_emb"] = self.get_nltk_token_vectors(texts)
+            return result
+        result = dict()
+        spacy_texts = None
+        if "spacy" in capabilities or "key_phrases" in capabilities:
+            spacy_texts = list(self.nlp.pipe(texts, n_process=1))
+        for c in capabilities:
+            if c == "spacy":
+                result[c] = self.annotate_spacy(spacy_texts)
+            elif c == "key_phrases":
+                result[c] = self.annotate_key_phrases(texts, spacy_texts)
+            else:
+                result[c] = getattr(self, "annotate_" + c)(texts)
         return result
 
+    def get_annotations(self, texts: List[str]):
+        # Rows from the annotation store where present, live annotation for texts or capabilities it doesn't have
+        capabilities = [c for c in self.capabilities if c in ANNOTATED_CAPABILITIES]
+        store = self.annotation_store
+        stored = [c for c in capabilities if store is not None and c in store.families]
+        result = self.annotate(texts, [c for c in capabilities if c not in stored])
+        if len(stored) > 0:
+            rows = store.lookup(texts)
+            hit = rows >= 0
+            missing = [t for t, h in zip(texts, hit) if not h]
+            live = self.annotate(missing, stored) if len(missing) > 0 else dict()
+            for c in stored:
+                fields = dict()
+                for k, v in store.get(c, rows[hit]).items():
+                    v = torch.from_numpy(v)
+                    if len(missing) > 0:
+                        full = v.new_zeros((len(texts),) + tuple(v.shape[1:]))
+                        full[torch.from_numpy(np.where(hit)[0])] = v
+                        full[torch.from_numpy(np.where(~hit)[0])] = live[c][k].to(v.dtype)
+                        v = full
+                    fields[k] = v
+                result[c] = fields
+        return {c: {k: v.to(get_device()) for k, v in fields.items()} for c, fields in result.items()}
+
     def get_word_vectors(self, texts: List[str]):
-        cap_method = {"snlp": self.get_stanford_nlp_vectors, "full_view": self.get_sentence_vector,
-                      "nltk": self.get_nltk_vectors,
-                      "ibm_max": self.get_ibm_max, "tmoji": self.get_tmoji, "gensim": self.get_gensim_word_vectors,
-                      "fasttext_crawl": self.get__crawl_word_vectors}
+        cap_method = {"gensim": self.get_gensim_word_vectors, "fasttext_crawl": self.get__crawl_word_vectors}
+        annotations = self.get_annotations(texts)
+        # spacy and key_phrases first, then the rest in capabilities order
+        order = [c for c in ["spacy", "key_phrases"] if c in self.capabilities] + [c for c in self.capabilities if c not in ["spacy", "key_phrases"]]
         results = []
-        if "spacy" in self.capabilities:
-            r, spt = self.get_spacy_nlp_vectors(texts)
-            results.append(r)
-        if "key_phrases" in self.capabilities and "spacy" in self.capabilities:
-            r = self.get_keyphrases(texts, spt)
-            results.append(r)
-        for c in self.capabilities:
-            if c == "spacy" or c == "key_phrases":
-                continue
-            r = cap_method[c](texts)
+        for c in order:
+            r = getattr(self, "embed_" + c)(annotations[c]) if c in annotations else cap_method[c](texts)
             results.append(r)
-        clean_memory()
+        maybe_clean_memory()
         result = torch.cat(results, 2)
         result = result.to(get_device())
         result = self.contract_nn(result)
@@ -20,8 +20,14 @@ from torchvision import transforms
 import random
 import math
 
-from ..utils import read_json_lines_into_df, isNan
+from ..utils import read_json_lines_into_df, isNan, build_image_digest_index, tag_image_digest
+from ..utils.image_pyramid import get_image_pyramid
 from ..utils.sample import Sample
+from .image_store import DecodedImageStore
+from .neighbour_table import NeighbourTable
+from .shared_embeddings import MmapKeyedVectors, MmapWordEmbs, export_keyed_vectors
+from .augment_service import AugmentServiceClient, ServiceAugment, start_augment_service
+from .view_store import AugmentedViewStore
 
 
 def identity(x): return x
@@ -331,7 +337,8 @@ def isnumber(text):
 class TextAugment:
     def __init__(self, count_proba: List[float], choice_probas: Dict[str, float],
                  fasttext_file: str = None, idf_file: str = None,
-                 dab_file: str = None, tokenizer="bert-base-uncased"):
+                 dab_file: str = None, tokenizer="bert-base-uncased", neighbour_tables: Dict[str, str] = None,
+                 embeddings_dir: str = None, augment_service=None):
         self.count_proba = count_proba
         assert 1 - 1e-6 <= sum(count_proba) <= 1 + 1e-6
         assert len(count_proba) >= 1
@@ -545,12 +552,33 @@ class TextAugment:
         assert len(set(list(choice_probas.keys())) - set(self.augs)) == 0
         self.augments = dict()
         self.indexes = dict()
+        neighbour_tables = dict() if neighbour_tables is None else neighbour_tables
+
+        if augment_service is None and embeddings_dir is not None and max(choice_probas.get("word_insert", 0), choice_probas.get("word_substitute", 0)) > 0:
+            # Shared models mode, DistilBERT is loaded once in a service process instead of in every DataLoader worker
+            augment_service = ("localhost", 6100)
+            start_augment_service(augment_service)
+        service_client = AugmentServiceClient(augment_service) if augment_service is not None else None
+
+        def word2vec_augment(action):
+            if embeddings_dir is None:
+                return naw.WordEmbsAug(model_type='word2vec', model_path='GoogleNews-vectors-negative300.bin',
+                                       action=action, aug_min=1, aug_max=1, top_k=10, )
+            # Exported once, workers mmap the vectors instead of each reading the .bin
+            path = os.path.join(embeddings_dir, "word2vec.kv")
+            if not os.path.exists(path):
+                export_keyed_vectors("word2vec", path)
+            return naw.WordEmbsAug(model_type='word2vec', model=MmapWordEmbs(MmapKeyedVectors(path), top_k=10),
+                                   action=action, aug_min=1, aug_max=1, top_k=10, )
         if not choice_probas.keys().isdisjoint(["glove_wiki", "glove_twitter", "word2vec", "fasttext", "word_cutout", "word_masking"]):
             assert idf_file is not None
             tfidf = pd.read_csv(idf_file)
             tfidf['token'] = tfidf['token'].apply(lambda x: x.lower() if isinstance(x, str) else x)
             self.idfs = dict(zip(tfidf.to_dict()['token'].values(), tfidf.to_dict()['idf'].values()))
             self.max_idf_score = tfidf.idf.max()
+            # Integer ids into a flat idf array for augment_batch, numbers and OOV words (last slot) score max idf as in idf_proba
+            self.idf_vocab = {w: i for i, w in enumerate(self.idfs.keys())}
+            self.idf_array = np.array([self.max_idf_score if isnumber(w) else v for w, v in self.idfs.items()] + [self.max_idf_score], dtype=np.float64)
             tfidf = tfidf[tfidf["idf"] < tfidf["idf"].max()]
             tfidf["kw"] = np.log1p(tfidf["frequency"] * tfidf["idf"])
             max_kw = tfidf["kw"].max()
@@ -609,6 +637,20 @@ class TextAugment:
                     dab_store[int(d[0])].append(d[1])
                 self.dab_store = dab_store
 
+            if k in neighbour_tables:
+                # Precomputed with neighbour_table.py, embedding model and annoy index are not loaded
+                assert k in ["fasttext", "glove_twitter", "glove_wiki", "word2vec"]
+                self.augments[k] = NeighbourTable(neighbour_tables[k])
+                self.indexes[k] = None
+                continue
+            if embeddings_dir is not None and k in ["fasttext", "glove_twitter", "glove_wiki", "word2vec"]:
+                # Exported once, then mmapped read-only by whichever process first uses it
+                path = os.path.join(embeddings_dir, "%s.kv" % k)
+                if not os.path.exists(path):
+                    export_keyed_vectors(k, path, fasttext_file)
+                self.augments[k] = MmapKeyedVectors(path)
+                self.indexes[k] = None
+                continue
             if k == "fasttext":
                 assert fasttext_file is not None
                 self.augments["fasttext"] = load_facebook_model(fasttext_file)
@@ -650,6 +692,10 @@ class TextAugment:
                                                                  aug_word_max=3, include_numeric=False,
                                                                  include_upper_case=False)
 
+            if k in ["word_insert", "word_substitute"] and service_client is not None:
+                # DistilBERT runs once, in the augment service, on micro-batches from all workers
+                self.augments[k] = ServiceAugment(service_client, k.split("_")[1])
+                continue
             if k == "word_insert":
                 self.augments["word_insert"] = naw.ContextualWordEmbsAug(model_path='distilbert-base-uncased',
                                                                          action='insert', temperature=0.5, top_k=20,
@@ -660,13 +706,9 @@ class TextAugment:
                                                                              top_k=20, aug_min=1, aug_max=1,
                                                                              optimize=True)
             if k == "w2v_insert":
-                self.augments["w2v_insert"] = naw.WordEmbsAug(model_type='word2vec',
-                                                              model_path='GoogleNews-vectors-negative300.bin',
-                                                              action="insert", aug_min=1, aug_max=1, top_k=10, )
+                self.augments["w2v_insert"] = word2vec_augment("insert")
             if k == "w2v_substitute":
-                self.augments["w2v_substitute"] = naw.WordEmbsAug(model_type='word2vec',
-                                                                  model_path='GoogleNews-vectors-negative300.bin',
-                                                                  action="substitute", aug_min=1, aug_max=1, top_k=10, )
+                self.augments["w2v_substitute"] = word2vec_augment("substitute")
 
         choices_arr = np.array([choice_probas[c] if c in choice_probas else 0.0 for c in self.augs])
         self.choice_probas = choices_arr / np.linalg.norm(choices_arr, ord=1)
@@ -713,6 +755,141 @@ class TextAugment:
         words = words[:cut_idx[0]] + ([mask_token] * len(tkz.tokenize(words[cut_idx[0]]))) + words[cut_idx[0] + 1:cut_idx[1]] + ([mask_token] * len(tkz.tokenize(words[cut_idx[1]]))) + words[cut_idx[1] + 1:]
         return " ".join(words)
 
+    def batch_idf_proba(self, tokenized: List[List[str]]):
+        """Vectorized idf_proba over a batch, returns flat word scores and segment offsets into them."""
+        lengths = np.array([len(t) for t in tokenized])
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        oov = len(self.idf_array) - 1
+        ids = np.fromiter((self.idf_vocab.get(w.lower(), oov) for t in tokenized for w in t), dtype=np.int64, count=lengths.sum())
+        idf = self.idf_array[ids]
+        seg_max = np.maximum.reduceat(idf, offsets)
+        max_minus_score = np.repeat(seg_max, lengths) - idf
+        z = np.add.reduceat(max_minus_score, offsets) / lengths
+        z_words = np.repeat(z, lengths)
+        uniform = np.repeat(1 / lengths, lengths)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = np.where(z_words == 0, uniform, np.minimum(0.6 * max_minus_score / z_words, 1))
+        return scores, offsets, lengths
+
+    @staticmethod
+    def sample_positions(weights, offsets, lengths, k=1):
+        """One weighted draw (with replacement) of `k` positions per segment, inverse cdf over the flat cumulative sum."""
+        cs = np.cumsum(weights)
+        starts = np.concatenate([[0.0], cs])[offsets]
+        totals = np.add.reduceat(weights, offsets)
+        targets = starts[:, None] + np.random.random((len(offsets), k)) * totals[:, None]
+        idx = np.searchsorted(cs, targets, side="right")
+        idx = np.clip(idx, offsets[:, None], (offsets + lengths - 1)[:, None])
+        return idx - offsets[:, None]
+
+    def keyed_vectors(self, aug):
+        if aug not in ["fasttext", "glove_twitter", "glove_wiki", "word2vec"]:
+            return None
+        tm = self.augments[aug]
+        return tm.wv if hasattr(tm, "wv") else tm
+
+    def augment_batch(self, texts: List[str], identifiers: List = None):
+        """
+        Batched `__call__`: per text the augmentation count, choices and idf weighted word draws follow `__call__`, but the idf
+        based word choices of a whole batch are scored and sampled with a few numpy ops per augmentation round instead of per-word
+        python loops. Used by TextAugmentCollate.
+        """
+        texts = [str(t) for t in texts]
+        originals = list(texts)
+        B = len(texts)
+        if B == 0:
+            return texts
+        counts = np.random.choice(len(self.count_proba), B, p=self.count_proba)
+        # Gumbel top-k, same distribution as np.random.choice(self.augs, count, replace=False, p=self.choice_probas) per text
+        with np.errstate(divide="ignore"):
+            keys = np.log(self.choice_probas)[None, :] + np.random.gumbel(size=(B, len(self.augs)))
+        order = np.argsort(-keys, axis=1)
+        done = np.zeros(B, dtype=bool)
+        idf_augs = {"word_cutout", "word_masking", "fasttext", "glove_twitter", "glove_wiki", "word2vec"}
+        for r in range(counts.max()):
+            active = [i for i in range(B) if counts[i] > r and not done[i]]
+            for i in active:
+                if len(texts[i].split()) < 2 or len(texts[i]) < 5:
+                    texts[i] = originals[i]
+                    done[i] = True
+            active = [i for i in active if not done[i]]
+            augs = {i: self.augs[order[i, r]] for i in active}
+
+            # One tokenization and one vectorized draw for every text whose aug in this round is idf weighted
+            idf_rows = [i for i in active if augs[i] in idf_augs]
+            positions = dict()
+            if len(idf_rows) > 0:
+                tokenized = [texts[i].split() for i in idf_rows]
+                scores, offsets, lengths = self.batch_idf_proba(tokenized)
+                words = [w for t in tokenized for w in t]
+                length_weights = 1 / np.sqrt(np.fromiter((len(w) for w in words), dtype=np.float64, count=len(words)))
+                # word_cutout and word_masking draw one length weighted position, embedding replacement draws by idf alone and,
+                # like __w2v_replace__, retries up to 11 draws for an in-vocab word
+                length_positions = self.sample_positions(scores * length_weights, offsets, lengths, 1)
+                idf_positions = self.sample_positions(scores, offsets, lengths, 11)
+                for j, i in enumerate(idf_rows):
+                    positions[i] = (tokenized[j], length_positions[j][0], idf_positions[j])
+
+            # Service backed augs of the whole round are submitted together and resolved after the local ones
+            futures = dict()
+            for i in active:
+                aug = augs[i]
+                text = texts[i]
+                try:
+                    if isinstance(self.augments.get(aug), ServiceAugment):
+                        futures[i] = self.augments[aug].submit(text)
+                        continue
+                    if aug == "word_cutout":
+                        tokens, pos, _ = positions[i]
+                        if len(tokens) > 4:
+                            text = " ".join(tokens[:pos] + tokens[pos + 1:])
+                    elif aug == "word_masking":
+                        tokens, pos, _ = positions[i]
+                        if len(tokens) > 5:
+                            # word_masking draws a single position and masks it twice over, see cut_idx there
+                            tkz = self.tokenizer
+                            masks = [tkz.mask_token] * (2 * len(tkz.tokenize(tokens[pos])))
+                            text = " ".join(tokens[:pos] + masks + tokens[pos + 1:])
+                    elif aug in ["fasttext", "glove_twitter", "glove_wiki", "word2vec"]:
+                        tokens, _, draws = positions[i]
+                        tm = self.keyed_vectors(aug)
+                        # The full fasttext model has subword vectors for every word, __fasttext_replace__ keeps neighbours 1 to 4
+                        full_fasttext = aug == "fasttext" and not isinstance(self.augments[aug], (NeighbourTable, MmapKeyedVectors))
+                        lowered = [w.lower() for w in tokens]
+                        draws = draws[:1] if full_fasttext else [d for d in draws if lowered[d] in tm][:1]
+                        enough = len(tokens) > 3 if full_fasttext else len(set(tokens)) > 3
+                        if enough and len(draws) > 0:
+                            sampled = lowered[draws[0]]
+                            neighbours = [w for w, d in tm.most_similar(sampled, topn=10, indexer=self.indexes[aug])]
+                            candidates = neighbours[1:5] if full_fasttext else neighbours[1:]
+                            # Last occurrence of the word, as the t_2_i lookup does
+                            idx = len(lowered) - 1 - lowered[::-1].index(sampled)
+                            tokens = list(tokens)
+                            tokens[idx] = random.sample(candidates, 1)[0]
+                            text = " ".join(tokens)
+                    elif aug == "dab":
+                        identifier = int(identifiers[i])
+                        if len(self.dab_store[identifier]) > 0:
+                            text = random.sample(self.dab_store[identifier], 1)[0]
+                    elif callable(self.augments[aug]):
+                        text = self.augments[aug](text)
+                    elif hasattr(self.augments[aug], "augment"):
+                        text = self.augments[aug].augment(text)
+                    else:
+                        raise ValueError()
+                    texts[i] = text
+                except Exception as e:
+                    print("Exception for: ", aug, "|", "[Original Text]:", originals[i], "[Final Text]:", text, e)
+                    texts[i] = originals[i] if text is None or not isinstance(text, str) or len(text.split()) < 3 or len(text) < 8 else text
+                    done[i] = True
+            for i, future in futures.items():
+                try:
+                    texts[i] = future.result(self.augments[augs[i]].client.timeout)
+                except Exception as e:
+                    print("Exception for: ", augs[i], "|", "[Original Text]:", originals[i], "[Final Text]:", texts[i], e)
+                    done[i] = True
+        return texts
+
     def __fasttext_replace__(self, tm, indexer, text):
         tokens = text.split()
         t_2_i = {w: i for i, w in enumerate(tokens)}
@@ -758,7 +935,7 @@ class TextAugment:
             if len(text.split()) < 2 or len(text) < 5:
                 return original_text
             try:
-                if aug == "fasttext":
+                if aug == "fasttext" and not isinstance(self.augments[aug], (NeighbourTable, MmapKeyedVectors)):
                     text = self.__fasttext_replace__(self.augments[aug], self.indexes[aug], text)
                 elif aug == "word_cutout":
                     text = self.word_cutout(text)
@@ -768,7 +945,7 @@ class TextAugment:
                     identifier = int(kwargs["identifier"])
                     if len(self.dab_store[identifier]) > 0:
                         text = random.sample(self.dab_store[identifier], 1)[0]
-                elif aug in ["glove_twitter", "glove_wiki", "word2vec"]:
+                elif aug in ["fasttext", "glove_twitter", "glove_wiki", "word2vec"]:
                     text = self.__w2v_replace__(self.augments[aug], self.indexes[aug], text)
                 elif callable(self.augments[aug]):
                     text = self.augments[aug](text)
@@ -782,6 +959,24 @@ class TextAugment:
         return text
 
 
+class TextAugmentCollate:
+    """
+    collate_fn for the DataLoader, collates with `collate_fn` then augments the batch texts with TextAugment.augment_batch in
+    the worker. Used by train with set_global("batch_text_augment", True), the dataset then skips its per sample text_transform.
+    """
+    def __init__(self, text_augment: TextAugment, collate_fn=None):
+        self.text_augment = text_augment
+        self.collate_fn = collate_fn
+
+    def __call__(self, batch):
+        from ..utils import my_collate
+        sample_list = (self.collate_fn or my_collate)(batch)
+        ids = sample_list["id"] if "id" in sample_list else None
+        ids = ids.tolist() if isinstance(ids, torch.Tensor) else ids
+        sample_list["text"] = self.text_augment.augment_batch(sample_list["text"], ids)
+        return sample_list
+
+
 def get_image2torchvision_transforms():
     preprocess = transforms.Compose([
         transforms.Resize((224, 224)),
@@ -817,7 +1012,11 @@ def get_transforms_for_bbox_methods():
     return transforms_for_bbox_methods
 
 
-def get_image_transforms_pytorch(mode="easy"):
+def get_image_transforms_pytorch(mode="easy", array_pipeline=False, output_size=224):
+    """
+    With `array_pipeline` the image is converted to a uint8 array once, every op runs on the array and the result is the
+    normalised `output_size` tensor, so it can be used as `torchvision_pre_image_transform` without PIL round trips.
+    """
 
     def get_imgaug(aug):
         def augment(image):
@@ -829,6 +1028,10 @@ def get_image_transforms_pytorch(mode="easy"):
             return Image.fromarray(aug(image=np.array(image, dtype=np.uint8))['image'])
         return augment
 
+    if array_pipeline:
+        from . import array_augment as aa
+        get_imgaug, get_alb = aa.imgaug_op, aa.alb_op
+
     p = 0.1
     param1 = 0.05
     rotation = 15
@@ -880,11 +1083,44 @@ def get_image_transforms_pytorch(mode="easy"):
             img = cut(img)
         return img
 
-    preprocess = transforms.Compose([
-        transforms.RandomGrayscale(p=p),
-        transforms.RandomHorizontalFlip(p=p),
-        transforms.RandomPerspective(distortion_scale=distortion_scale, p=p),
-        transforms.ColorJitter(brightness=param1, contrast=param1, saturation=param1, hue=param1),
+    if array_pipeline:
+        cutout = aa.Cutout(cutout_proba, (0.05, cutout_size), max_count=cutout_max_count)
+        geometric = [
+            aa.RandomApply(aa.grayscale, p),
+            aa.RandomApply(aa.horizontal_flip, p),
+            aa.RandomApply(aa.Perspective(distortion_scale), p),
+            aa.ColorJitter(brightness=param1, contrast=param1, saturation=param1, hue=param1),
+        ]
+        rotations = [
+            aa.Affine(degrees=rotation),
+            aa.vertical_flip,
+            aa.rotate_90,
+            aa.Affine(translate=(affine_translate, affine_translate), scale=(1 - affine_zoom, 1 + affine_zoom), shear=25),
+            aa.ResizedCrop(640, scale=(0.6, 0.8)),
+            aa.ResizedCrop(360, scale=(0.4, 0.8)),
+        ]
+    else:
+        geometric = [
+            transforms.RandomGrayscale(p=p),
+            transforms.RandomHorizontalFlip(p=p),
+            transforms.RandomPerspective(distortion_scale=distortion_scale, p=p),
+            transforms.ColorJitter(brightness=param1, contrast=param1, saturation=param1, hue=param1),
+        ]
+        rotations = [
+            transforms.RandomRotation(rotation),
+            transforms.RandomVerticalFlip(p=1.0),
+            DefinedRotation(90),
+            transforms.RandomAffine(
+                0,
+                translate=(affine_translate, affine_translate),
+                scale=(1 - affine_zoom, 1 + affine_zoom),  # 0.6 -> Zoom out, 1.4 -> Zoom in
+                shear=25,
+            ),
+            transforms.RandomResizedCrop(640, scale=(0.6, 0.8)),  # Zoom in
+            transforms.RandomResizedCrop(360, scale=(0.4, 0.8)),
+        ]
+
+    ops = geometric + [
         transforms.RandomChoice([
             cutout,
             get_alb(alb.transforms.GridDropout(ratio=0.35+grid_ratio, holes_number_x=8, holes_number_y=8, random_offset=grid_random_offset, p=alb_dropout_proba)),
@@ -909,20 +1145,11 @@ def get_image_transforms_pytorch(mode="easy"):
              get_alb(alb.transforms.Solarize(threshold=128, always_apply=False, p=alb_proba)),
              get_alb(alb.transforms.GaussNoise(var_limit=(10.0, 50.0), mean=0, always_apply=False, p=alb_proba)),
         ]),
-        transforms.RandomChoice([
-            transforms.RandomRotation(rotation),
-            transforms.RandomVerticalFlip(p=1.0),
-            DefinedRotation(90),
-            transforms.RandomAffine(
-                0,
-                translate=(affine_translate, affine_translate),
-                scale=(1 - affine_zoom, 1 + affine_zoom),  # 0.6 -> Zoom out, 1.4 -> Zoom in
-                shear=25,
-            ),
-            transforms.RandomResizedCrop(640, scale=(0.6, 0.8)),  # Zoom in
-            transforms.RandomResizedCrop(360, scale=(0.4, 0.8)),
-        ]),
-    ] + color_augs)
+        transforms.RandomChoice(rotations),
+    ] + color_augs
+    if array_pipeline:
+        return transforms.Compose([aa.ToArray()] + ops + [aa.ArrayToTensor(output_size)])
+    preprocess = transforms.Compose(ops)
     return preprocess
 
 
@@ -1040,7 +1267,7 @@ def get_datasets(data_dir, train_text_transform=None, train_image_transform=None
                  train_mixup_config=None, test_mixup_config=None,
                  cache_images: bool = True, use_images: bool = True, dev: bool = False, test_dev: bool = True,
                  keep_original_text: bool = False, keep_original_image: bool = False,
-                 keep_processed_image: bool = False, keep_torchvision_image: bool = False):
+                 keep_processed_image: bool = False, keep_torchvision_image: bool = False, train_augmented_views: str = None):
     use_dev = dev
     from functools import partial
     joiner = partial(os.path.join, data_dir)
@@ -1090,7 +1317,7 @@ def get_datasets(data_dir, train_text_transform=None, train_image_transform=None
                             train_torchvision_pre_image_transform=train_torchvision_pre_image_transform,
                             test_torchvision_pre_image_transform=test_torchvision_pre_image_transform,
                             test_text_transform=test_text_transform, test_image_transform=test_image_transform,
-                            data_dir=data_dir))
+                            train_augmented_views=train_augmented_views, data_dir=data_dir))
     return rd
 
 
@@ -1166,6 +1393,7 @@ def create_collage(width, height, images, filled_position=None):
     new_im = Image.new('RGB', (width, height))
     ims = []
     for im in images:
+        im = im.copy()
         im.thumbnail(size)
         ims.append(im)
     i = 0
@@ -1187,11 +1415,12 @@ class TextImageDataset(Dataset):
     def __init__(self, identifiers: List, texts: List[str], image_locations: List[str], labels: torch.Tensor = None,
                  numbers: np.ndarray = None, embed1: np.ndarray = None, embed2: np.ndarray = None,
                  sample_weights: List[float] = None, cached_images: Dict = None,
-                 text_transform=None, image_transform=None, cache_images: bool = True, use_images: bool = True,
+                 text_transform=None, image_transform=None, cache_images: Union[bool, str] = True, use_images: bool = True,
                  torchvision_pre_image_transform=identity, numeric_regularizer: Callable = identity,
                  mixup_config=None,
                  keep_original_text: bool = False, keep_original_image: bool = False,
-                 keep_processed_image: bool = False, keep_torchvision_image: bool = False, additional_processors=tuple()):
+                 keep_processed_image: bool = False, keep_torchvision_image: bool = False, additional_processors=tuple(),
+                 augmented_views: str = None):
         self.texts = list(texts)
         self.identifiers = list(identifiers)
         self.image_locations = image_locations
@@ -1207,13 +1436,21 @@ class TextImageDataset(Dataset):
         self.numeric_regularizer = numeric_regularizer if numeric_regularizer is not None else identity
         from tqdm.auto import tqdm as tqdm
         self.images = dict()
+        self.image_store = None
         if use_images:
+            build_image_digest_index(image_locations)
             if cached_images is not None:
                 self.images = cached_images
+            elif cache_images == "mmap":
+                # Shared memory mapped store of decoded images instead of a per process dict of PIL images, filled on first access
+                from ..utils import get_global
+                self.image_store = DecodedImageStore(os.path.join(get_global("cache_dir"), "decoded_images"))
             elif cache_images:
-                self.images = {l: Image.open(l).convert('RGB') if not isNan(l) else Image.fromarray(np.zeros((224, 224, 3), dtype=np.uint8)) for l in tqdm(list(set(image_locations)), "Caching Images in Dataset")}
+                self.images = {l: tag_image_digest(Image.open(l).convert('RGB'), l) if not isNan(l) else Image.fromarray(np.zeros((224, 224, 3), dtype=np.uint8)) for l in tqdm(list(set(image_locations)), "Caching Images in Dataset")}
         self.labels = labels if labels is not None else ([0] * len(texts))
         self.text_transform = text_transform if text_transform is not None else return_first_arg
+        # Set by train when TextAugmentCollate augments the texts of whole batches
+        self.batch_text_transform = False
         self.image_transform = image_transform if image_transform is not None else identity
         self.use_images = use_images
         self.sample_weights = [1.0] * len(texts) if sample_weights is None else sample_weights
@@ -1226,6 +1463,9 @@ class TextImageDataset(Dataset):
         self.keep_torchvision_image = keep_torchvision_image
         self.mixup_config = mixup_config
         self.additional_processors = additional_processors
+        # Precomputed views from view_store.py replace text_transform, image_transform and torchvision_pre_image_transform
+        # for the samples they cover
+        self.view_store = AugmentedViewStore(augmented_views) if augmented_views is not None else None
 
     def item_getter(self, item):
         text = self.texts[item]
@@ -1233,6 +1473,11 @@ class TextImageDataset(Dataset):
         label = self.labels[item] if self.labels is not None else 0
         sample_weight = self.sample_weights[item]
         s = Sample({"id": identifier, "text": text, "label": label, "sample_weight": sample_weight, "image": None})
+        view_image = None
+        # Samples missing from the view store are augmented live in process_example
+        s.materialized = self.view_store is not None and identifier in self.view_store
+        if s.materialized:
+            s.text, view_image, _ = self.view_store.get(identifier)
         if hasattr(self, "numbers"):
             s.numbers = torch.tensor(self.numeric_regularizer(self.numbers[item]))
         if hasattr(self, "embed1"):
@@ -1242,9 +1487,18 @@ class TextImageDataset(Dataset):
 
         if self.use_images and (self.keep_torchvision_image or self.keep_original_image or self.keep_processed_image):
             l = self.image_locations[item]
-            image = self.images.get(l)
+            image = view_image
+            if image is None and self.keep_torchvision_image and not (self.keep_original_image or self.keep_processed_image) and self.torchvision_pre_image_transform is identity:
+                # Only the 224x224 torchvision view is needed, read it pre-resized instead of decoding the full image
+                pyramid = get_image_pyramid()
+                image = pyramid.load(l, 224) if pyramid is not None and not isNan(l) else None
+            image = self.images.get(l) if image is None else image
+            if image is None and self.image_store is not None:
+                image = self.image_store.get(l)
+                if image is not None:
+                    image = tag_image_digest(image, l)
             if image is None:
-                image = Image.open(l).convert('RGB') if not isNan(l) else Image.fromarray(np.zeros((224, 224, 3), dtype=np.uint8))
+                image = tag_image_digest(Image.open(l).convert('RGB'), l) if not isNan(l) else Image.fromarray(np.zeros((224, 224, 3), dtype=np.uint8))
             s.image = image
 
         return s
@@ -1253,17 +1507,23 @@ class TextImageDataset(Dataset):
         s = Sample(sample)
         # clean_text
         orig_text = s["text"]
-        text = self.text_transform(orig_text, identifier=s.id)  # Give ID here to retrieve DAB examples
+        materialized = s.pop("materialized", False)
+        text = orig_text if materialized or self.batch_text_transform else self.text_transform(orig_text, identifier=s.id)  # Give ID here to retrieve DAB examples
         s.text = text
         image = s["image"]
         if image is not None:
             if self.keep_original_image:
                 s.original_image = image
             if self.keep_torchvision_image:
-                torchvision_image = self.to_torchvision(self.torchvision_pre_image_transform(image))
+                torchvision_image = image if materialized else self.torchvision_pre_image_transform(image)
+                # Array pipelines (get_image_transforms_pytorch(array_pipeline=True)) already return the normalised tensor
+                torchvision_image = torchvision_image if isinstance(torchvision_image, torch.Tensor) else self.to_torchvision(torchvision_image)
                 s.torchvision_image = torchvision_image
             if self.keep_processed_image:
-                image = self.image_transform(image.copy())
+                image = image if materialized else self.image_transform(image.copy())
+                if self.image_transform is not identity and "PIL" in str(type(image)):
+                    # Transformed pixels no longer match the source file
+                    image.info.pop("content_digest", None)
                 s.image = image
             else:
                 del s['image']
@@ -1285,7 +1545,8 @@ class TextImageDataset(Dataset):
         text = " ".join([s.text for s in samples])
         label = min(sum([s.label for s in samples]), 1)
         sample_weight = sum([s.sample_weight for s in samples]) / len(samples)
-        sample = Sample({"id": -1, "text": text, "label": label, "sample_weight": sample_weight, "image": image})
+        sample = Sample({"id": -1, "text": text, "label": label, "sample_weight": sample_weight, "image": image,
+                         "materialized": all([s.materialized for s in samples])})
         if hasattr(self, "numbers"):
             sample.numbers = torch.stack([s.numbers for s in samples]).mean(0)
         if hasattr(self, "embed1"):
@@ -0,0 +1,120 @@
+from typing import List
+
+import numpy as np
+
+_annotator = None
+
+
+def _init_worker(capabilities, n_tokens_in, kwargs):
+    global _annotator
+    import torch
+    from ..utils import set_cpu_as_device
+    # One pipeline per process, parallelism comes from the pool
+    torch.set_num_threads(1)
+    set_cpu_as_device()
+    from ..models.text_models import LangFeaturesModel
+    _annotator = LangFeaturesModel(256, 2, 256, 0.0, 0.0, 256, 1, None, None, n_tokens_in=n_tokens_in, use_as_super=True,
+                                   capabilities=capabilities, annotation_worker=True, **kwargs)
+
+
+def row_ids(rows, head_rows):
+    """
+    head_rows[i, j] (always a row of the same doc's tensor) as an index into rows[i], or past the end into `extra` for
+    heads outside the first n_tokens_in tokens. Returns (ids of shape (B, L), extra of shape (n, D)).
+    """
+    B, L, D = head_rows.shape
+    ids = np.zeros((B, L), dtype=np.int64)
+    extra = []
+    for i in range(B):
+        same = (head_rows[i][:, None, :] == rows[i][None, :, :]).all(2)
+        ids[i] = same.argmax(1)
+        for j in np.where(~same.any(1))[0]:
+            ids[i, j] = L + len(extra)
+            extra.append(head_rows[i, j])
+    return ids, np.array(extra, dtype=head_rows.dtype).reshape(-1, D)
+
+
+def compact(annotations):
+    # Tag / dependency / entity ids fit int16, and spaCy head vectors go back as ids into text_tensors (see expand),
+    # which keeps what goes back through the pipe small. nltk_emb is not computed in workers, see LangFeaturesModel.annotate
+    result = dict()
+    for family, fields in annotations.items():
+        result[family] = dict()
+        for k, v in fields.items():
+            v = v.cpu().numpy() if hasattr(v, "cpu") else np.asarray(v)
+            if np.issubdtype(v.dtype, np.integer) and (v.size == 0 or (v.min() >= -32768 and v.max() <= 32767)):
+                v = v.astype(np.int16)
+            result[family][k] = v
+    spacy = result.get("spacy")
+    if spacy is not None and "head_tensors" in spacy:
+        ids, extra = row_ids(spacy["text_tensors"], spacy.pop("head_tensors"))
+        spacy["head_ids"] = ids.astype(np.int16) if ids.max(initial=0) <= 32767 else ids
+        spacy["head_extra"] = extra
+    return result
+
+
+def expand(part):
+    spacy = part.get("spacy")
+    if spacy is not None and "head_ids" in spacy:
+        rows = spacy["text_tensors"]
+        B, L, D = rows.shape
+        table = np.concatenate([rows.reshape(B * L, D), spacy.pop("head_extra")])
+        ids = spacy.pop("head_ids").astype(np.int64)
+        spacy["head_tensors"] = table[np.where(ids < L, np.arange(B)[:, None] * L + ids, B * L + ids - L)]
+    return part
+
+
+def _annotate_chunk(args):
+    texts, capabilities = args
+    return compact(_annotator.annotate(texts, capabilities))
+
+
+class AnnotationPool:
+    """
+    `n_workers` processes, each with its own LangFeaturesModel pipelines (spaCy, stanza, nltk ...), annotating chunks of
+    `chunk_size` texts. `annotate` returns the same dict as LangFeaturesModel.annotate, in input order, except nltk
+    "nltk_emb" which the model looks up itself.
+    The pool is started on first use and is not pickled.
+    """
+    def __init__(self, capabilities: List[str], n_tokens_in, n_workers=None, chunk_size=64, **kwargs):
+        import multiprocessing as mp
+        self.capabilities = capabilities
+        self.n_tokens_in = n_tokens_in
+        self.n_workers = n_workers if n_workers is not None else max(1, mp.cpu_count() - 1)
+        self.chunk_size = chunk_size
+        self.kwargs = kwargs
+        self.pool = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["pool"] = None
+        return state
+
+    def start(self):
+        if self.pool is None:
+            import multiprocessing as mp
+            self.pool = mp.get_context("spawn").Pool(self.n_workers, initializer=_init_worker,
+                                                     initargs=(self.capabilities, self.n_tokens_in, self.kwargs))
+        return self
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def annotate(self, texts: List[str], capabilities=None):
+        import torch
+        capabilities = self.capabilities if capabilities is None else capabilities
+        texts = list(texts)
+        if len(texts) == 0 or len(capabilities) == 0:
+            return dict()
+        self.start()
+        chunks = [(texts[i:i + self.chunk_size], capabilities) for i in range(0, len(texts), self.chunk_size)]
+        parts = [expand(p) for p in self.pool.imap(_annotate_chunk, chunks)]
+        result = dict()
+        for family in parts[0]:
+            result[family] = dict()
+            for k in parts[0][family]:
+                v = np.concatenate([p[family][k] for p in parts])
+                result[family][k] = torch.from_numpy(v.astype(np.int64) if np.issubdtype(v.dtype, np.integer) else v)
+        return result
@@ -0,0 +1,119 @@
+import argparse
+import hashlib
+import json
+import os
+from typing import List
+
+import numpy as np
+
+
+def text_key(text):
+    return hashlib.sha1(str(text).encode("utf-8")).hexdigest()
+
+
+def annotation_config(n_tokens_in, kwargs):
+    """LangFeaturesModel settings the stored annotations depend on, with the model's defaults."""
+    return dict(n_tokens_in=n_tokens_in,
+                fasttext_file=kwargs["fasttext_file"] if "fasttext_file" in kwargs else "wiki-news-300d-1M-subword.bin",
+                rake_dims=kwargs["rake_dims"] if "rake_dims" in kwargs else 32,
+                yake_dims=kwargs["yake_dims"] if "yake_dims" in kwargs else 32,
+                ibm_max_quantize=bool(kwargs["ibm_max_quantize"]) if "ibm_max_quantize" in kwargs else False)
+
+
+class AnnotationStore:
+    """
+    Columnar store of per text annotations, e.g. the raw LangFeaturesModel features before any learned layer.
+    `index.json` holds the text hashes (row order), `n_tokens_in`, the annotator `config` (see annotation_config) and the
+    dtype and shape of every "family/field";
+    each field is a memory mapped `<family>__<field>.bin` of shape (rows, *shape).
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "index.json")) as f:
+            index = json.load(f)
+        self.n_tokens_in = index["n_tokens_in"]
+        self.config = index["config"] if "config" in index else None
+        self.fields = {k: (v[0], tuple(v[1])) for k, v in index["fields"].items()}
+        self.families = sorted(set([k.split("/")[0] for k in self.fields]))
+        self.rows = {h: i for i, h in enumerate(index["hashes"])}
+        self.data = dict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["data"] = dict()
+        return state
+
+    def __len__(self):
+        return len(self.rows)
+
+    def column(self, name):
+        if name not in self.data:
+            dtype, shape = self.fields[name]
+            path = os.path.join(self.directory, "%s.bin" % name.replace("/", "__"))
+            self.data[name] = np.memmap(path, dtype=dtype, mode="r", shape=(len(self.rows),) + shape)
+        return self.data[name]
+
+    def lookup(self, texts: List[str]):
+        """Row per text, -1 if the text is not in the store."""
+        return np.array([self.rows.get(text_key(t), -1) for t in texts], dtype=np.int64)
+
+    def get(self, family, rows):
+        """Dict of field -> numpy array (len(rows), *shape) for one family."""
+        names = [k for k in self.fields if k.split("/")[0] == family]
+        return {name.split("/")[1]: np.array(self.column(name)[rows]) for name in names}
+
+
+def write_annotation_store(directory, texts: List[str], annotate, n_tokens_in, batch_size=256, config=None):
+    """
+    `annotate(texts)` -> Dict[family, Dict[field, tensor or array of shape (len(texts), ...)]].
+    `config` is the annotation_config of the annotator, checked by LangFeaturesModel when the store is used.
+    Each unique text is annotated once, fields are written row by row into preallocated memmaps.
+    """
+    from tqdm.auto import tqdm
+    os.makedirs(directory, exist_ok=True)
+    texts = list(dict.fromkeys([str(t) for t in texts]))
+    columns = dict()
+    fields = dict()
+    for start in tqdm(range(0, len(texts), batch_size), "Annotating %s texts" % len(texts)):
+        batch = texts[start:start + batch_size]
+        for family, values in annotate(batch).items():
+            for field, v in values.items():
+                v = v.cpu().numpy() if hasattr(v, "cpu") else np.asarray(v)
+                name = "%s/%s" % (family, field)
+                if name not in columns:
+                    fields[name] = [str(v.dtype), list(v.shape[1:])]
+                    path = os.path.join(directory, "%s.bin" % name.replace("/", "__"))
+                    columns[name] = np.memmap(path, dtype=v.dtype, mode="w+", shape=(len(texts),) + v.shape[1:])
+                columns[name][start:start + len(batch)] = v
+    for c in columns.values():
+        c.flush()
+    tmp = os.path.join(directory, "index.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(dict(n_tokens_in=n_tokens_in, config=config, fields=fields, hashes=[text_key(t) for t in texts]), f)
+    os.replace(tmp, os.path.join(directory, "index.json"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Annotate every unique text once for LangFeaturesModel(annotation_store=out_dir)")
+    parser.add_argument("--data_dir", required=True)
+    parser.add_argument("--out_dir", required=True)
+    parser.add_argument("--capabilities", nargs="+", default=["spacy", "key_phrases", "nltk", "snlp", "full_view", "ibm_max", "tmoji"])
+    parser.add_argument("--n_tokens_in", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--fasttext_file", default="wiki-news-300d-1M-subword.bin")
+    parser.add_argument("--workers", type=int, default=0, help="Annotate with an AnnotationPool of this many processes")
+    parser.add_argument("--rake_dims", type=int, default=32)
+    parser.add_argument("--yake_dims", type=int, default=32)
+    parser.add_argument("--ibm_max_quantize", action="store_true")
+    a = parser.parse_args()
+    import pandas as pd
+    from . import get_datasets
+    from ..models.text_models import LangFeaturesModel
+    data = get_datasets(a.data_dir, cache_images=False)
+    texts = pd.concat([data[k]["text"] for k in ["train", "dev", "test", "dev_unseen", "test_unseen"] if data.get(k) is not None]).tolist()
+    annotator_kwargs = dict(fasttext_file=a.fasttext_file, rake_dims=a.rake_dims, yake_dims=a.yake_dims, ibm_max_quantize=a.ibm_max_quantize)
+    annotator = LangFeaturesModel(256, 2, 256, 0.0, 0.0, 256, 1, None, None, n_tokens_in=a.n_tokens_in, use_as_super=True,
+                                  capabilities=a.capabilities, annotation_workers=a.workers, **annotator_kwargs)
+    # Large batches keep every pool worker busy
+    write_annotation_store(a.out_dir, texts, annotator.annotate, a.n_tokens_in, a.batch_size * max(1, a.workers),
+                           annotation_config(a.n_tokens_in, annotator_kwargs))
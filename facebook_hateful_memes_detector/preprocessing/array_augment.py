@@ -0,0 +1,182 @@
+import random
+
+import numpy as np
+import torch
+
+# Array space versions of the get_image_transforms_pytorch ops. Every op takes and returns an HWC uint8 numpy array,
+# the image is converted from PIL once at the start and to a normalised CHW tensor once at the end.
+
+
+class ToArray:
+    def __call__(self, image):
+        if isinstance(image, np.ndarray):
+            return image
+        return np.array(image.convert('RGB'), dtype=np.uint8)
+
+
+class ArrayToTensor:
+    """Replaces Resize + ToTensor + Normalize of get_image2torchvision_transforms."""
+    def __init__(self, size=224, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        self.size = size
+        self.scale = (1.0 / (255.0 * np.array(std))).astype(np.float32)
+        self.shift = (np.array(mean) / np.array(std)).astype(np.float32)
+
+    def __call__(self, arr):
+        import cv2
+        if self.size is not None:
+            arr = cv2.resize(arr, (self.size, self.size), interpolation=cv2.INTER_LINEAR)
+        arr = arr.astype(np.float32) * self.scale - self.shift
+        return torch.from_numpy(np.ascontiguousarray(arr.transpose(2, 0, 1)))
+
+
+class RandomApply:
+    def __init__(self, op, p):
+        self.op = op
+        self.p = p
+
+    def __call__(self, arr):
+        return self.op(arr) if random.random() < self.p else arr
+
+
+def grayscale(arr):
+    gray = (arr[..., 0] * 0.299 + arr[..., 1] * 0.587 + arr[..., 2] * 0.114).astype(np.uint8)
+    return np.repeat(gray[..., None], 3, axis=2)
+
+
+def horizontal_flip(arr):
+    return np.ascontiguousarray(arr[:, ::-1])
+
+
+def vertical_flip(arr):
+    return np.ascontiguousarray(arr[::-1])
+
+
+class Perspective:
+    def __init__(self, distortion_scale):
+        self.distortion_scale = distortion_scale
+
+    def __call__(self, arr):
+        import cv2
+        h, w = arr.shape[:2]
+        dh, dw = int(self.distortion_scale * h / 2), int(self.distortion_scale * w / 2)
+        start = np.float32([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]])
+        jitter = np.float32([[random.randint(0, dw), random.randint(0, dh)], [-random.randint(0, dw), random.randint(0, dh)],
+                             [-random.randint(0, dw), -random.randint(0, dh)], [random.randint(0, dw), -random.randint(0, dh)]])
+        matrix = cv2.getPerspectiveTransform(start, start + jitter)
+        return cv2.warpPerspective(arr, matrix, (w, h), flags=cv2.INTER_LINEAR, borderValue=0)
+
+
+class ColorJitter:
+    """Brightness, contrast, saturation and hue factors drawn like transforms.ColorJitter and applied in random order."""
+    def __init__(self, brightness=0, contrast=0, saturation=0, hue=0):
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+
+    def __call__(self, arr):
+        import cv2
+        ops = []
+        if self.brightness > 0:
+            f = random.uniform(1 - self.brightness, 1 + self.brightness)
+            ops.append(lambda a, f=f: a * f)
+        if self.contrast > 0:
+            f = random.uniform(1 - self.contrast, 1 + self.contrast)
+            ops.append(lambda a, f=f: a * f + (1 - f) * grayscale(np.clip(a, 0, 255).astype(np.uint8))[..., 0].mean())
+        if self.saturation > 0:
+            f = random.uniform(1 - self.saturation, 1 + self.saturation)
+            ops.append(lambda a, f=f: a * f + (1 - f) * grayscale(np.clip(a, 0, 255).astype(np.uint8)))
+        if self.hue > 0:
+            shift = int(random.uniform(-self.hue, self.hue) * 180)
+
+            def hue(a):
+                hsv = cv2.cvtColor(np.clip(a, 0, 255).astype(np.uint8), cv2.COLOR_RGB2HSV)
+                hsv[..., 0] = (hsv[..., 0].astype(np.int32) + shift) % 180
+                return cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB).astype(np.float32)
+            ops.append(hue)
+        random.shuffle(ops)
+        out = arr.astype(np.float32)
+        for op in ops:
+            out = op(out)
+        return np.clip(out, 0, 255).astype(np.uint8)
+
+
+class Cutout:
+    """1 to `max_count` random erasings with random values, as the ToTensor -> RandomErasing -> ToPILImage cutout."""
+    def __init__(self, p, scale, ratio=(0.3, 3.3), max_count=1):
+        self.p = p
+        self.scale = scale
+        self.ratio = ratio
+        self.max_count = max_count
+
+    def __call__(self, arr):
+        arr = arr.copy()
+        h, w = arr.shape[:2]
+        for _ in range(random.randint(1, self.max_count)):
+            if random.random() >= self.p:
+                continue
+            for _ in range(10):
+                area = random.uniform(*self.scale) * h * w
+                ratio = np.exp(random.uniform(np.log(self.ratio[0]), np.log(self.ratio[1])))
+                eh, ew = int(round(np.sqrt(area * ratio))), int(round(np.sqrt(area / ratio)))
+                if eh < h and ew < w:
+                    y, x = random.randint(0, h - eh), random.randint(0, w - ew)
+                    arr[y:y + eh, x:x + ew] = np.random.randint(0, 256, (eh, ew, arr.shape[2]), dtype=np.uint8)
+                    break
+        return arr
+
+
+class Affine:
+    def __init__(self, degrees=0, translate=(0, 0), scale=(1, 1), shear=0):
+        self.degrees = degrees
+        self.translate = translate
+        self.scale = scale
+        self.shear = shear
+
+    def __call__(self, arr):
+        import cv2
+        h, w = arr.shape[:2]
+        matrix = cv2.getRotationMatrix2D((w / 2, h / 2), random.uniform(-self.degrees, self.degrees), random.uniform(*self.scale))
+        shear = np.tan(np.radians(random.uniform(-self.shear, self.shear)))
+        matrix = matrix @ np.array([[1, shear, -shear * h / 2], [0, 1, 0], [0, 0, 1]])
+        matrix[0, 2] += random.uniform(-self.translate[0], self.translate[0]) * w
+        matrix[1, 2] += random.uniform(-self.translate[1], self.translate[1]) * h
+        return cv2.warpAffine(arr, matrix, (w, h), flags=cv2.INTER_LINEAR, borderValue=0)
+
+
+def rotate_90(arr):
+    # DefinedRotation(90): +90 or -90 degrees
+    return np.ascontiguousarray(np.rot90(arr, random.choice([1, -1])))
+
+
+class ResizedCrop:
+    def __init__(self, size, scale, ratio=(3 / 4, 4 / 3)):
+        self.size = size
+        self.scale = scale
+        self.ratio = ratio
+
+    def __call__(self, arr):
+        import cv2
+        h, w = arr.shape[:2]
+        # Same sampling as transforms.RandomResizedCrop.get_params, centre crop fallback
+        i, j, ch, cw = (h - min(h, w)) // 2, (w - min(h, w)) // 2, min(h, w), min(h, w)
+        for _ in range(10):
+            area = random.uniform(*self.scale) * h * w
+            ratio = np.exp(random.uniform(np.log(self.ratio[0]), np.log(self.ratio[1])))
+            tw, th = int(round(np.sqrt(area * ratio))), int(round(np.sqrt(area / ratio)))
+            if 0 < tw <= w and 0 < th <= h:
+                i, j, ch, cw = random.randint(0, h - th), random.randint(0, w - tw), th, tw
+                break
+        return cv2.resize(arr[i:i + ch, j:j + cw], (self.size, self.size), interpolation=cv2.INTER_LINEAR)
+
+
+def alb_op(aug):
+    def augment(arr):
+        return aug(image=arr)['image']
+    return augment
+
+
+def imgaug_op(aug):
+    def augment(arr):
+        return aug(image=arr)
+    return augment
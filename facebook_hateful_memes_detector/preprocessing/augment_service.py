@@ -0,0 +1,281 @@
+import argparse
+import itertools
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import Listener, Client
+
+AUTHKEY_ENV = "AUGMENT_SERVICE_AUTHKEY"
+
+
+def get_authkey(authkey=None):
+    """`authkey` or the AUGMENT_SERVICE_AUTHKEY environment variable. Connections exchange pickles, so there is no default key."""
+    authkey = authkey if authkey is not None else os.environ.get(AUTHKEY_ENV)
+    if authkey is None:
+        raise ValueError("Augment service needs an authkey, pass one or set %s" % AUTHKEY_ENV)
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+def new_authkey():
+    return os.urandom(32).hex()
+
+
+class ContextualWordAugmenter:
+    """Masked LM word insert / substitute for a whole batch of texts in one forward pass."""
+    def __init__(self, model_path="distilbert-base-uncased", device="cpu", temperature=0.5, top_k=20, max_length=128):
+        import torch
+        from transformers import AutoTokenizer, AutoModelWithLMHead
+        self.device = torch.device(device)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        self.model = AutoModelWithLMHead.from_pretrained(model_path).to(self.device).eval()
+        self.temperature = temperature
+        self.top_k = top_k
+        self.max_length = max_length
+        vocab = self.tokenizer.convert_ids_to_tokens(list(range(self.tokenizer.vocab_size)))
+        # Whole word, non special tokens only
+        self.invalid = torch.tensor([t.startswith("##") or t in self.tokenizer.all_special_tokens or not t.isalpha() for t in vocab],
+                                    device=self.device)
+
+    def __call__(self, requests):
+        import torch
+        tkz = self.tokenizer
+        outputs = []
+        masked = []
+        for action, text in requests:
+            words = text.split()
+            if action == "insert":
+                idx = random.randint(0, len(words))
+                words = words[:idx] + [tkz.mask_token] + words[idx:]
+            else:
+                idx = random.randint(0, len(words) - 1)
+                words = words[:idx] + [tkz.mask_token] + words[idx + 1:]
+            masked.append(words)
+        enc = tkz.batch_encode_plus([" ".join(w) for w in masked], max_length=self.max_length, pad_to_max_length=True, return_tensors="pt")
+        input_ids = enc["input_ids"].to(self.device)
+        with torch.no_grad():
+            logits = self.model(input_ids, attention_mask=enc["attention_mask"].to(self.device))[0]
+        rows, cols = (input_ids == tkz.mask_token_id).nonzero(as_tuple=True)
+        first = dict()
+        for r, c in zip(rows.tolist(), cols.tolist()):
+            first.setdefault(r, c)
+        selected = list(first.keys())
+        replacement = dict()
+        if len(selected) > 0:
+            scores = logits[selected, [first[r] for r in selected]].float() / self.temperature
+            scores = scores.masked_fill(self.invalid[None, :scores.size(1)], -float("inf"))
+            top, top_ids = scores.topk(self.top_k, dim=-1)
+            choice = torch.multinomial(torch.softmax(top, dim=-1), 1).squeeze(-1)
+            tokens = tkz.convert_ids_to_tokens(top_ids.gather(1, choice.unsqueeze(-1)).squeeze(-1).tolist())
+            replacement = dict(zip(selected, tokens))
+        for i, ((action, text), words) in enumerate(zip(requests, masked)):
+            # Mask truncated away, text is returned unchanged
+            outputs.append(" ".join([replacement[i] if w == tkz.mask_token else w for w in words]) if i in replacement else text)
+        return outputs
+
+
+def serve(address, model_path="distilbert-base-uncased", device="cpu", max_batch=64, max_wait_ms=5, authkey=None):
+    """One model for all clients, requests from every connection are grouped into micro-batches of up to `max_batch`."""
+    authkey = get_authkey(authkey)
+    augmenter = ContextualWordAugmenter(model_path, device)
+    pending = queue.Queue()
+    listener = Listener(tuple(address), authkey=authkey)
+
+    def reader(conn, lock):
+        while True:
+            try:
+                req_id, action, text = conn.recv()
+            except (EOFError, OSError):
+                return
+            pending.put((conn, lock, req_id, action, text))
+
+    def acceptor():
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                # e.g. a peer without the authkey
+                print("Augment service rejected a connection:", e)
+                continue
+            threading.Thread(target=reader, args=(conn, threading.Lock()), daemon=True).start()
+
+    threading.Thread(target=acceptor, daemon=True).start()
+    print("Augment service on %s:%s, model = %s, device = %s" % (address[0], address[1], model_path, device))
+    while True:
+        batch = [pending.get()]
+        deadline = time.time() + max_wait_ms / 1000
+        while len(batch) < max_batch:
+            try:
+                batch.append(pending.get(timeout=max(0, deadline - time.time())))
+            except queue.Empty:
+                break
+        try:
+            results = augmenter([(action, text) for _, _, _, action, text in batch])
+        except Exception as e:
+            print("Augment service batch failed:", e)
+            results = [text for _, _, _, _, text in batch]
+        for (conn, lock, req_id, _, _), result in zip(batch, results):
+            try:
+                with lock:
+                    conn.send((req_id, result))
+            except (EOFError, OSError):
+                pass
+
+
+def start_augment_service(address=("localhost", 6100), model_path="distilbert-base-uncased", device="cpu", max_batch=64, max_wait_ms=5,
+                          authkey=None):
+    """
+    Starts the service in a child process. Without `authkey` (or AUGMENT_SERVICE_AUTHKEY) a key is generated for this run and
+    exported in the environment, so clients created here and in DataLoader workers use it.
+    """
+    import multiprocessing as mp
+    if authkey is None:
+        authkey = os.environ.get(AUTHKEY_ENV) or new_authkey()
+    os.environ[AUTHKEY_ENV] = authkey.decode() if isinstance(authkey, bytes) else authkey
+    process = mp.get_context("spawn").Process(target=serve, args=(address, model_path, device, max_batch, max_wait_ms, authkey), daemon=True)
+    process.start()
+    return process
+
+
+class AugmentServiceClient:
+    """
+    Future based client, safe to pickle into DataLoader workers. Each process opens its own connection on first use
+    and a reader thread resolves futures as results come back. A dropped connection fails its pending futures and the
+    next `submit` reconnects. `authkey` defaults to AUGMENT_SERVICE_AUTHKEY, read when connecting.
+    """
+    def __init__(self, address=("localhost", 6100), timeout=30, authkey=None):
+        self.address = tuple(address)
+        self.timeout = timeout
+        self.authkey = authkey
+        self.lock = threading.Lock()
+        self.__reset__()
+
+    def __reset__(self):
+        self.pid = None
+        self.conn = None
+        self.futures = dict()
+        self.ids = itertools.count()
+
+    def __getstate__(self):
+        return dict(address=self.address, timeout=self.timeout, authkey=self.authkey)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.__reset__()
+
+    def __connect__(self):
+        # Called with self.lock held
+        if self.pid != os.getpid():
+            # Connection and futures inherited from a parent process are not ours
+            self.__reset__()
+        if self.conn is None:
+            self.conn = Client(self.address, authkey=get_authkey(self.authkey))
+            self.pid = os.getpid()
+            threading.Thread(target=self.__read__, args=(self.conn,), daemon=True).start()
+        return self.conn
+
+    def __drop__(self, conn):
+        # Called with self.lock held, fails every request still waiting on `conn`
+        if self.conn is conn:
+            self.conn = None
+            futures, self.futures = self.futures, dict()
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Augment service connection to %s:%s dropped" % self.address))
+        try:
+            conn.close()
+        except OSError:
+            pass
+
+    def __read__(self, conn):
+        while True:
+            try:
+                req_id, result = conn.recv()
+            except (EOFError, OSError):
+                with self.lock:
+                    self.__drop__(conn)
+                return
+            future = self.futures.pop(req_id, None)
+            if future is not None:
+                future.set_result(result)
+
+    def submit(self, action, text) -> Future:
+        future = Future()
+        with self.lock:
+            for attempt in range(2):
+                conn = self.__connect__()
+                req_id = next(self.ids)
+                self.futures[req_id] = future
+                try:
+                    conn.send((req_id, action, text))
+                    break
+                except (EOFError, OSError):
+                    self.futures.pop(req_id, None)
+                    self.__drop__(conn)
+                    if attempt == 1:
+                        raise
+        return future
+
+    def map(self, action, texts):
+        return [f.result(self.timeout) for f in [self.submit(action, t) for t in texts]]
+
+
+class ServiceAugment:
+    """nlpaug style `augment` for TextAugment, backed by the shared augment service."""
+    def __init__(self, client: AugmentServiceClient, action):
+        assert action in ["insert", "substitute"]
+        self.client = client
+        self.action = action
+
+    def submit(self, text) -> Future:
+        return self.client.submit(self.action, text)
+
+    def augment(self, text):
+        return self.submit(text).result(self.client.timeout)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batched contextual word insert/substitute service, use with TextAugment(augment_service=(host, port))")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6100)
+    parser.add_argument("--model", default="distilbert-base-uncased")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--max_batch", type=int, default=64)
+    parser.add_argument("--max_wait_ms", type=float, default=5)
+    parser.add_argument("--benchmark", type=int, default=0, help="Send this many requests from a local client and report latency")
+    parser.add_argument("--authkey", default=None, help="Shared secret for clients, default %s or a key generated for this run" % AUTHKEY_ENV)
+    a = parser.parse_args()
+    authkey = a.authkey or os.environ.get(AUTHKEY_ENV)
+    if authkey is None:
+        authkey = new_authkey()
+        print("Generated augment service authkey, export %s=%s for clients" % (AUTHKEY_ENV, authkey))
+    os.environ[AUTHKEY_ENV] = authkey
+    if a.benchmark > 0:
+        import numpy as np
+        p = start_augment_service((a.host, a.port), a.model, a.device, a.max_batch, a.max_wait_ms, authkey)
+        client = AugmentServiceClient((a.host, a.port), timeout=300)
+        for _ in range(100):
+            try:
+                client.map("insert", ["warm up request"])
+                break
+            except (ConnectionRefusedError, OSError):
+                time.sleep(1)
+        texts = ["this meme is about %s people doing things on the internet" % i for i in range(a.benchmark)]
+        ts = time.perf_counter()
+        latencies = []
+        futures = []
+        for t in texts:
+            f = client.submit(random.choice(["insert", "substitute"]), t)
+            f.add_done_callback(lambda _, start=time.perf_counter(): latencies.append(time.perf_counter() - start))
+            futures.append(f)
+        for f in futures:
+            f.result(300)
+        total = time.perf_counter() - ts
+        latencies = np.array(latencies) * 1000
+        print("texts/sec = %.1f" % (len(texts) / total), "p50 = %.1f ms" % np.percentile(latencies, 50), "p99 = %.1f ms" % np.percentile(latencies, 99))
+        p.terminate()
+    else:
+        serve((a.host, a.port), a.model, a.device, a.max_batch, a.max_wait_ms, authkey)
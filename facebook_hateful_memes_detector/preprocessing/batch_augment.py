@@ -0,0 +1,215 @@
+import math
+import random
+
+import torch
+import torch.nn.functional as F
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+class BatchImageAugment:
+    """
+    Flip, grayscale, colour jitter, affine and cutout on a collated (B, 3, H, W) normalised image batch.
+    Every sample gets its own random parameters, each op is one vectorised call over the batch, so it can run on the GPU
+    after collation instead of per sample in PIL inside the DataLoader workers.
+    """
+    def __init__(self, p=0.25, hflip=0.5, grayscale=0.1, brightness=0.15, contrast=0.15, saturation=0.15, hue=0.05,
+                 rotation=15, translate=0.1, scale=(0.8, 1.2), shear=10, cutout_p=0.5, cutout_count=3, cutout_size=(0.05, 0.25),
+                 mean=IMAGENET_MEAN, std=IMAGENET_STD):
+        self.p = p
+        self.hflip = hflip
+        self.grayscale = grayscale
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+        self.rotation = rotation
+        self.translate = translate
+        self.scale = scale
+        self.shear = shear
+        self.cutout_p = cutout_p
+        self.cutout_count = cutout_count
+        self.cutout_size = cutout_size
+        self.mean = mean
+        self.std = std
+
+    @staticmethod
+    def uniform(B, low, high, device):
+        return torch.empty(B, device=device).uniform_(low, high)
+
+    @staticmethod
+    def chance(B, p, device):
+        return torch.rand(B, device=device) < p
+
+    @staticmethod
+    def gray(x):
+        return (0.299 * x[:, 0:1] + 0.587 * x[:, 1:2] + 0.114 * x[:, 2:3])
+
+    def colour(self, x):
+        B, device = x.size(0), x.device
+        view = (B, 1, 1, 1)
+        x = x * self.uniform(B, 1 - self.brightness, 1 + self.brightness, device).view(view)
+        c = self.uniform(B, 1 - self.contrast, 1 + self.contrast, device).view(view)
+        x = (x - self.gray(x).mean(dim=(2, 3), keepdim=True)) * c + self.gray(x).mean(dim=(2, 3), keepdim=True)
+        s = self.uniform(B, 1 - self.saturation, 1 + self.saturation, device).view(view)
+        x = (x - self.gray(x)) * s + self.gray(x)
+        if self.hue > 0:
+            # Hue rotation in YIQ space, one 3x3 colour matrix per sample
+            theta = self.uniform(B, -self.hue, self.hue, device) * 2 * math.pi
+            to_yiq = torch.tensor([[0.299, 0.587, 0.114], [0.596, -0.274, -0.322], [0.211, -0.523, 0.312]], device=device, dtype=x.dtype)
+            rot = torch.zeros(B, 3, 3, device=device, dtype=x.dtype)
+            rot[:, 0, 0] = 1
+            rot[:, 1, 1], rot[:, 1, 2] = torch.cos(theta), -torch.sin(theta)
+            rot[:, 2, 1], rot[:, 2, 2] = torch.sin(theta), torch.cos(theta)
+            m = torch.inverse(to_yiq) @ rot @ to_yiq
+            x = torch.einsum("bij,bjhw->bihw", m, x)
+        return x.clamp(0, 1)
+
+    def affine(self, x):
+        B, device = x.size(0), x.device
+        angle = self.uniform(B, -self.rotation, self.rotation, device) * math.pi / 180
+        shear = self.uniform(B, -self.shear, self.shear, device) * math.pi / 180
+        scale = self.uniform(B, self.scale[0], self.scale[1], device)
+        cos, sin, tan = torch.cos(angle) / scale, torch.sin(angle) / scale, torch.tan(shear)
+        theta = torch.zeros(B, 2, 3, device=device, dtype=x.dtype)
+        theta[:, 0, 0], theta[:, 0, 1] = cos, -sin + cos * tan
+        theta[:, 1, 0], theta[:, 1, 1] = sin, cos + sin * tan
+        theta[:, :, 2] = torch.empty(B, 2, device=device).uniform_(-2 * self.translate, 2 * self.translate)
+        grid = F.affine_grid(theta, list(x.size()), align_corners=False)
+        return F.grid_sample(x, grid, mode="bilinear", padding_mode="zeros", align_corners=False)
+
+    def cutout(self, x):
+        B, _, H, W = x.size()
+        device = x.device
+        ys = torch.arange(H, device=device).view(1, 1, H, 1)
+        xs = torch.arange(W, device=device).view(1, 1, 1, W)
+        area = torch.empty(B, self.cutout_count, device=device).uniform_(*self.cutout_size) * H * W
+        ratio = torch.exp(torch.empty(B, self.cutout_count, device=device).uniform_(math.log(0.3), math.log(3.3)))
+        h = (area * ratio).sqrt().clamp(max=H - 1)
+        w = (area / ratio).sqrt().clamp(max=W - 1)
+        top = torch.rand(B, self.cutout_count, device=device) * (H - h)
+        left = torch.rand(B, self.cutout_count, device=device) * (W - w)
+        active = torch.rand(B, self.cutout_count, device=device) < self.cutout_p
+        # (B, count, H, W) rectangles, merged into one mask per sample
+        boxes = (ys >= top[..., None, None]) & (ys < (top + h)[..., None, None]) & (xs >= left[..., None, None]) & (xs < (left + w)[..., None, None])
+        mask = (boxes & active[..., None, None]).any(dim=1, keepdim=True)
+        return torch.where(mask, torch.rand_like(x), x)
+
+    def __call__(self, images: torch.Tensor):
+        with torch.no_grad():
+            B, device = images.size(0), images.device
+            mean = torch.tensor(self.mean, device=device, dtype=images.dtype).view(1, 3, 1, 1)
+            std = torch.tensor(self.std, device=device, dtype=images.dtype).view(1, 3, 1, 1)
+            x = images * std + mean
+            view = (B, 1, 1, 1)
+            x = torch.where(self.chance(B, self.hflip, device).view(view), x.flip(-1), x)
+            x = torch.where(self.chance(B, self.grayscale, device).view(view), self.gray(x).expand_as(x), x)
+            x = torch.where(self.chance(B, self.p, device).view(view), self.colour(x), x)
+            x = torch.where(self.chance(B, self.p, device).view(view), self.affine(x), x)
+            x = self.cutout(x)
+            return (x - mean) / std
+
+
+def augment_sample_list(sample_list, augment, field="torchvision_image"):
+    if augment is not None and field in sample_list and isinstance(sample_list[field], torch.Tensor):
+        from ..utils import get_device
+        sample_list[field] = augment(sample_list[field].to(get_device()))
+    return sample_list
+
+
+class BatchMixup:
+    """
+    TextImageDataset.mixup as one pass over a collated batch. Each mixed example takes 1 to `max_partners` partners from the same
+    batch: images become 2x2 quadrant collages cut from one half resolution copy of the batch, texts are joined, label is the max
+    and numeric fields and sample weights are averaged through a (B, B) mixing matrix. Nothing is read or decoded again.
+    """
+    def __init__(self, proba=0.5, max_partners=3, image_fields=("torchvision_image", "image", "original_image"),
+                 mean_fields=("numbers", "embed1", "embed2", "sample_weight")):
+        self.proba = proba
+        self.max_partners = max_partners
+        self.image_fields = image_fields
+        self.mean_fields = mean_fields
+
+    def groups(self, B):
+        groups = []
+        for i in range(B):
+            if B < 2 or random.random() >= self.proba:
+                groups.append(None)
+                continue
+            partners = random.sample([j for j in range(B) if j != i], min(B - 1, random.randint(1, self.max_partners)))
+            members = partners + [i]
+            random.shuffle(members)
+            groups.append(members)
+        return groups
+
+    @staticmethod
+    def tensor_collage(images, groups):
+        B, C, H, W = images.size()
+        h, w = H // 2, W // 2
+        half = F.interpolate(images, size=(h, w), mode="bilinear", align_corners=False)
+        out = images.clone()
+        for i, members in enumerate(groups):
+            if members is None:
+                continue
+            out[i] = images.min()
+            for m, (r, c) in zip(members, random.sample([(0, 0), (0, 1), (1, 0), (1, 1)], len(members))):
+                out[i, :, r * h:(r + 1) * h, c * w:(c + 1) * w] = half[m]
+        return out
+
+    def __call__(self, sample_list):
+        from . import create_collage
+        labels = sample_list["label"]
+        B = len(labels)
+        groups = self.groups(B)
+        if all([g is None for g in groups]):
+            return sample_list
+        mix = torch.eye(B)
+        for i, members in enumerate(groups):
+            if members is not None:
+                mix[i] = 0
+                mix[i, members] = 1.0 / len(members)
+
+        for field in self.image_fields:
+            if field not in sample_list:
+                continue
+            v = sample_list[field]
+            if isinstance(v, torch.Tensor) and v.dim() == 4:
+                sample_list[field] = self.tensor_collage(v, groups)
+            elif isinstance(v, list) and "PIL" in str(type(v[0])):
+                size = v[0].size
+                sample_list[field] = [v[i] if g is None else create_collage(size[0], size[1], [v[m] for m in g],
+                                      filled_position=random.sample([(0, 0), (0, 1), (1, 0), (1, 1)], len(g))) for i, g in enumerate(groups)]
+
+        for field in self.mean_fields:
+            if field not in sample_list:
+                continue
+            v = sample_list[field]
+            t = v if isinstance(v, torch.Tensor) else torch.tensor(v, dtype=torch.float)
+            mixed = (mix.to(t.device) @ t.float().reshape(B, -1)).reshape(t.size()).to(t.dtype)
+            sample_list[field] = mixed if isinstance(v, torch.Tensor) else mixed.tolist()
+
+        label_t = labels if isinstance(labels, torch.Tensor) else torch.tensor(labels)
+        mixed_labels = torch.where(mix > 0, label_t.view(1, B).expand(B, B), torch.zeros_like(label_t).view(1, B).expand(B, B)).max(1)[0].clamp(max=1)
+        sample_list["label"] = mixed_labels if isinstance(labels, torch.Tensor) else mixed_labels.tolist()
+        if "text" in sample_list:
+            texts = sample_list["text"]
+            sample_list["text"] = [t if g is None else " ".join([texts[m] for m in g]) for t, g in zip(texts, groups)]
+        if "id" in sample_list:
+            ids = sample_list["id"]
+            new_ids = [-1 if g is not None else i for i, g in zip(ids.tolist() if isinstance(ids, torch.Tensor) else ids, groups)]
+            sample_list["id"] = torch.tensor(new_ids) if isinstance(ids, torch.Tensor) else new_ids
+        previous = sample_list["mixup"] if "mixup" in sample_list else [False] * B
+        sample_list["mixup"] = [bool(m) or g is not None for m, g in zip(previous, groups)]
+        return sample_list
+
+
+class MixupCollate:
+    """collate_fn for the DataLoader, collates with `collate_fn` then applies BatchMixup in the worker."""
+    def __init__(self, mixup: BatchMixup, collate_fn=None):
+        self.mixup = mixup
+        self.collate_fn = collate_fn
+
+    def __call__(self, batch):
+        from ..utils import my_collate
+        return self.mixup((self.collate_fn or my_collate)(batch))
@@ -0,0 +1,91 @@
+import os
+from typing import List
+
+import numpy as np
+from PIL import Image
+
+
+class DecodedImageStore:
+    """
+    Decoded RGB uint8 images packed back to back in `<prefix>.bin`, with `<prefix>.idx` lines of path, offset, height and width.
+    Images are decoded on first access and appended, so only images that are actually read are stored. The file is memory
+    mapped lazily in each process, so DataLoader workers share the page cache instead of holding their own copy of every
+    decoded image, and pick up images appended by other workers by reading new index lines.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.index = dict()
+        self.index_position = 0
+        self.data = None
+        self.refresh()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["data"] = None
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, path):
+        return path in self.index
+
+    def refresh(self):
+        # Index lines appended since the last read, a line without its newline is still being written
+        if not os.path.exists(self.prefix + ".idx"):
+            return
+        with open(self.prefix + ".idx", "rb") as f:
+            f.seek(self.index_position)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                path, offset, h, w = line.decode("utf-8").rstrip("\n").rsplit("\t", 3)
+                self.index[path] = [int(offset), int(h), int(w)]
+                self.index_position += len(line)
+
+    def add(self, path):
+        import fcntl
+        im = np.ascontiguousarray(np.array(Image.open(path).convert('RGB'), dtype=np.uint8))
+        os.makedirs(os.path.dirname(os.path.abspath(self.prefix)), exist_ok=True)
+        with open(self.prefix + ".lock", "w") as lock:
+            # Workers and concurrent runs may share a cache dir, only one appends at a time
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.refresh()
+            if path not in self.index:
+                with open(self.prefix + ".bin", "ab") as f:
+                    offset = f.tell()
+                    f.write(im.data)
+                # Data is written before its index line, readers never see an entry without pixels
+                with open(self.prefix + ".idx", "ab") as f:
+                    f.write(("%s\t%s\t%s\t%s\n" % (path, offset, im.shape[0], im.shape[1])).encode("utf-8"))
+                self.refresh()
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        return im
+
+    def build(self, paths: List[str]):
+        """Optional offline fill, `get` decodes and stores images on first access anyway."""
+        from tqdm.auto import tqdm
+        self.refresh()
+        missing = sorted(set([p for p in paths if isinstance(p, str) and p not in self.index and os.path.isfile(p)]))
+        for p in tqdm(missing, "Decoding Images to %s" % self.prefix):
+            self.add(p)
+        return self
+
+    def get_array(self, path):
+        entry = self.index.get(path)
+        if entry is None:
+            self.refresh()
+            entry = self.index.get(path)
+        if entry is None:
+            return None
+        offset, h, w = entry
+        if self.data is None or self.data.size < offset + h * w * 3:
+            # Remap once the file has grown past the current mapping
+            self.data = np.memmap(self.prefix + ".bin", dtype=np.uint8, mode="r")
+        return self.data[offset:offset + h * w * 3].reshape(h, w, 3)
+
+    def get(self, path):
+        im = self.get_array(path)
+        if im is None and isinstance(path, str) and os.path.isfile(path):
+            im = self.add(path)
+        return Image.fromarray(im) if im is not None else None
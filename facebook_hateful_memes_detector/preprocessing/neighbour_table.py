@@ -0,0 +1,120 @@
+import argparse
+import json
+import os
+from typing import List
+
+import numpy as np
+
+
+class NeighbourTable:
+    """
+    Precomputed top-k embedding neighbours for a restricted vocabulary.
+    `<prefix>.json` holds the word list (query words first) and `<prefix>.bin` an int32 (n_queries, k) matrix of neighbour ids
+    into that list. Stands in for a KeyedVectors + AnnoyIndexer pair in TextAugment, so the embedding model is never loaded.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        with open(prefix + ".json") as f:
+            meta = json.load(f)
+        self.words = meta["words"]
+        self.n_queries = meta["n_queries"]
+        self.k = meta["k"]
+        self.rows = {w: i for i, w in enumerate(self.words[:self.n_queries])}
+        self.data = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["data"] = None
+        return state
+
+    def __len__(self):
+        return self.n_queries
+
+    def __contains__(self, word):
+        return word in self.rows
+
+    def neighbours(self, word, topn=None):
+        if self.data is None:
+            self.data = np.memmap(self.prefix + ".bin", dtype=np.int32, mode="r", shape=(self.n_queries, self.k))
+        ids = self.data[self.rows[word]][:topn]
+        return [self.words[i] for i in ids]
+
+    def most_similar(self, word, topn=10, indexer=None):
+        # Same shape as most_similar with an AnnoyIndexer, whose first result is the query word itself
+        return [(word, 1.0)] + [(w, 1.0) for w in self.neighbours(word, topn - 1)]
+
+
+def keyed_vectors_vocab(kv):
+    if hasattr(kv, "index_to_key"):
+        return kv.index_to_key
+    return kv.index2word
+
+
+def build_neighbour_table(kv, words: List[str], prefix, k=10, max_candidates=200000, batch_size=4096):
+    """Top-k cosine neighbours of each of `words` found in `kv`, searched among the `max_candidates` most frequent words of `kv`."""
+    from tqdm.auto import tqdm
+    queries = sorted(set([w for w in words if isinstance(w, str) and len(w) > 0 and w in kv]))
+    candidates = list(keyed_vectors_vocab(kv)[:max_candidates])
+    cvecs = np.stack([kv[w] for w in candidates]).astype(np.float32)
+    cvecs /= np.linalg.norm(cvecs, axis=1, keepdims=True) + 1e-8
+    word_ids = {w: i for i, w in enumerate(queries)}
+    out_words = list(queries)
+    for w in candidates:
+        if w not in word_ids:
+            word_ids[w] = len(out_words)
+            out_words.append(w)
+    candidate_ids = np.array([word_ids[w] for w in candidates], dtype=np.int32)
+
+    os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+    table = np.memmap(prefix + ".bin", dtype=np.int32, mode="w+", shape=(len(queries), k))
+    for start in tqdm(range(0, len(queries), batch_size), "Building neighbour table %s" % prefix):
+        qwords = queries[start:start + batch_size]
+        qvecs = np.stack([kv[w] for w in qwords]).astype(np.float32)
+        qvecs /= np.linalg.norm(qvecs, axis=1, keepdims=True) + 1e-8
+        sims = qvecs @ cvecs.T
+        # The query itself is usually its own nearest candidate, take one extra and drop it
+        top = np.argpartition(-sims, k + 1, axis=1)[:, :k + 1]
+        top = np.take_along_axis(top, np.argsort(-np.take_along_axis(sims, top, axis=1), axis=1), axis=1)
+        ids = candidate_ids[top]
+        for i, w in enumerate(qwords):
+            row = ids[i][ids[i] != word_ids[w]][:k]
+            table[start + i] = row if len(row) == k else np.pad(row, (0, k - len(row)), mode="edge")
+    table.flush()
+    with open(prefix + ".json.tmp", "w") as f:
+        json.dump(dict(words=out_words, n_queries=len(queries), k=k), f)
+    os.replace(prefix + ".json.tmp", prefix + ".json")
+    return NeighbourTable(prefix)
+
+
+def corpus_vocabulary(text_files: List[str], idf_file=None):
+    import pandas as pd
+    from ..utils import read_json_lines_into_df
+    words = set()
+    for f in text_files:
+        for text in read_json_lines_into_df(f)["text"]:
+            words.update(str(text).lower().split())
+    if idf_file is not None:
+        words.update([t.lower() for t in pd.read_csv(idf_file)["token"] if isinstance(t, str)])
+    return sorted(words)
+
+
+def load_embedding_model(name):
+    if name.endswith(".bin"):
+        from gensim.models.fasttext import load_facebook_model
+        return load_facebook_model(name).wv
+    import gensim.downloader as api
+    return api.load(name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute top-k neighbour tables for TextAugment(neighbour_tables={aug: prefix})")
+    parser.add_argument("--model", required=True, help="fastText .bin file or gensim downloader name like glove-twitter-100")
+    parser.add_argument("--text_files", nargs="+", required=True, help="jsonl files with a `text` column")
+    parser.add_argument("--idf_file", default=None)
+    parser.add_argument("--out_prefix", required=True)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--max_candidates", type=int, default=200000)
+    a = parser.parse_args()
+    vocab = corpus_vocabulary(a.text_files, a.idf_file)
+    t = build_neighbour_table(load_embedding_model(a.model), vocab, a.out_prefix, a.k, a.max_candidates)
+    print("Wrote neighbours for %s of %s words to %s" % (len(t), len(vocab), a.out_prefix))
@@ -0,0 +1,93 @@
+import argparse
+import os
+
+
+# Embedding models used by TextAugment, saved once as gensim KeyedVectors (+ annoy index) so workers can mmap them read-only
+EMBEDDING_MODELS = {"glove_twitter": "glove-twitter-100", "glove_wiki": "glove-wiki-gigaword-100", "word2vec": "word2vec-google-news-300"}
+
+
+def export_keyed_vectors(aug, path, fasttext_file=None, annoy_trees=32):
+    from gensim.similarities.index import AnnoyIndexer
+    if aug == "fasttext":
+        from gensim.models.fasttext import load_facebook_model
+        kv = load_facebook_model(fasttext_file).wv
+    else:
+        import gensim.downloader as api
+        kv = api.load(EMBEDDING_MODELS[aug])
+    # Store unit vectors, so most_similar in the workers does not build a private normalised copy
+    kv.init_sims(replace=True)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    AnnoyIndexer(kv, annoy_trees).save(path + ".annoy")
+    kv.save(path)
+    return path
+
+
+class MmapKeyedVectors:
+    """
+    KeyedVectors saved by `export_keyed_vectors`, loaded on first use in the process that uses them with `mmap='r'`.
+    Nothing is loaded in the parent, and DataLoader workers share the vector pages through the page cache.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.kv = None
+        self.indexer = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["kv"] = None
+        state["indexer"] = None
+        return state
+
+    def load(self):
+        if self.kv is None:
+            from gensim.models import KeyedVectors
+            from gensim.similarities.index import AnnoyIndexer
+            kv = KeyedVectors.load(self.path, mmap='r')
+            # Vectors were saved normalised
+            kv.vectors_norm = kv.vectors
+            if hasattr(kv, "vectors_ngrams"):
+                kv.vectors_ngrams_norm = kv.vectors_ngrams
+            indexer = AnnoyIndexer()
+            indexer.load(self.path + ".annoy")
+            self.kv, self.indexer = kv, indexer
+        return self.kv
+
+    def __contains__(self, word):
+        return word in self.load()
+
+    def __getitem__(self, word):
+        return self.load()[word]
+
+    def most_similar(self, word, topn=10, indexer=None):
+        kv = self.load()
+        return kv.most_similar(word, topn=topn, indexer=self.indexer)
+
+
+class MmapWordEmbs:
+    """
+    nlpaug word embedding model (`get_vocab` / `predict`) over `MmapKeyedVectors`, for `naw.WordEmbsAug(model=...)`.
+    Pickles without the vectors, each worker mmaps the exported file instead of reading GoogleNews-vectors-negative300.bin.
+    """
+    def __init__(self, kv: MmapKeyedVectors, top_k=100):
+        self.kv = kv
+        self.top_k = top_k
+
+    def get_vocab(self):
+        kv = self.kv.load()
+        return kv.index_to_key if hasattr(kv, "index_to_key") else kv.index2word
+
+    def predict(self, word, n=1):
+        if word not in self.kv:
+            return [word]
+        candidates = [w for w, _ in self.kv.most_similar(word, topn=self.top_k + 1) if w.lower() != word.lower()]
+        return candidates[:self.top_k] if len(candidates) > 0 else [word]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export TextAugment embedding models for TextAugment(embeddings_dir=out_dir)")
+    parser.add_argument("--out_dir", required=True)
+    parser.add_argument("--augs", nargs="+", default=list(EMBEDDING_MODELS.keys()))
+    parser.add_argument("--fasttext_file", default=None)
+    a = parser.parse_args()
+    for aug in a.augs:
+        print("Exported", aug, "to", export_keyed_vectors(aug, os.path.join(a.out_dir, "%s.kv" % aug), a.fasttext_file))
@@ -0,0 +1,107 @@
+import os
+import pickle
+import re
+from typing import List
+
+
+def token_cache_key(tokenizer_name, max_length):
+    return "%s:%s" % (tokenizer_name, max_length)
+
+
+def resolve_model_name(name):
+    # Same lookup the text models do before AutoTokenizer.from_pretrained
+    from ..utils import get_global
+    global_dir = get_global("models_dir")
+    return os.path.join(global_dir, name) if name in os.listdir(global_dir) else name
+
+
+class TokenCache:
+    """
+    text -> un-padded input_ids for one (tokenizer, max_length), persisted as a pickle in `cache_dir`.
+    Fill it in the main process with `build(texts)` before training, DataLoader workers then get the full dict when
+    the collate fn is pickled and only tokenize texts that were never seen (e.g. augmented ones).
+    """
+    def __init__(self, tokenizer_name, max_length, cache_dir=None):
+        from ..utils import get_global
+        self.tokenizer_name = resolve_model_name(tokenizer_name)
+        self.max_length = max_length
+        self.key = token_cache_key(self.tokenizer_name, max_length)
+        if cache_dir is None:
+            cache_dir = get_global("cache_dir")
+        self.path = os.path.join(cache_dir, "tokens_%s_%s.pkl" % (re.sub(r"[^A-Za-z0-9_.-]", "_", self.tokenizer_name), max_length))
+        self.tokens = dict()
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                self.tokens = pickle.load(f)
+        self.tokenizer = None
+        self.pad_token_id = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["tokenizer"] = None
+        return state
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def get_tokenizer(self):
+        if self.tokenizer is None:
+            from transformers import AutoTokenizer
+            self.tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name)
+            self.pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else 0
+        return self.tokenizer
+
+    def encode(self, texts: List[str]):
+        texts = [str(t) for t in texts]
+        missing = list(set([t for t in texts if t not in self.tokens]))
+        if len(missing) > 0:
+            converted_texts = self.get_tokenizer().batch_encode_plus(missing, add_special_tokens=True, max_length=self.max_length, truncation=True)
+            self.tokens.update(dict(zip(missing, converted_texts["input_ids"])))
+        return [self.tokens[t] for t in texts]
+
+    def build(self, texts: List[str], batch_size=1024):
+        texts = list(texts)
+        for i in range(0, len(texts), batch_size):
+            self.encode(texts[i:i + batch_size])
+        self.get_tokenizer()
+        self.save()
+        return self
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(self.tokens, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+
+
+class TokenizeCollate:
+    """
+    collate_fn for the DataLoader. Collates with `collate_fn` then adds `input_ids`, `attention_mask` and `token_key`
+    to the SampleList from `token_cache`, so tokenization happens in the workers. Text models built with the same
+    tokenizer and n_tokens_in use these fields instead of tokenizing `text` in forward.
+    Tokens are padded to `max_length`, models drop the padding they don't need with trim_padding.
+    """
+    def __init__(self, token_cache: TokenCache, collate_fn=None):
+        self.token_cache = token_cache
+        self.collate_fn = collate_fn
+
+    def __call__(self, batch):
+        import torch
+        from ..utils import my_collate
+        sample_list = (self.collate_fn or my_collate)(batch)
+        cache = self.token_cache
+        input_ids = cache.encode(sample_list["text"])
+        if cache.pad_token_id is None:
+            cache.get_tokenizer()
+        length = cache.max_length
+        ids = torch.full((len(input_ids), length), cache.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(input_ids), length), dtype=torch.long)
+        for i, t in enumerate(input_ids):
+            t = t[:length]
+            ids[i, :len(t)] = torch.tensor(t, dtype=torch.long)
+            attention_mask[i, :len(t)] = 1
+        sample_list["input_ids"] = ids
+        sample_list["attention_mask"] = attention_mask
+        sample_list["token_key"] = cache.key
+        return sample_list
@@ -0,0 +1,142 @@
+import argparse
+import contextlib
+import glob
+import json
+import os
+import random
+import zlib
+
+import numpy as np
+from PIL import Image
+
+
+def view_seed(identifier, view_id, seed=0):
+    # Same identifier, view id and seed always give the same augmentation draws
+    return (zlib.crc32(("%s:%s:%s" % (seed, identifier, view_id)).encode()) & 0x7fffffff)
+
+
+@contextlib.contextmanager
+def seeded_rngs(seed):
+    # The transforms draw from the global random, numpy and torch generators. They are seeded for the view only and
+    # their previous state is restored after, so augmentation elsewhere in the process is unaffected
+    import torch
+    states = random.getstate(), np.random.get_state(), torch.get_rng_state()
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    try:
+        yield
+    finally:
+        random.setstate(states[0])
+        np.random.set_state(states[1])
+        torch.set_rng_state(states[2])
+
+
+def render_view(text, image, identifier, view_id, text_transform, image_transform, seed=0, image_size=224):
+    """One augmented view, deterministic in (identifier, view_id, seed)."""
+    with seeded_rngs(view_seed(identifier, view_id, seed)):
+        text = text_transform(text, identifier=identifier)
+        if image is not None:
+            image = image_transform(image.copy())
+            if image_size:
+                image.thumbnail((image_size, image_size))
+    return text, image
+
+
+class AugmentedViewStore:
+    """
+    K precomputed augmented views per sample in `n_shards` shards. `views_<shard>.bin` holds the view images as raw RGB uint8,
+    `views_<shard>.json` maps sample identifier -> list of [view_id, text, offset, height, width] (offset -1 for no image).
+    Shards are written independently, so each can be built by its own process.
+
+    Views are stored uncompressed so reading one is a memmap slice, which makes their size the cost: a 224 px view is
+    ~150KB, a full size meme view is several MB, times `n_views` per sample. Views are shrunk to `image_size` (longest
+    side, 224 by default, the model input size) when built, pass 0 to keep full size when later transforms need it.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.views = dict()
+        self.shard_of = dict()
+        self.meta = dict()
+        for f in sorted(glob.glob(os.path.join(directory, "views_*.json"))):
+            with open(f) as fp:
+                shard = json.load(fp)
+            self.meta = shard["meta"]
+            for identifier, views in shard["views"].items():
+                self.views[identifier] = views
+                self.shard_of[identifier] = shard["shard"]
+        self.data = dict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["data"] = dict()
+        return state
+
+    def __contains__(self, identifier):
+        return str(identifier) in self.views
+
+    def __len__(self):
+        return len(self.views)
+
+    def get(self, identifier, view_id=None):
+        """(text, PIL image or None, view_id) for a random stored view, or the given one."""
+        identifier = str(identifier)
+        views = self.views[identifier]
+        view = random.choice(views) if view_id is None else [v for v in views if v[0] == view_id][0]
+        view_id, text, offset, h, w = view
+        if offset < 0:
+            return text, None, view_id
+        shard = self.shard_of[identifier]
+        if shard not in self.data:
+            self.data[shard] = np.memmap(os.path.join(self.directory, "views_%s.bin" % shard), dtype=np.uint8, mode="r")
+        return text, Image.fromarray(np.array(self.data[shard][offset:offset + h * w * 3]).reshape(h, w, 3)), view_id
+
+
+def build_view_shard(dataset, directory, n_views, shard=0, n_shards=1, seed=0, image_size=224):
+    """Materialise `n_views` views of every `shard`-th sample of a TextImageDataset, using its text and image transforms."""
+    from tqdm.auto import tqdm
+    os.makedirs(directory, exist_ok=True)
+    views = dict()
+    with open(os.path.join(directory, "views_%s.bin" % shard), "wb") as f:
+        for item in tqdm(range(shard, len(dataset), n_shards), "Building view shard %s/%s" % (shard, n_shards)):
+            s = dataset.item_getter(item)
+            sample_views = []
+            for view_id in range(n_views):
+                text, image = render_view(s.text, s.image, s.id, view_id, dataset.text_transform, dataset.image_transform, seed, image_size)
+                offset, h, w = -1, 0, 0
+                if image is not None:
+                    im = np.ascontiguousarray(np.array(image.convert('RGB'), dtype=np.uint8))
+                    offset, h, w = f.tell(), im.shape[0], im.shape[1]
+                    f.write(im.data)
+                sample_views.append([view_id, text, offset, h, w])
+            views[str(s.id)] = sample_views
+    meta = dict(n_views=n_views, seed=seed, image_size=image_size, n_shards=n_shards)
+    tmp = os.path.join(directory, "views_%s.json.tmp" % shard)
+    with open(tmp, "w") as f:
+        json.dump(dict(shard=shard, meta=meta, views=views), f)
+    os.replace(tmp, os.path.join(directory, "views_%s.json" % shard))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute augmented training views, use with TextImageDataset(augmented_views=out_dir)")
+    parser.add_argument("--data_dir", required=True)
+    parser.add_argument("--out_dir", required=True)
+    parser.add_argument("--n_views", type=int, default=8)
+    parser.add_argument("--shard", type=int, default=0)
+    parser.add_argument("--n_shards", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--image_size", type=int, default=224,
+                        help="Longest side of stored view images (raw RGB, ~150KB per view at 224), 0 keeps full size")
+    parser.add_argument("--image_augment", default="hard", help="get_image_transforms_pytorch mode")
+    parser.add_argument("--text_augment_config", default=None, help="json with TextAugment kwargs, text is left as is if not set")
+    a = parser.parse_args()
+    from . import TextAugment, get_image_transforms_pytorch, get_datasets
+    from ..training.generic import convert_dataframe_to_dataset
+    text_transform = None
+    if a.text_augment_config is not None:
+        with open(a.text_augment_config) as f:
+            text_transform = TextAugment(**json.load(f))
+    data = get_datasets(a.data_dir, train_text_transform=text_transform, train_image_transform=get_image_transforms_pytorch(a.image_augment),
+                        cache_images=False, keep_processed_image=True)
+    dataset = convert_dataframe_to_dataset(data["train"], data["metadata"], True)
+    build_view_shard(dataset, a.out_dir, a.n_views, a.shard, a.n_shards, a.seed, a.image_size)
@@ -0,0 +1,127 @@
+import os
+from typing import List
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+def default_tokenize(text):
+    import fasttext
+    return fasttext.tokenize(str(text))
+
+
+class VocabEmbeddings:
+    """
+    Word -> row table over one or more word vector sources (fasttext, BPEmb, CharNGram, gensim ...), concatenated
+    in `sources` order. Row 0 is padding. Words are looked up once, when first seen in `build` or in a batch, so
+    fasttext subword vectors for OOV words are computed once and cached. Featurizing a batch is then `token_ids`
+    plus one nn.Embedding gather.
+    `lookups` optionally gives a word -> vector function per source, default `source[word]`.
+    `normalize` unit normalises every word vector per source, as Fasttext1DCNNModel.get_fasttext_vectors does.
+    Not an nn.Module, so the growing table stays out of model state dicts.
+    """
+    def __init__(self, sources: List, lookups: List = None, normalize=True, tokenize=default_tokenize):
+        self.sources = sources
+        self.lookups = lookups if lookups is not None else [None] * len(sources)
+        self.normalize = normalize
+        self.tokenize = tokenize
+        self.vocab = dict()
+        self.dims = None
+        self.matrix = None
+        self.embedding = None
+
+    @classmethod
+    def from_config(cls, config, sources: List, **kwargs):
+        """`config` from model kwargs: falsy for no table, True for an empty table, or the path of a saved table."""
+        if not config:
+            return None
+        table = cls(sources, **kwargs)
+        if isinstance(config, str) and os.path.exists(config):
+            table.load(config)
+        return table
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["embedding"] = None
+        return state
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def word_vector(self, word):
+        vectors = []
+        for source, lookup in zip(self.sources, self.lookups):
+            v = lookup(word) if lookup is not None else source[word]
+            v = torch.as_tensor(np.asarray(v), dtype=torch.float).view(-1)
+            if self.normalize:
+                v = v / v.norm().clamp(min=1e-5)
+            vectors.append(v)
+        if self.dims is None:
+            self.dims = [v.size(0) for v in vectors]
+        return torch.cat(vectors)
+
+    def add_words(self, words):
+        new_words = [w for w in dict.fromkeys(words) if w not in self.vocab]
+        if len(new_words) == 0:
+            return 0
+        rows = torch.stack([self.word_vector(w) for w in new_words])
+        start = len(self.vocab) + 1
+        end = start + len(new_words)
+        if self.matrix is None or end > self.matrix.size(0):
+            # Grow by doubling, the embedding is only rebuilt when the table is reallocated
+            matrix = torch.zeros(max(2 * end, 1024), rows.size(1))
+            if self.matrix is not None:
+                matrix[:start] = self.matrix[:start]
+            self.matrix = matrix
+            self.embedding = None
+        self.matrix[start:end] = rows
+        if self.embedding is not None:
+            self.embedding.weight.data[start:end] = rows.to(self.embedding.weight.device)
+        for i, w in enumerate(new_words):
+            self.vocab[w] = start + i
+        return len(new_words)
+
+    def build(self, texts: List[str]):
+        from tqdm.auto import tqdm
+        for text in tqdm(texts, "Building vocabulary embeddings"):
+            self.add_words(self.tokenize(text))
+        return self
+
+    def get_embedding(self, device=None):
+        if self.embedding is None:
+            matrix = self.matrix if self.matrix is not None else torch.zeros(1, sum(self.dims) if self.dims is not None else 1)
+            self.embedding = nn.Embedding.from_pretrained(matrix.clone(), freeze=True, padding_idx=0)
+        if device is not None and self.embedding.weight.device != torch.device(device):
+            self.embedding = self.embedding.to(device)
+        return self.embedding
+
+    def token_ids(self, texts: List[str], n_tokens_in, min_length=None):
+        from ..utils import dynamic_pad_length
+        tokenized = [self.tokenize(text)[:n_tokens_in] for text in texts]
+        self.add_words([w for t in tokenized for w in t])
+        length = dynamic_pad_length([len(t) for t in tokenized], n_tokens_in, min_length)
+        ids = np.zeros((len(texts), length), dtype=np.int64)
+        for i, t in enumerate(tokenized):
+            t = t[:length]
+            ids[i, :len(t)] = [self.vocab[w] for w in t]
+        return torch.from_numpy(ids)
+
+    def __call__(self, texts: List[str], n_tokens_in, min_length=None, device=None, split=False):
+        """(B, L, sum of source dims) word vectors, or one tensor per source if `split`."""
+        ids = self.token_ids(texts, n_tokens_in, min_length)
+        embedding = self.get_embedding(device)
+        result = embedding(ids.to(embedding.weight.device))
+        return list(torch.split(result, self.dims, dim=2)) if split else result
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        torch.save(dict(words=list(self.vocab.keys()), matrix=self.matrix[:len(self.vocab) + 1].clone(), dims=self.dims), path)
+
+    def load(self, path):
+        state = torch.load(path)
+        self.vocab = {w: i + 1 for i, w in enumerate(state["words"])}
+        self.matrix = state["matrix"]
+        self.dims = state["dims"]
+        self.embedding = None
+        return self
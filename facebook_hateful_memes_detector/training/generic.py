@@ -14,8 +14,10 @@ import contractions
 import pandas as pd
 from sklearn.metrics import confusion_matrix
 
-from ..utils import in_notebook, get_device, dict2sampleList, clean_memory, GaussianNoise, my_collate, WordMasking
+from ..utils import in_notebook, get_device, dict2sampleList, clean_memory, memory_hygiene_step, GaussianNoise, my_collate, WordMasking
+from ..preprocessing.batch_augment import augment_sample_list
 from ..preprocessing import make_weights_for_balanced_classes, TextImageDataset, make_weights_for_uda, make_sqrt_weights_for_balanced_classes, make_sqrt_weights_for_uda
+from ..preprocessing import TextAugment, TextAugmentCollate
 import gc
 from torch.utils.data.sampler import WeightedRandomSampler, Sampler
 from torch.utils.data import Subset
@@ -332,6 +334,34 @@ class CustomSampler(Sampler):
         return self.num_samples
 
 
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batch sampler over the indices of `sampler` (any sampling_policy sampler, or a random permutation if None).
+    Takes `batch_size * bucket_multiplier` indices at a time, sorts them by text length, cuts them into batches and shuffles
+    the batches, so each batch holds texts of similar length and dynamic padding pads little.
+    """
+    def __init__(self, sampler, lengths, batch_size, bucket_multiplier=50, drop_last=False):
+        self.sampler = sampler
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_multiplier
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        indices = list(self.sampler) if self.sampler is not None else np.random.permutation(len(self.lengths)).tolist()
+        batches = []
+        for i in range(0, len(indices), self.bucket_size):
+            bucket = sorted(indices[i:i + self.bucket_size], key=lambda idx: self.lengths[idx])
+            batches.extend([bucket[j:j + self.batch_size] for j in range(0, len(bucket), self.batch_size)])
+        if self.drop_last:
+            batches = [b for b in batches if len(b) == self.batch_size]
+        return iter([batches[i] for i in np.random.permutation(len(batches))])
+
+    def __len__(self):
+        n = len(self.sampler) if self.sampler is not None else len(self.lengths)
+        return n // self.batch_size if self.drop_last else int(np.ceil(n / self.batch_size))
+
+
 def train(model, optimizer, scheduler_init_fn,
           batch_size, epochs, dataset,
           model_call_back=None, accumulation_steps=1,
@@ -341,7 +371,7 @@ def train(model, optimizer, scheduler_init_fn,
           collate_fn=my_collate,
           class_weights={0: 1, 1: 1.8},
           model_save_key=None, save_every=None,
-          resume_most_recent_checkpoint=False):
+          resume_most_recent_checkpoint=False, batch_augment: Callable = None):
     if in_notebook():
         from tqdm.notebook import tqdm, trange
     else:
@@ -370,6 +400,12 @@ def train(model, optimizer, scheduler_init_fn,
     except:
         pass
     use_autocast = use_autocast and get_global("use_autocast")
+    if batch_augment is None:
+        try:
+            # e.g. BatchImageAugment(), runs on the collated torchvision_image batch on the training device
+            batch_augment = get_global("batch_image_augment")
+        except:
+            pass
     gradient_clipping = False
     try:
         gradient_clipping = get_global("gradient_clipping")
@@ -447,8 +483,37 @@ def train(model, optimizer, scheduler_init_fn,
         shuffle = True
         examples = len(dataset)
         divisor = 1
-    train_loader = DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn,
-                              shuffle=shuffle, num_workers=get_global("dataloader_workers"), pin_memory=False, sampler=sampler)
+    pin_memory = False
+    try:
+        # Batches from my_collate are columnar, SampleList.pin_memory pins each stacked field in the loader's pin thread
+        pin_memory = get_global("pin_memory") and "cuda" in str(get_device())
+    except:
+        pass
+    batch_text_augment = False
+    try:
+        batch_text_augment = get_global("batch_text_augment")
+    except:
+        pass
+    if batch_text_augment and isinstance(getattr(dataset, "text_transform", None), TextAugment) and dataset.view_store is None:
+        # Texts are augmented per batch in the loader workers instead of per sample, on a shallow copy so validation
+        # on the same dataset object keeps its per sample text_transform
+        import copy
+        dataset = copy.copy(dataset)
+        dataset.batch_text_transform = True
+        collate_fn = TextAugmentCollate(dataset.text_transform, collate_fn)
+    length_bucketing = False
+    try:
+        length_bucketing = get_global("length_bucketing")
+    except:
+        pass
+    if length_bucketing and hasattr(dataset, "texts"):
+        lengths = [len(str(t).split()) for t in dataset.texts]
+        batch_sampler = LengthBucketBatchSampler(sampler, lengths, batch_size)
+        train_loader = DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn,
+                                  num_workers=get_global("dataloader_workers"), pin_memory=pin_memory)
+    else:
+        train_loader = DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn,
+                                  shuffle=shuffle, num_workers=get_global("dataloader_workers"), pin_memory=pin_memory, sampler=sampler)
 
     train_losses = []
     learning_rates = []
@@ -457,7 +522,7 @@ def train(model, optimizer, scheduler_init_fn,
     epochs = int(epochs * divisor)
     scheduler, update_in_batch, update_in_epoch = scheduler_init_fn(optimizer, epochs, batch_size, examples) if scheduler_init_fn is not None else (None, False, False)
     print("Autocast = ", use_autocast, "Epochs = ", epochs, "Divisor =", divisor, "Examples =", examples, "Batch Size = ", batch_size,)
-    print("Training Samples = ", len(dataset), "Weighted Sampling = ", sampler is not None,
+    print("Training Samples = ", len(dataset), "Weighted Sampling = ", sampler is not None, "Length Bucketing = ", length_bucketing,
           "Num Batches = ", len(train_loader), "Accumulation steps = ", accumulation_steps)
     if len(train_loader) % accumulation_steps != 0:
         print("[WARN]: Number of training batches not divisible by accumulation steps, some training batches will be wasted due to this.")
@@ -490,6 +555,7 @@ def train(model, optimizer, scheduler_init_fn,
                     if model_call_back is not None:
                         model_call_back(model, batch_idx, len(train_loader), epoc, epochs)
                     tms = time.time()
+                    batch = augment_sample_list(batch, batch_augment)
                     if use_autocast:
                         with autocast():
                             res = model(batch)
@@ -525,6 +591,7 @@ def train(model, optimizer, scheduler_init_fn,
                         learning_rates.append(float(optimizer.param_groups[0]['lr']))
                         loss_monitor = 0.0
                         optimizer.zero_grad()
+                        memory_hygiene_step()
                     if update_in_batch:
                         scheduler.step()
                     train_losses_cur_epoch.append(float(loss.cpu().detach().item()) * accumulation_steps)
@@ -657,7 +724,7 @@ def train_for_augment_similarity(model, optimizer, scheduler_init_fn,
                             scaler.step(optimizer)
                             scaler.update()
                             optimizer.zero_grad()
-                            clean_memory()
+                            memory_hygiene_step()
                     else:
                         repr = model(augmented_batch)
                         if isinstance(repr, (list, tuple)):
@@ -674,7 +741,7 @@ def train_for_augment_similarity(model, optimizer, scheduler_init_fn,
                                 torch.nn.utils.clip_grad_norm_(list(filter(lambda p: p.requires_grad, model.parameters())), gradient_clipping)
                             optimizer.step()
                             optimizer.zero_grad()
-                            clean_memory()
+                            memory_hygiene_step()
                     if update_in_batch:
                         scheduler.step()
                     train_losses.append(float(loss.cpu().detach().item()))
@@ -930,7 +997,8 @@ def convert_dataframe_to_dataset(df, metadata, train=True, **kwargs):
                           cache_images=metadata["cache_images"], use_images=metadata["use_images"],
                           keep_original_text=metadata["keep_original_text"], keep_original_image=metadata["keep_original_image"],
                           keep_processed_image=metadata["keep_processed_image"], keep_torchvision_image=metadata["keep_torchvision_image"],
-                          mixup_config=metadata["train_mixup_config"] if train else None,  **kwargs)
+                          mixup_config=metadata["train_mixup_config"] if train else None,
+                          augmented_views=metadata.get("train_augmented_views") if train else None, **kwargs)
     return ds
 
 
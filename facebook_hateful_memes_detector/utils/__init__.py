@@ -34,9 +34,9 @@ RE_D = re.compile('\d')
 
 
 def my_collate(batch):
-    # Create and return sample list with proper name and type set
-    sample_list = SampleList(batch)
-    clean_memory()
+    # Create and return sample list with proper name and type set, one stacked tensor per field
+    sample_list = columnar_collate(batch)
+    maybe_clean_memory()
     return sample_list
 
 
@@ -369,6 +369,52 @@ def stack_and_pad_tensors(batch, max_len=None, padding_index=DEFAULT_PADDING_IND
     return padded
 
 
+def dynamic_pad_length(lengths, max_length, min_length=None, multiple=8):
+    """
+    Length to pad a batch to. `max_length` unless the "dynamic_padding" global is set and the caller passes `min_length`,
+    then the longest sequence in the batch rounded up to `multiple`, within [min_length, max_length].
+    """
+    dynamic = False
+    try:
+        dynamic = get_global("dynamic_padding")
+    except:
+        pass
+    if not dynamic or min_length is None or len(lengths) == 0:
+        return max_length
+    length = int(math.ceil(max(lengths) / multiple) * multiple)
+    return max(min(length, max_length), min(min_length, max_length))
+
+
+def tokenize_and_pad(tokenizer, texts: List[str], max_length, min_length=None):
+    """batch_encode_plus padded to `dynamic_pad_length`, returns (input_ids, attention_mask) as lists of lists."""
+    converted_texts = tokenizer.batch_encode_plus(texts, add_special_tokens=True, max_length=max_length, truncation=True)
+    input_ids, attention_mask = converted_texts["input_ids"], converted_texts["attention_mask"]
+    length = dynamic_pad_length([len(ids) for ids in input_ids], max_length, min_length)
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+    input_ids = [ids[:length] + [pad_id] * (length - len(ids)) for ids in input_ids]
+    attention_mask = [mask[:length] + [0] * (length - len(mask)) for mask in attention_mask]
+    return input_ids, attention_mask
+
+
+def trim_padding(input_ids: torch.Tensor, attention_mask: torch.Tensor, min_length=None):
+    """Drops trailing padding columns of already padded token tensors down to `dynamic_pad_length`."""
+    length = dynamic_pad_length(attention_mask.sum(1).tolist(), input_ids.size(1), min_length)
+    return input_ids[:, :length], attention_mask[:, :length]
+
+
+def pretokenized(sampleList, token_key, word_masking=None, min_length=None):
+    """
+    (input_ids, attention_mask) on the device from a SampleList built by TokenizeCollate, None if it has no tokens
+    for `token_key` and the model should tokenise `text` itself.
+    """
+    if "input_ids" not in sampleList or "token_key" not in sampleList or sampleList["token_key"] != token_key:
+        return None
+    input_ids, attention_mask = trim_padding(sampleList["input_ids"], sampleList["attention_mask"], min_length)
+    if word_masking is not None:
+        input_ids = word_masking.mask_ids(input_ids, attention_mask)
+    return input_ids.to(get_device()), attention_mask.to(get_device())
+
+
 class Transpose(nn.Module):
     def __init__(self, dim1=1, dim2=2):
         super().__init__()
@@ -1244,7 +1290,7 @@ class LambdaLayer(nn.Module):
         return x
 
 
-from .detectron_v1_object_detector import get_image_info_fn, persistent_caching_fn
+from .detectron_v1_object_detector import get_image_info_fn, persistent_caching_fn, build_image_digest_index, tag_image_digest, image_digest
 
 
 def print_code(func):
@@ -1273,13 +1319,64 @@ def dict2sampleList(samples: Dict, *args, **kwargs):
         raise ValueError
 
 
+def in_dataloader_worker():
+    return torch.utils.data.get_worker_info() is not None
+
+
 def clean_memory():
     _ = gc.collect()
-    if torch.cuda.is_available():
+    # DataLoader workers are forked and must not initialise CUDA
+    if torch.cuda.is_available() and not in_dataloader_worker():
         torch.cuda.empty_cache()
     _ = gc.collect()
 
 
+def memory_usage_fraction():
+    """CUDA reserved fraction in the main process, process RSS fraction on CPU and inside DataLoader workers."""
+    if torch.cuda.is_available() and not in_dataloader_worker():
+        return torch.cuda.memory_reserved() / torch.cuda.get_device_properties(torch.cuda.current_device()).total_memory
+    try:
+        with open("/proc/self/statm") as f:
+            rss_pages = int(f.read().split()[1])
+        return rss_pages / os.sysconf("SC_PHYS_PAGES")
+    except:
+        return 0.0
+
+
+memory_hygiene_state = dict(step=0)
+
+
+def get_memory_hygiene():
+    """
+    Policy for gc.collect + cuda empty_cache in hot paths, set with `set_global("memory_hygiene", dict(mode=..., ...))`.
+    mode = "always" (clean on every hot path call), "off", "every" (every `steps` train steps) or "threshold" (when
+    cuda reserved / process RSS fraction exceeds `threshold`).
+    """
+    try:
+        return get_global("memory_hygiene")
+    except:
+        return dict(mode="every", steps=100)
+
+
+def maybe_clean_memory():
+    policy = get_memory_hygiene()
+    mode = policy["mode"]
+    if mode == "always":
+        clean_memory()
+    elif mode == "threshold" and memory_usage_fraction() > policy.get("threshold", 0.9):
+        clean_memory()
+
+
+def memory_hygiene_step():
+    memory_hygiene_state["step"] += 1
+    policy = get_memory_hygiene()
+    mode = policy["mode"]
+    if mode == "every" and memory_hygiene_state["step"] % policy.get("steps", 100) == 0:
+        clean_memory()
+    elif mode == "threshold" and memory_usage_fraction() > policy.get("threshold", 0.9):
+        clean_memory()
+
+
 class WordMasking(nn.Module):
     def __init__(self, tokenizer, **kwargs):
         super().__init__()
@@ -1297,6 +1394,23 @@ class WordMasking(nn.Module):
                 texts = [random_word_mask(t, tokenizer, proba) for t in texts]
         return texts
 
+    def mask_ids(self, input_ids: torch.Tensor, attention_mask: torch.Tensor):
+        """random_word_mask on token ids: 80% mask token, 10% random token, 10% unchanged. Special tokens are kept."""
+        if not self.training or self.word_masking_proba == 0:
+            return input_ids
+        tokenizer = self.tokenizer
+        special = torch.tensor(tokenizer.all_special_ids, dtype=input_ids.dtype, device=input_ids.device)
+        candidates = attention_mask.bool() & ~(input_ids.unsqueeze(-1) == special).any(-1)
+        prob = torch.rand(input_ids.size(), device=input_ids.device)
+        selected = candidates & (prob < self.word_masking_proba)
+        prob = prob / self.word_masking_proba
+        input_ids = input_ids.clone()
+        input_ids[selected & (prob < 0.8)] = tokenizer.mask_token_id
+        random_ids = torch.randint(len(tokenizer), input_ids.size(), dtype=input_ids.dtype, device=input_ids.device)
+        replace = selected & (prob >= 0.8) & (prob < 0.9)
+        input_ids[replace] = random_ids[replace]
+        return input_ids
+
 
 def random_whole_word_mask(text: str, tokenizer, probability: float) -> str:
     text = str(text)
@@ -1419,9 +1533,10 @@ class BertLMPredictionHead(nn.Module):
 
 
 class MLMPretraining(nn.Module):
-    def __init__(self, model, tokenizer, hidden_size, hidden_act, n_tokens_in, use_as_super=False, low_memory=False):
+    def __init__(self, model, tokenizer, hidden_size, hidden_act, n_tokens_in, use_as_super=False, low_memory=False, token_key=None):
         super().__init__()
         self.model = model
+        self.token_key = token_key
 
         if not use_as_super:
             self.mlm = BertLMPredictionHead(hidden_size, tokenizer.vocab_size, hidden_act, n_tokens_in, low_memory=low_memory)
@@ -1440,7 +1555,8 @@ class MLMPretraining(nn.Module):
     def forward(self, samples: SampleList):
         _, pooled, seq, _ = self.model(samples)
         text = samples["text"]
-        input_ids, attention_mask = self.tokenise(text)
+        tokens = pretokenized(samples, self.token_key)
+        input_ids, attention_mask = self.tokenise(text) if tokens is None else tokens
         loss, accuracy, input_ids, predictions = self.mlm(seq, input_ids, attention_mask)
         self.accuracy_hist.append(accuracy)
         self.loss_hist.append(float(loss.cpu().detach()))
@@ -1,8 +1,8 @@
-import gc
+import contextlib
 import os
 import sys
 import time
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, OrderedDict
 from random import random, shuffle
 from time import sleep
 from typing import List, Callable
@@ -15,15 +15,169 @@ from PIL import Image
 
 try:
     from .globals import get_device, build_cache, set_global, get_global
+    from .feature_pack import get_feature_pack, pack_first, fc6_value, lxmert_value
+    from .image_pyramid import get_image_pyramid
 except:
     from globals import get_device, build_cache, set_global, get_global
+    from feature_pack import get_feature_pack, pack_first, fc6_value, lxmert_value
+    from image_pyramid import get_image_pyramid
 
 DIR = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(f'{DIR}/vqa-maskrcnn-benchmark')
 
 
+def sizeof(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.element_size() * obj.nelement()
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum([sizeof(k) + sizeof(v) for k, v in obj.items()])
+    if isinstance(obj, (list, tuple, set)):
+        return sys.getsizeof(obj) + sum([sizeof(v) for v in obj])
+    return sys.getsizeof(obj)
+
+
+class MemoryLRUCache:
+    """
+    Byte bounded LRU shared by every persistent_caching_fn in the process, sits in front of diskcache.
+    Values are shared, not copied: callers that change features in place (e.g. bbox_aug) must work on their own copy.
+    """
+    def __init__(self, max_bytes, cache_stats):
+        self.max_bytes = max_bytes
+        self.cache_stats = cache_stats
+        self.store = OrderedDict()
+        self.bytes = 0
+
+    def get(self, name, hsh):
+        if hsh in self.store:
+            self.store.move_to_end(hsh)
+            self.cache_stats[name]["memory_hit"] += 1
+            return self.store[hsh][1]
+        self.cache_stats[name]["memory_miss"] += 1
+        return None
+
+    def put(self, name, hsh, value):
+        size = sizeof(value)
+        if size > self.max_bytes:
+            return
+        if hsh in self.store:
+            self.bytes -= self.store.pop(hsh)[0]
+        self.store[hsh] = (size, value, name)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (evicted_size, _, evicted_name) = self.store.popitem(last=False)
+            self.bytes -= evicted_size
+            self.cache_stats[evicted_name]["memory_eviction"] += 1
+        self.cache_stats["memory_lru"]["bytes"] = self.bytes
+        self.cache_stats["memory_lru"]["entries"] = len(self.store)
+
+
+def file_digest(path, block_size=2 ** 20):
+    import hashlib
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def get_image_digest_index():
+    try:
+        return get_global("image_digest_index")
+    except:
+        index = dict()
+        set_global("image_digest_index", index)
+        return index
+
+
+def build_image_digest_index(paths: List, index_file=None):
+    """
+    Hash each image file's bytes once, path -> sha1. Entries are persisted to `index_file` (default `cache_dir/image_digests.json`)
+    with size and mtime so later runs only re-hash files that changed.
+    """
+    import json
+    from tqdm.auto import tqdm
+    index = get_image_digest_index()
+    if index_file is None:
+        try:
+            index_file = os.path.join(get_global("cache_dir"), "image_digests.json")
+        except:
+            pass
+    stored = dict()
+    if index_file is not None and os.path.exists(index_file):
+        with open(index_file) as f:
+            stored = json.load(f)
+    paths = [p for p in set(paths) if isinstance(p, str) and p not in index and os.path.isfile(p)]
+    changed = False
+    for p in tqdm(paths, "Image digests", disable=len(paths) < 1000):
+        st = os.stat(p)
+        entry = stored.get(p)
+        if entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime:
+            entry = [st.st_size, st.st_mtime, file_digest(p)]
+            stored[p] = entry
+            changed = True
+        index[p] = entry[2]
+    if changed and index_file is not None and os.path.isdir(os.path.dirname(index_file)):
+        with open(index_file, "w") as f:
+            json.dump(stored, f)
+    return index
+
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".webp", ".tif", ".tiff")
+
+
+def pixel_digest(image):
+    import hashlib
+    return hashlib.sha1(("%s %s %s " % (image.mode, image.size[0], image.size[1])).encode() + image.tobytes()).hexdigest()
+
+
+def tag_image_digest(image, path):
+    # PIL copies `info` through transpose/rotate/resize/convert, so the file digest is stored with a digest of the
+    # pixels it was decoded to and only trusted while the pixels still match, see image_digest
+    digest = get_image_digest_index().get(path)
+    if digest is not None and "PIL" in str(type(image)):
+        image.info["content_digest"] = (digest, pixel_digest(image))
+        image._verified_digest = (image.mode, image.size, image.info["content_digest"])
+    return image
+
+
+def is_image_path(value):
+    return isinstance(value, str) and "\n" not in value and len(value) < 4096 and os.path.splitext(value)[1].lower() in IMAGE_EXTENSIONS
+
+
+def image_digest(image):
+    if isinstance(image, str):
+        # Only image file paths, other strings (e.g. texts for cached text featurizers) are never stat-ed or hashed
+        if not is_image_path(image):
+            return None
+        index = get_image_digest_index()
+        if image not in index and os.path.isfile(image):
+            index[image] = file_digest(image)
+        return index.get(image)
+    if "PIL" in str(type(image)):
+        tag = image.info.get("content_digest")
+        if not (isinstance(tag, tuple) and len(tag) == 2):
+            return None
+        # The pixel hash is checked once per image object, PIL transforms return new objects which are checked again.
+        # In place edits (paste, ImageDraw) that keep mode and size must drop info["content_digest"] themselves.
+        fingerprint = (image.mode, image.size, tag)
+        if getattr(image, "_verified_digest", None) == fingerprint:
+            return tag[0]
+        if tag[1] == pixel_digest(image):
+            image._verified_digest = fingerprint
+            return tag[0]
+        return None
+    return None
+
+
 def persistent_caching_fn(fn, name, check_cache_exists=False, cache_dir=None,
-                          cache_dirs=None, cache_allow_writes=True, retries=2) -> Callable:
+                          cache_dirs=None, cache_allow_writes=True, retries=2, batch_fn=None) -> Callable:
+    """
+    Wraps `fn` with a memory LRU + diskcache. The returned callable also has
+    `get_many(hashes)` and `compute_missing(items, ignore_cache=None)`, the latter reads all keys in one sqlite
+    transaction, calls `batch_fn(list_of_missing_items)` (one batched forward) and writes back in one transaction.
+    """
     wait_time = 0.25
     random_time = 0.25
 
@@ -49,6 +203,17 @@ def persistent_caching_fn(fn, name, check_cache_exists=False, cache_dir=None,
     cache_stats["count_cache_dirs"] = len(set(cache_dirs))
     cache_stats["cache_dirs"] = set(cache_dirs)
 
+    # Opt in with e.g. set_global("cache_memory_bytes", 2 ** 30), every process (DataLoader workers too) gets its own tier
+    try:
+        memory_lru = get_global("memory_lru_cache")
+    except:
+        try:
+            cache_memory_bytes = get_global("cache_memory_bytes")
+        except:
+            cache_memory_bytes = 0
+        memory_lru = MemoryLRUCache(cache_memory_bytes, cache_stats) if cache_memory_bytes > 0 else None
+        set_global("memory_lru_cache", memory_lru)
+
     from diskcache import Cache
     import joblib
     if check_cache_exists:
@@ -72,8 +237,18 @@ def persistent_caching_fn(fn, name, check_cache_exists=False, cache_dir=None,
         except Exception as e:
             fnh = joblib.hashing.hash(name, 'sha1')
 
+    try:
+        content_addressed_keys = get_global("content_addressed_cache_keys")
+    except:
+        content_addressed_keys = True
+
+    def content_key(arg):
+        digest = image_digest(arg) if content_addressed_keys else None
+        return arg if digest is None else ("content_digest", digest)
+
     def build_hash(*args, **kwargs):
-        hsh = fnh + joblib.hashing.hash(args, 'sha1')
+        # Images with a known file digest are keyed by it, so a path and its decoded PIL image share one entry
+        hsh = fnh + joblib.hashing.hash(tuple(map(content_key, args)), 'sha1')
         if len(kwargs) > 0:
             hsh = hsh + joblib.hashing.hash(kwargs, 'sha1')
         return hsh
@@ -132,9 +307,16 @@ def persistent_caching_fn(fn, name, check_cache_exists=False, cache_dir=None,
 
         cache_stats[name]["called"] += 1
 
+        if memory_lru is not None:
+            r = memory_lru.get(name, hsh)
+            if r is not None:
+                return r
+
         r = read_hash(hsh)
         if r is not None:
             if not isinstance(r, tuple) or (isinstance(r, tuple) and r[0] != "ke"):
+                if memory_lru is not None:
+                    memory_lru.put(name, hsh, r)
                 return r
 
         if r is None:
@@ -146,8 +328,98 @@ def persistent_caching_fn(fn, name, check_cache_exists=False, cache_dir=None,
         r = fn(*args, **kwargs)  # r is not None and there was key-error so we need to calculate the key and put in cache
         cache_stats[name]["compute"] += 1
         write_hsh(hsh, r, kes)
+        if memory_lru is not None:
+            memory_lru.put(name, hsh, r)
         return r
 
+    missing = object()
+
+    def get_many(hashes: List[str]):
+        results = [None] * len(hashes)
+        pending = list(range(len(hashes)))
+        ts = time.time()
+        for cache in caches:
+            if len(pending) == 0:
+                break
+            still_pending = []
+            for retry in range(retries):
+                try:
+                    with cache.transact():
+                        values = [cache.get(hashes[i], default=missing, retry=True) for i in pending]
+                    break
+                except Exception as e:
+                    values = [missing] * len(pending)
+                    cache_stats[name]["read_exception"] += 1
+                    cache_stats[name]["read_retries"] += 1
+                    sleep(wait_time * (retry + 1) + random() * random_time)
+            for i, v in zip(pending, values):
+                if v is missing:
+                    still_pending.append(i)
+                else:
+                    results[i] = v
+            pending = still_pending
+        cache_stats[name]["hit"] += len(hashes) - len(pending)
+        cache_stats[name]["key_error"] += len(pending)
+        cache_stats[name]["read_many_time"] = 0.9 * cache_stats[name]["read_many_time"] + 0.1 * (time.time() - ts)
+        return results
+
+    def put_many(kv_pairs):
+        if not cache_allow_writes or len(kv_pairs) == 0:
+            return
+        ts = time.time()
+        for retry in range(retries):
+            try:
+                with caches[0].transact():
+                    for hsh, r in kv_pairs:
+                        caches[0].set(hsh, r, retry=True)
+                cache_stats[name]["writes"] += len(kv_pairs)
+                cache_stats[name]["write_many_time"] = 0.9 * cache_stats[name]["write_many_time"] + 0.1 * (time.time() - ts)
+                return
+            except Exception as e:
+                cache_stats[name]["write_exception"] += 1
+                cache_stats[name]["write_retries"] += 1
+                sleep(wait_time * (retry + 1) + random() * random_time)
+
+    def compute_missing(items: List, ignore_cache: List[bool] = None):
+        ignore_cache = ([False] * len(items)) if ignore_cache is None else ignore_cache
+        cache_stats[name]["called"] += len(items)
+        results = [None] * len(items)
+        hashes = [None] * len(items)
+        lookups = []
+        for i, (item, ic) in enumerate(zip(items, ignore_cache)):
+            if ic:
+                continue
+            hashes[i] = build_hash(item)
+            r = memory_lru.get(name, hashes[i]) if memory_lru is not None else None
+            if r is None:
+                lookups.append(i)
+            else:
+                results[i] = r
+
+        if len(lookups) > 0:
+            for i, r in zip(lookups, get_many([hashes[i] for i in lookups])):
+                if r is not None:
+                    results[i] = r
+                    if memory_lru is not None:
+                        memory_lru.put(name, hashes[i], r)
+
+        misses = [i for i, r in enumerate(results) if r is None]
+        if len(misses) > 0:
+            computed = batch_fn([items[i] for i in misses]) if batch_fn is not None else [fn(items[i]) for i in misses]
+            cache_stats[name]["compute"] += len(misses)
+            writes = []
+            for i, r in zip(misses, computed):
+                results[i] = r
+                if not ignore_cache[i]:
+                    writes.append((hashes[i], r))
+                    if memory_lru is not None:
+                        memory_lru.put(name, hashes[i], r)
+            put_many(writes)
+        return results
+
+    cfn.build_hash = build_hash
+    cfn.get_many = get_many
+    cfn.compute_missing = compute_missing
     return cfn
 
 
@@ -172,6 +444,9 @@ class LXMERTFeatureExtractor:
         self.device = device
 
     def __call__(self, url):
+        return self.batch([url])[0]
+
+    def batch(self, urls: List):
         if not hasattr(self.__class__, 'predictor'):
             from detectron2.engine import DefaultPredictor
             predictor = DefaultPredictor(self.cfg)
@@ -186,9 +461,9 @@ class LXMERTFeatureExtractor:
             pass
         if autocast_supported:
             with autocast(enabled=self.do_autocast and get_global("use_autocast")):
-                detectron_features = self.doit(url, self.do_autocast and get_global("use_autocast"))
+                detectron_features = self.doit_batch(urls, self.do_autocast and get_global("use_autocast"))
         else:
-            detectron_features = self.doit(url, False)
+            detectron_features = self.doit_batch(urls, False)
 
         return detectron_features
 
@@ -205,16 +480,21 @@ class LXMERTFeatureExtractor:
         return np.array(Image.open(path).convert('RGB'))[:, :, ::-1]
 
     def doit(self, raw_image, autocasting=False):
-        raw_image = self.get_cv2_image(raw_image)
+        return self.doit_batch([raw_image], autocasting)[0]
+
+    def doit_batch(self, raw_images, autocasting=False):
+        raw_images = [self.get_cv2_image(raw_image) for raw_image in raw_images]
         from detectron2.modeling.postprocessing import detector_postprocess
         from detectron2.modeling.roi_heads.fast_rcnn import FastRCNNOutputs, fast_rcnn_inference_single_image
         predictor = self.predictor
         with torch.no_grad():
             NUM_OBJECTS = 36
-            raw_height, raw_width = raw_image.shape[:2]
-            image = predictor.transform_gen.get_transform(raw_image).apply_image(raw_image)
-            image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
-            inputs = [{"image": image, "height": raw_height, "width": raw_width}]
+            inputs = []
+            for raw_image in raw_images:
+                raw_height, raw_width = raw_image.shape[:2]
+                image = predictor.transform_gen.get_transform(raw_image).apply_image(raw_image)
+                image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+                inputs.append({"image": image, "height": raw_height, "width": raw_width})
             images = predictor.model.preprocess_image(inputs)
 
             # Run Backbone Res1-Res4
@@ -222,7 +502,6 @@ class LXMERTFeatureExtractor:
 
             # Generate proposals with RPN
             proposals, _ = predictor.model.proposal_generator(images, features, None)
-            proposal = proposals[0]
             proposal_boxes = [x.proposal_boxes for x in proposals]
             features = [features[f] for f in predictor.model.roi_heads.in_features]
             if autocasting:
@@ -246,8 +525,8 @@ class LXMERTFeatureExtractor:
                 proposals,
                 predictor.model.roi_heads.smooth_l1_beta,
             )
-            probs = outputs.predict_probs()[0]
-            boxes = outputs.predict_boxes()[0]
+            probs_list = outputs.predict_probs()
+            boxes_list = outputs.predict_boxes()
 
             # probs = predictor.model.roi_heads.box_predictor.predict_probs((pred_class_logits, pred_proposal_deltas,), proposals)[0]
             # boxes = predictor.model.roi_heads.box_predictor.predict_boxes((pred_class_logits, pred_proposal_deltas,), proposals)[0]
@@ -255,26 +534,33 @@ class LXMERTFeatureExtractor:
             attr_prob = pred_attr_logits[..., :-1].softmax(-1)
             max_attr_prob, max_attr_label = attr_prob.max(-1)
 
-            # Note: BUTD uses raw RoI predictions,
-            #       we use the predicted boxes instead.
-            # boxes = proposal_boxes[0].tensor
-
-            # NMS
-            for nms_thresh in np.arange(0.5, 1.0, 0.1):
-                instances, ids = fast_rcnn_inference_single_image(
-                    boxes, probs, image.shape[1:],
-                    score_thresh=0.2, nms_thresh=nms_thresh, topk_per_image=NUM_OBJECTS
-                )
-                if len(ids) == NUM_OBJECTS:
-                    break
-
-            instances = detector_postprocess(instances, raw_height, raw_width)
-            roi_features = feature_pooled[ids].detach()
-            max_attr_prob = max_attr_prob[ids].detach()
-            max_attr_label = max_attr_label[ids].detach()
-            instances.attr_scores = max_attr_prob
-            instances.attr_classes = max_attr_label
-            return instances, roi_features
+            # Proposals of all images are concatenated, split them back per image
+            n_proposals = [len(p) for p in proposals]
+            feature_pooled = feature_pooled.split(n_proposals)
+            max_attr_prob = max_attr_prob.split(n_proposals)
+            max_attr_label = max_attr_label.split(n_proposals)
+
+            results = []
+            for i, inp in enumerate(inputs):
+                # Note: BUTD uses raw RoI predictions,
+                #       we use the predicted boxes instead.
+                # boxes = proposal_boxes[0].tensor
+
+                # NMS
+                for nms_thresh in np.arange(0.5, 1.0, 0.1):
+                    instances, ids = fast_rcnn_inference_single_image(
+                        boxes_list[i], probs_list[i], inp["image"].shape[1:],
+                        score_thresh=0.2, nms_thresh=nms_thresh, topk_per_image=NUM_OBJECTS
+                    )
+                    if len(ids) == NUM_OBJECTS:
+                        break
+
+                instances = detector_postprocess(instances, inp["height"], inp["width"])
+                roi_features = feature_pooled[i][ids].detach()
+                instances.attr_scores = max_attr_prob[i][ids].detach()
+                instances.attr_classes = max_attr_label[i][ids].detach()
+                results.append((instances, roi_features))
+            return results
 
 
 class FeatureExtractor:
@@ -299,6 +585,13 @@ class FeatureExtractor:
 
         return detectron_features
 
+    def batch(self, urls: List):
+        if not hasattr(self.__class__, 'detection_model'):
+            detection_model = self._build_detection_model()
+            setattr(self.__class__, "detection_model", detection_model)
+        with torch.no_grad():
+            return self.get_batch_detectron_features(urls)
+
     def _build_detection_model(self):
         from maskrcnn_benchmark.utils.model_serialization import load_state_dict
         from maskrcnn_benchmark.modeling.detector import build_detection_model
@@ -319,6 +612,11 @@ class FeatureExtractor:
         return model
 
     def get_pil_image(self, image_path):
+        # Pre-resized 800 short side copy skips the full decode + resize in _image_transform
+        pyramid = get_image_pyramid()
+        resized = pyramid.load(image_path, 800) if pyramid is not None else None
+        if resized is not None:
+            return resized
         if "PIL" in str(type(image_path)):
             return image_path.convert('RGB')
         elif image_path.startswith('http'):
@@ -413,10 +711,14 @@ class FeatureExtractor:
         return feat_list, info_list
 
     def get_detectron_features(self, image_path):
+        return self.get_batch_detectron_features([image_path])[0]
+
+    def get_batch_detectron_features(self, image_paths):
         from maskrcnn_benchmark.structures.image_list import to_image_list
-        _ = gc.collect()
-        im, im_scale, im_info = self._image_transform(image_path)
-        img_tensor, im_scales = [im], [im_scale]
+        from . import maybe_clean_memory
+        maybe_clean_memory()
+        transformed = [self._image_transform(image_path) for image_path in image_paths]
+        img_tensor, im_scales, im_infos = [t[0] for t in transformed], [t[1] for t in transformed], [t[2] for t in transformed]
         current_img_list = to_image_list(img_tensor, size_divisible=32)
         current_img_list = current_img_list.to(self.device)
         with torch.no_grad():
@@ -432,8 +734,8 @@ class FeatureExtractor:
                     output = self.detection_model(current_img_list)
             else:
                 output = self.detection_model(current_img_list)
-        feat_list, info_list = self._process_feature_extraction_v2(output, im_scales, [im_info], 'fc6')
-        return feat_list[0], info_list[0]
+        feat_list, info_list = self._process_feature_extraction_v2(output, im_scales, im_infos, 'fc6')
+        return list(zip(feat_list, info_list))
         # return {"image_feature": feat_list[0], "image_info": info_list[0]}
 
 
@@ -477,6 +779,31 @@ class ImageCaptionFeatures:
                 em = encoder(att_feats, att_masks)
                 return em
 
+    def batch(self, images: List):
+        if not hasattr(self.__class__, "model"):
+            model = self.build_model(self.enable_image_captions)
+            setattr(self.__class__, "model", model)
+
+        att_embed = self.model["att_embed"]
+        encoder = self.model["encoder"]
+        get_img_details = getattr(self.get_img_details, "compute_missing", None)
+        details = get_img_details(images) if get_img_details is not None else [self.get_img_details(i) for i in images]
+        use_autocast = False
+        try:
+            from torch.cuda.amp import autocast
+            use_autocast = "cuda" in str(self.device)
+        except:
+            pass
+        use_autocast = use_autocast and get_global("use_autocast")
+        with torch.no_grad():
+            with (autocast(enabled=False) if use_autocast else contextlib.nullcontext()):
+                img_feature = torch.stack([d[0] for d in details], 0).to(self.device)
+                att_feats = att_embed(img_feature)
+                att_masks = att_feats.new_ones(att_feats.shape[:2], dtype=torch.long)
+                att_masks = att_masks.unsqueeze(-2)
+                em = encoder(att_feats, att_masks)
+                return list(em.unsqueeze(1))
+
     def generate_captions(self, image):
         if not hasattr(self.__class__, "model"):
             model = self.build_model(self.enable_image_captions)
@@ -524,10 +851,8 @@ def get_image_info_fn(enable_encoder_feats=False,
         kwargs["device"] = device
 
     def clean_memory():
-        _ = gc.collect()
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        _ = gc.collect()
+        from . import maybe_clean_memory
+        maybe_clean_memory()
 
     feature_extractor = FeatureExtractor(**kwargs)
     lxmert_feature_extractor = LXMERTFeatureExtractor(device)
@@ -540,20 +865,35 @@ def get_image_info_fn(enable_encoder_feats=False,
         feats = lxmert_feature_extractor(impath)
         return feats
 
-    get_lxmert_details = persistent_caching_fn(get_lxmert_details, "get_lxmert_details")
+    get_lxmert_details = persistent_caching_fn(get_lxmert_details, "get_lxmert_details", batch_fn=lxmert_feature_extractor.batch)
 
-    get_img_details = persistent_caching_fn(get_img_details, "get_img_details")
+    get_img_details = persistent_caching_fn(get_img_details, "get_img_details", batch_fn=feature_extractor.batch)
 
-    def get_batch_img_roi_features(images):
-        img_feats = [get_img_details(i)[0].squeeze() for i in images]
+    # Precomputed feature packs (see feature_pack.py) take priority over the caches when `feature_pack_dir` global is set
+    fc6_pack = get_feature_pack("faster_rcnn")
+    lxmert_pack = get_feature_pack("lxmert_faster_rcnn")
+    caption_pack = get_feature_pack("caption_features")
+
+    def compute_batch_img_roi_features(images):
+        img_feats = [r[0].squeeze() for r in get_img_details.compute_missing(images)]
         clean_memory()
         return torch.stack(img_feats, 0).to(device)
 
-    def get_batch_lxmert_roi_features(images):
-        img_feats = [get_lxmert_details(i)[1].squeeze() for i in images]
+    def compute_batch_lxmert_roi_features(images):
+        img_feats = [r[1].squeeze() for r in get_lxmert_details.compute_missing(images)]
         clean_memory()
         return torch.stack(img_feats, 0).to(device)
 
+    def get_batch_img_roi_features(images):
+        if fc6_pack is not None:
+            return fc6_pack.gather(images, "features", compute_batch_img_roi_features).to(device)
+        return compute_batch_img_roi_features(images)
+
+    def get_batch_lxmert_roi_features(images):
+        if lxmert_pack is not None:
+            return lxmert_pack.gather(images, "features", compute_batch_lxmert_roi_features).to(device)
+        return compute_batch_lxmert_roi_features(images)
+
 
     get_encoder_feats = None
     get_image_captions = None
@@ -562,18 +902,24 @@ def get_image_info_fn(enable_encoder_feats=False,
 
     if enable_encoder_feats:
         imcm = ImageCaptionFeatures(get_img_details, device, enable_image_captions)
-        get_encoder_feats = persistent_caching_fn(imcm, "get_encoder_feats")
+        get_encoder_feats = persistent_caching_fn(imcm, "get_encoder_feats", batch_fn=imcm.batch)
 
-        def get_batch_encoder_feats(images, ignore_cache: List[bool] = None):
-            ignore_cache = ([False] * len(images)) if ignore_cache is None else ignore_cache
-            img_feats = [get_encoder_feats(i, ignore_cache=ic).squeeze() for i, ic in zip(images, ignore_cache)]
+        def compute_batch_encoder_feats(images, ignore_cache: List[bool] = None):
+            img_feats = [r.squeeze() for r in get_encoder_feats.compute_missing(images, ignore_cache)]
             clean_memory()
             return torch.stack(img_feats, 0).to(device)
 
+        def get_batch_encoder_feats(images, ignore_cache: List[bool] = None):
+            if caption_pack is not None and (ignore_cache is None or not any(ignore_cache)):
+                return caption_pack.gather(images, "features", compute_batch_encoder_feats).to(device)
+            return compute_batch_encoder_feats(images, ignore_cache)
+
         if enable_image_captions:
             def get_image_captions(image_text):
                 return imcm.generate_captions(image_text)
 
+    get_img_details = pack_first(get_img_details, fc6_pack, fc6_value)
+    get_lxmert_details = pack_first(get_lxmert_details, lxmert_pack, lxmert_value)
     return {"get_img_details": get_img_details, "get_encoder_feats": get_encoder_feats,
             "get_image_captions": get_image_captions,
             "feature_extractor": feature_extractor,
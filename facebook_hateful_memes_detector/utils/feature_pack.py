@@ -0,0 +1,257 @@
+import argparse
+import glob
+import json
+import os
+import warnings
+from functools import lru_cache
+from typing import List, Dict, Callable
+
+import numpy as np
+import torch
+
+try:
+    from .globals import get_global, set_global, set_device
+except:
+    from globals import get_global, set_global, set_device
+
+# Feature pack: one memmapped `<name>.<field>.bin` per field, shaped (rows, *field_shape), and `<name>.json` with shapes and key -> row.
+# Keys are image file digests (see build_image_digest_index) so a path and its decoded PIL image resolve to the same row.
+
+
+def pad_rows(array: np.ndarray, shape):
+    if len(shape) == 0 or array.shape == tuple(shape):
+        return array
+    out = np.zeros(shape, dtype=array.dtype)
+    n = min(array.shape[0], shape[0])
+    out[:n] = array[:n]
+    return out
+
+
+def to_numpy(v):
+    if isinstance(v, torch.Tensor):
+        return v.detach().cpu().numpy()
+    return np.asarray(v)
+
+
+class FeaturePackWriter:
+    def __init__(self, directory, name, n_rows, max_rows: Dict[str, int] = None, dtype=np.float32):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.name = name
+        self.n_rows = n_rows
+        self.max_rows = dict() if max_rows is None else max_rows
+        self.dtype = np.dtype(dtype)
+        self.fields = None
+        self.shapes = dict()
+        self.dtypes = dict()
+        self.index = dict()
+
+    def __create__(self, values: Dict):
+        # Shapes come from the first row written, first axis of fields in `max_rows` is padded to that many rows
+        self.fields = dict()
+        for field, v in values.items():
+            v = to_numpy(v)
+            shape = list(v.shape)
+            if field in self.max_rows:
+                shape[0] = self.max_rows[field]
+            dtype = self.dtype if np.issubdtype(v.dtype, np.floating) else v.dtype
+            self.shapes[field] = shape
+            self.dtypes[field] = dtype.str
+            path = os.path.join(self.directory, "%s.%s.bin" % (self.name, field))
+            self.fields[field] = np.memmap(path, dtype=dtype, mode="w+", shape=tuple([self.n_rows] + shape))
+
+    def write(self, key, values: Dict):
+        if self.fields is None:
+            self.__create__(values)
+        if key in self.index:
+            return self.index[key]
+        row = len(self.index)
+        assert row < self.n_rows
+        for field, v in values.items():
+            self.fields[field][row] = pad_rows(to_numpy(v), self.shapes[field])
+        self.index[key] = row
+        return row
+
+    def close(self):
+        if self.fields is not None:
+            for f in self.fields.values():
+                f.flush()
+        meta = dict(name=self.name, n_rows=self.n_rows, shapes=self.shapes, dtypes=self.dtypes, index=self.index)
+        tmp = os.path.join(self.directory, "%s.json.tmp" % self.name)
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(self.directory, "%s.json" % self.name))
+
+
+class FeaturePack:
+    def __init__(self, directory, name):
+        with open(os.path.join(directory, "%s.json" % name)) as f:
+            meta = json.load(f)
+        self.name = name
+        self.index = meta["index"]
+        self.shapes = meta["shapes"]
+        self.fields = {field: np.memmap(os.path.join(directory, "%s.%s.bin" % (name, field)), dtype=np.dtype(meta["dtypes"][field]), mode="r",
+                                        shape=tuple([meta["n_rows"]] + shape)) for field, shape in meta["shapes"].items()}
+
+    def __len__(self):
+        return len(self.index)
+
+    def row(self, image):
+        from .detectron_v1_object_detector import image_digest
+        digest = image_digest(image)
+        return self.index.get(digest) if digest is not None else None
+
+    def get(self, image, field=None):
+        """Zero-copy read-only views for one image, dict of all fields if `field` is None, None if the image is not in the pack."""
+        row = self.row(image)
+        if row is None:
+            return None
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            if field is not None:
+                return torch.from_numpy(self.fields[field][row])
+            return {f: torch.from_numpy(v[row]) for f, v in self.fields.items()}
+
+    def gather(self, images: List, field, fallback: Callable):
+        """Stacked `field` for all images in one memmap gather, images missing from the pack are computed by `fallback(missing_images)`."""
+        rows = [self.row(i) for i in images]
+        found = [i for i, r in enumerate(rows) if r is not None]
+        missing = [i for i, r in enumerate(rows) if r is None]
+        if len(missing) == 0:
+            out = torch.from_numpy(self.fields[field][rows])
+            return out.float() if out.dtype == torch.float16 else out
+        computed = fallback([images[i] for i in missing])
+        if len(found) == 0:
+            return computed
+        out = torch.empty((len(images),) + tuple(computed.shape[1:]), dtype=computed.dtype, device=computed.device)
+        out[found] = torch.from_numpy(self.fields[field][[rows[i] for i in found]]).to(computed.device, computed.dtype)
+        out[missing] = computed
+        return out
+
+
+@lru_cache(maxsize=None)
+def load_feature_pack(directory, name):
+    if not os.path.exists(os.path.join(directory, "%s.json" % name)):
+        return None
+    return FeaturePack(directory, name)
+
+
+def get_feature_pack(name):
+    try:
+        directory = get_global("feature_pack_dir")
+    except:
+        return None
+    return load_feature_pack(directory, name)
+
+
+def pack_first(fn, pack, to_value):
+    """Single image lookups served from `pack` when present, `fn` (a persistent_caching_fn) otherwise."""
+    if pack is None:
+        return fn
+
+    def pfn(image, **kwargs):
+        fields = pack.get(image)
+        if fields is None:
+            return fn(image, **kwargs)
+        return to_value(fields)
+
+    for attr in ["build_hash", "get_many", "compute_missing"]:
+        if hasattr(fn, attr):
+            setattr(pfn, attr, getattr(fn, attr))
+    return pfn
+
+
+# Per box Instances fields written next to `boxes`, older packs without them restore boxes only
+LXMERT_INSTANCE_FIELDS = ["scores", "pred_classes", "attr_scores", "attr_classes"]
+
+
+def writable(t: torch.Tensor):
+    # Pack rows are read-only memmap views, callers such as bbox_aug write into what they get
+    return t.float() if t.dtype == torch.float16 else t.clone()
+
+
+def fc6_value(fields):
+    # Same (features, info) structure as FeatureExtractor, as private writable copies of the pack rows
+    info = dict(bbox=writable(fields["bbox"]).numpy(), cls_prob=writable(fields["cls_prob"]).numpy(), image_width=int(fields["image_width"]),
+                image_height=int(fields["image_height"]), max_features=int(fields["max_features"]))
+    return writable(fields["features"]), info
+
+
+def lxmert_value(fields):
+    from detectron2.structures import Instances, Boxes
+    n = int(fields["n_boxes"])
+    instances = Instances((int(fields["image_height"]), int(fields["image_width"])))
+    instances.pred_boxes = Boxes(writable(fields["boxes"][:n]))
+    for field in LXMERT_INSTANCE_FIELDS:
+        if "instances_%s" % field in fields:
+            instances.set(field, writable(fields["instances_%s" % field][:n]))
+    return instances, writable(fields["features"][:n])
+
+
+def fc6_fields(r):
+    feat, info = r
+    return dict(features=feat, bbox=info["bbox"], cls_prob=info["cls_prob"], image_width=np.array(info["image_width"]),
+                image_height=np.array(info["image_height"]), max_features=np.array(info["max_features"]))
+
+
+def lxmert_fields(r):
+    instances, feats = r
+    fields = dict(features=feats, boxes=instances.pred_boxes.tensor, n_boxes=np.array(len(feats)),
+                  image_width=np.array(instances.image_size[1]), image_height=np.array(instances.image_size[0]))
+    for field in LXMERT_INSTANCE_FIELDS:
+        if instances.has(field):
+            fields["instances_%s" % field] = instances.get(field)
+    return fields
+
+
+def build(image_paths: List, out_dir, extractors: List[str], batch_size, device, dtype):
+    from tqdm.auto import tqdm
+    from more_itertools import chunked
+    from .detectron_v1_object_detector import get_image_info_fn, build_image_digest_index, image_digest
+    index = build_image_digest_index(image_paths)
+    digests = dict()
+    for p in image_paths:
+        digests.setdefault(index[p], p)
+    # One row per unique file content
+    image_paths = list(digests.values())
+    needs_encoder = "caption_features" in extractors
+    info_fns = get_image_info_fn(enable_encoder_feats=needs_encoder, device=device) if any([e in ["faster_rcnn", "lxmert_faster_rcnn", "caption_features"] for e in extractors]) else None
+    for extractor in extractors:
+        if extractor == "faster_rcnn":
+            fn, to_fields, max_rows = info_fns["get_img_details"].compute_missing, fc6_fields, dict(features=100, bbox=100, cls_prob=100)
+        elif extractor == "lxmert_faster_rcnn":
+            fn, to_fields, max_rows = info_fns["get_lxmert_details"].compute_missing, lxmert_fields, dict(features=36, boxes=36, **{"instances_%s" % f: 36 for f in LXMERT_INSTANCE_FIELDS})
+        elif extractor == "caption_features":
+            fn, to_fields, max_rows = info_fns["get_encoder_feats"].compute_missing, lambda r: dict(features=r.squeeze(0)), dict()
+        elif "detr" in extractor:
+            from ..models.external.detr import get_detr_model
+            detr_fn = get_detr_model(device, extractor)["batch_detr_fn"]
+            fn, to_fields, max_rows = lambda images: list(detr_fn(images)), lambda r: dict(features=r), dict()
+        else:
+            raise NotImplementedError(extractor)
+        writer = FeaturePackWriter(out_dir, extractor, len(image_paths), max_rows, dtype)
+        for batch in tqdm(list(chunked(image_paths, batch_size)), "Building %s pack" % extractor):
+            for p, r in zip(batch, fn(batch)):
+                writer.write(image_digest(p), to_fields(r))
+        writer.close()
+        print(extractor, ": Wrote %s rows to %s" % (len(writer.index), out_dir))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute memory-mapped feature packs. Use them in training with set_global('feature_pack_dir', out_dir)")
+    parser.add_argument("--image_dir", required=True)
+    parser.add_argument("--out_dir", required=True)
+    parser.add_argument("--cache_dir", default=None, help="diskcache dir, features already cached there are not recomputed")
+    parser.add_argument("--extractors", nargs="+", default=["faster_rcnn", "lxmert_faster_rcnn", "caption_features", "detr_resnet101"])
+    parser.add_argument("--image_extension", default=".png")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--fp16", action="store_true")
+    a = parser.parse_args()
+    os.makedirs(a.out_dir, exist_ok=True)
+    device = torch.device(a.device)
+    set_device(device)
+    set_global("use_autocast", False)
+    set_global("cache_dir", a.cache_dir if a.cache_dir is not None else os.path.join(a.out_dir, "cache"))
+    paths = sorted(glob.glob(os.path.join(a.image_dir, "**", "*" + a.image_extension), recursive=True))
+    build(paths, a.out_dir, a.extractors, a.batch_size, device, np.float16 if a.fp16 else np.float32)
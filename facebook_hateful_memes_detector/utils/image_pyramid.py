@@ -0,0 +1,98 @@
+import argparse
+import glob
+import os
+from functools import lru_cache
+from typing import List
+
+from PIL import Image
+
+try:
+    from .globals import get_global
+except:
+    from globals import get_global
+
+# Canonical resolutions used by the models
+# 224: torchvision classification models (get_image2torchvision_transforms)
+# 360/480: DETR `im_size` square resize
+# 800: detectron FeatureExtractor, short side 800 with long side capped at 1333
+LEVELS = {224: ("square", 224), 360: ("square", 360), 480: ("square", 480), 800: ("short_side", 800, 1333)}
+
+
+def resize_to_level(image: Image.Image, level):
+    spec = LEVELS[level]
+    if spec[0] == "square":
+        return image.resize((spec[1], spec[1]), Image.BILINEAR)
+    w, h = image.size
+    scale = spec[1] / min(w, h)
+    if round(scale * max(w, h)) > spec[2]:
+        scale = spec[2] / max(w, h)
+    return image.resize((int(round(w * scale)), int(round(h * scale))), Image.BILINEAR)
+
+
+class ImagePyramid:
+    """Pre-resized copies of each source image under `directory/<level>/<file digest>.<ext>`."""
+    def __init__(self, directory, image_format="jpg", quality=95):
+        self.directory = directory
+        self.image_format = image_format
+        self.quality = quality
+
+    def path(self, digest, level):
+        return os.path.join(self.directory, str(level), "%s.%s" % (digest, self.image_format))
+
+    def load(self, image, level):
+        """`image` is a path or a digest tagged PIL image, returns None when the level is not available for it."""
+        from .detectron_v1_object_detector import image_digest
+        if level not in LEVELS:
+            return None
+        digest = image_digest(image)
+        if digest is None:
+            return None
+        p = self.path(digest, level)
+        if not os.path.exists(p):
+            return None
+        return Image.open(p).convert('RGB')
+
+    def build(self, paths: List[str], levels=tuple(LEVELS.keys())):
+        from tqdm.auto import tqdm
+        from .detectron_v1_object_detector import build_image_digest_index
+        index = build_image_digest_index(paths)
+        for level in levels:
+            os.makedirs(os.path.join(self.directory, str(level)), exist_ok=True)
+        for p in tqdm(sorted(set(paths)), "Building image pyramid"):
+            if p not in index:
+                continue
+            targets = [(level, self.path(index[p], level)) for level in levels]
+            targets = [(level, t) for level, t in targets if not os.path.exists(t)]
+            if len(targets) == 0:
+                continue
+            im = Image.open(p).convert('RGB')
+            for level, t in targets:
+                out = resize_to_level(im, level)
+                if self.image_format == "jpg":
+                    out.save(t, "JPEG", quality=self.quality)
+                else:
+                    out.save(t)
+
+
+@lru_cache(maxsize=None)
+def load_image_pyramid(directory):
+    return ImagePyramid(directory)
+
+
+def get_image_pyramid():
+    try:
+        directory = get_global("image_pyramid_dir")
+    except:
+        return None
+    return load_image_pyramid(directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write each image once at the model resolutions. Use with set_global('image_pyramid_dir', out_dir)")
+    parser.add_argument("--image_dir", required=True)
+    parser.add_argument("--out_dir", required=True)
+    parser.add_argument("--image_extension", default=".png")
+    parser.add_argument("--levels", type=int, nargs="+", default=list(LEVELS.keys()))
+    a = parser.parse_args()
+    paths = sorted(glob.glob(os.path.join(a.image_dir, "**", "*" + a.image_extension), recursive=True))
+    ImagePyramid(a.out_dir).build(paths, a.levels)
@@ -3,6 +3,7 @@ monkey.patch_all()
 from flask import Flask
 from flask import request
 from flask import json
+from flask import Response
 app = Flask(__name__)
 from gevent import monkey
 monkey.patch_all()
@@ -15,6 +16,8 @@ import sys
 import zerorpc
 from gevent.pywsgi import WSGIServer
 from gevent.pool import Pool
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from codec import pack_frames, unpack_frames, encode
 
 cache_dir = os.path.join(os.getcwd(), 'cache')
 if os.path.exists(cache_dir):
@@ -70,6 +73,28 @@ def setfn():
     return {"result": proxy.set(data)}
 
 
+@app.route('/get_bin', methods=['POST'])
+def get_bin():
+    data = request.get_json()
+    values = dict()
+    for k, v in proxy.get(data).items():
+        if v is None or isinstance(v, (bytes, bytearray, memoryview)):
+            values[k] = v
+            continue
+        # Stored through the json `set` endpoint, sent as a codec structure
+        try:
+            values[k] = encode(v)
+        except TypeError as e:
+            return Response("Value for %s can not be sent as binary: %s" % (k, e), status=400)
+    return Response(pack_frames(values), mimetype='application/octet-stream')
+
+
+@app.route('/set_bin', methods=['POST'])
+def set_bin():
+    data = {k: bytes(v) for k, v in unpack_frames(request.get_data()).items()}
+    return {"result": proxy.set(data)}
+
+
 def start_server(port):
     assert type(port) == int
     try:
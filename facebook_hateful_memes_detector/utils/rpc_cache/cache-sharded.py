@@ -0,0 +1,81 @@
+import argparse
+import os
+import sys
+import time
+import multiprocessing
+
+args = dict(eviction_policy='none', sqlite_cache_size=2**16, sqlite_mmap_size=2**34, disk_min_file_size=2**18)
+
+
+def serve_shard(port, shard_dir, pool_size):
+    # Patch inside the child, each shard gets its own process, hub and sqlite writer
+    from gevent import monkey
+    monkey.patch_all()
+    from diskcache import Cache
+    import zerorpc
+
+    class CacheProxy:
+        def __init__(self, cache):
+            super().__init__()
+            self.cache = cache
+
+        def get(self, keys):
+            if type(keys) == str:
+                keys = [keys]
+
+            values = {key: self.cache[key] if key in self.cache else None for key in keys}
+            return values
+
+        def set(self, kv_pairs):
+            assert type(kv_pairs) == dict
+            with self.cache.transact():
+                for k, v in kv_pairs.items():
+                    self.cache[k] = v
+            return True
+
+    server = None
+    try:
+        server = zerorpc.Server(CacheProxy(Cache(shard_dir, **args)), heartbeat=None, pool_size=pool_size)
+        server.bind("tcp://0.0.0.0:%s" % port)
+        print("Shard %s serving %s" % (port, shard_dir))
+        server.run()
+    except Exception as e:
+        print(e)
+    finally:
+        if server is not None:
+            server.close()
+        print("Closed Shard %s" % port)
+
+
+def launch(n_shards, port_start, cache_dir, pool_size):
+    ctx = multiprocessing.get_context("spawn")
+    processes = []
+    for i in range(n_shards):
+        shard_dir = os.path.join(cache_dir, "shard_%s" % i)
+        os.makedirs(shard_dir, exist_ok=True)
+        p = ctx.Process(target=serve_shard, args=(port_start + i, shard_dir, pool_size), name="cache_shard_%s" % i)
+        p.start()
+        processes.append(p)
+    return processes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Start K zerorpc cache servers, each owning one diskcache shard. Pair with ShardedRpcCacheClient.")
+    parser.add_argument("--shards", type=int, default=os.cpu_count())
+    parser.add_argument("--port_start", type=int, default=4242)
+    parser.add_argument("--cache_dir", default=os.path.join(os.getcwd(), 'cache'))
+    parser.add_argument("--pool_size", type=int, default=256)
+    a = parser.parse_args()
+    print(a)
+    # Shard count is part of the key -> shard mapping, reusing a cache_dir with a different count misses existing keys
+    processes = launch(a.shards, a.port_start, a.cache_dir, a.pool_size)
+    try:
+        while all([p.is_alive() for p in processes]):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in processes:
+            p.terminate()
+            p.join()
+        print("Closed Servers")
@@ -1,10 +1,14 @@
-
 import collections
 import logging
 import contextlib
 import gevent
 from gevent import Greenlet
 import threading
+import time
+import hashlib
+import bisect
+import argparse
+import numpy as np
 from threading import current_thread
 # from gevent import monkey
 # monkey.patch_all()
@@ -18,6 +22,10 @@ import random
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from threading import Lock
 import requests
+try:
+    from .codec import encode_batch, decode_batch, pack_frames, unpack_frames
+except:
+    from codec import encode_batch, decode_batch, pack_frames, unpack_frames
 # https://github.com/coleifer/greendb
 
 
@@ -26,61 +34,141 @@ def htime():
 
 
 class RpcCacheClient:
-    def __init__(self, server, zrpc_port, mprpc_port, http_port, pool_size=1):
+    def __init__(self, server, zrpc_port, mprpc_port, http_port, pool_size=1, in_flight=4, chunk_size=16, timeout=30, retries=2,
+                 encode_values=False, compression=None, fp16=False):
         self.server = server
         self.zrpc_port = zrpc_port
         self.mprpc_port = mprpc_port
         self.http_port = http_port
         self.pool = ThreadPoolExecutor(pool_size, thread_name_prefix='cache_')
         self.pool_size = pool_size
+        self.in_flight = in_flight
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.retries = retries
+        # Values go over the wire as codec bytes (dtype/shape header + raw buffer), servers store them as opaque blobs
+        self.encode_values = encode_values
+        self.compression = compression
+        self.fp16 = fp16
+        self.local = threading.local()
+        self.connections = []
+        self.lock = Lock()
 
     def __getitem__(self, item):
         assert type(item) == str
-        return self.__exec__("get", item)
+        return self.__decode__(self.__exec_zrpc__(("get", [item])))[item]
 
     def __setitem__(self, key, value):
         assert type(key) == str
-        return self.__exec__("set", key, value)
+        return self.__exec_zrpc__(("set", self.__encode__({key: value})))
 
-    def __exec_mprpc__(self, args):
-        from mprpc import RPCClient, RPCPoolClient
+    def __encode__(self, item_dict: Dict):
+        return encode_batch(item_dict, self.compression, self.fp16) if self.encode_values else item_dict
 
-        method = args[0]
-        args = args[1]
-        assert method in ["get", "set"]
+    def __decode__(self, item_dict: Dict):
+        return decode_batch(item_dict) if self.encode_values else item_dict
+
+    def __track__(self, client):
+        with self.lock:
+            self.connections.append(client)
+        return client
+
+    def __untrack__(self, client):
+        with self.lock:
+            if client in self.connections:
+                self.connections.remove(client)
         try:
-            client = RPCClient(self.server, self.mprpc_port)
-            result = client.call(method, args)
             client.close()
-            return result
+        except:
+            pass
+
+    def __zrpc_client__(self, reconnect=False):
+        client = getattr(self.local, "zrpc", None)
+        if client is not None and reconnect:
+            self.__untrack__(client)
+            client = None
+        if client is None:
+            client = zerorpc.Client(heartbeat=None, timeout=self.timeout)
+            client.connect("tcp://%s:%s" % (self.server, self.zrpc_port))
+            self.local.zrpc = self.__track__(client)
+        return client
+
+    def __mprpc_client__(self, reconnect=False):
+        from mprpc import RPCClient
+        client = getattr(self.local, "mprpc", None)
+        if client is not None and (reconnect or not client.is_connected()):
+            self.__untrack__(client)
+            client = None
+        if client is None:
+            client = RPCClient(self.server, self.mprpc_port, timeout=self.timeout)
+            self.local.mprpc = self.__track__(client)
+        return client
+
+    def health_check(self):
+        # A get on an empty key list is a cheap round trip on all three servers
+        try:
+            return self.__zrpc_client__().get([]) == {}
         except Exception as e:
             print(e)
+            return False
+
+    def __exec_mprpc__(self, args):
+        method = args[0]
+        args = args[1]
+        assert method in ["get", "set"]
+        for attempt in range(self.retries + 1):
             try:
-                client.close()
-            except:
-                pass
+                client = self.__mprpc_client__(reconnect=attempt > 0)
+                return client.call(method, args)
+            except Exception as e:
+                print(e)
 
     def __exec_zrpc__(self, args):
         method = args[0]
         args = args[1]
         assert method in ["get", "set"]
-        try:
-            client = zerorpc.Client(heartbeat=None)
-            client.connect("tcp://%s:%s" % (self.server, self.zrpc_port))
-            result = client.get(args) if method == "get" else client.set(args)
-            client.close()
-            return result
-        except Exception as e:
-            print(e)
+        for attempt in range(self.retries + 1):
             try:
-                client.close()
-            except:
-                pass
+                client = self.__zrpc_client__(reconnect=attempt > 0)
+                return client.get(args) if method == "get" else client.set(args)
+            except Exception as e:
+                print(e)
+
+    def __exec_pipelined_zrpc__(self, args):
+        # Keeps up to `in_flight` requests outstanding on this thread's connection, chunks which fail are retried on a fresh one
+        method, batches = args
+        assert method in ["get", "set"]
+        results = [None] * len(batches)
+        pending = list(range(len(batches)))
+        for attempt in range(self.retries + 1):
+            if len(pending) == 0:
+                break
+            failed = []
+            try:
+                client = self.__zrpc_client__(reconnect=attempt > 0)
+            except Exception as e:
+                print(e)
+                continue
+            for window in chunked(pending, self.in_flight):
+                futures = [(i, getattr(client, method)(batches[i], async_=True)) for i in window]
+                for i, future in futures:
+                    try:
+                        results[i] = future.get()
+                    except Exception as e:
+                        print(e)
+                        failed.append(i)
+            pending = failed
+        return results
 
     def __exec_http__(self, args):
         method = args[0]
         args = args[1]
         assert method in ["get", "set"]
+        if self.encode_values:
+            if method == "get":
+                r = requests.post('http://%s:%s/get_bin' % (self.server, self.http_port), json=list(args))
+                return unpack_frames(r.content)
+            return requests.post('http://%s:%s/set_bin' % (self.server, self.http_port), data=pack_frames(args)).json()["result"]
         return requests.post('http://%s:%s/%s' % (self.server, self.http_port, method), json=args).json()
 
     def __clever_exec__(self, args):
@@ -90,53 +178,133 @@ class RpcCacheClient:
         else:
             return self.__exec_zrpc__(args)
 
+    def __pipelined_map__(self, method, batches):
+        per_thread = max(1, int(np.ceil(len(batches) / self.pool_size)))
+        results = self.pool.map(self.__exec_pipelined_zrpc__, [(method, list(c)) for c in chunked(batches, per_thread)])
+        return [r for rs in results for r in rs]
+
     def get_batch(self, items: List):
-        chunk_size = int(len(items) / self.pool_size)  # 2
-        results = self.pool.map(self.__exec_zrpc__, [("get", c) for c in chunked(items, chunk_size)])
+        if len(items) == 0:
+            return dict()
+        results = self.__pipelined_map__("get", [list(c) for c in chunked(items, self.chunk_size)])
+        assert all([r is not None for r in results])
         results = {k: v for d in results for k, v in d.items()}
-        return results
+        return self.__decode__(results)
 
     def set_batch(self, item_dict: Dict):
-        results = self.pool.map(self.__exec_zrpc__, [("set", dict(c)) for c in chunked(item_dict.items(), 2)])
+        if len(item_dict) == 0:
+            return True
+        item_dict = self.__encode__(item_dict)
+        results = self.__pipelined_map__("set", [dict(c) for c in chunked(item_dict.items(), self.chunk_size)])
         results = all(results)
         assert results
+        return results
 
+    def close(self):
+        with self.lock:
+            connections = list(self.connections)
+            self.connections = []
+        for client in connections:
+            try:
+                client.close()
+            except:
+                pass
+        self.pool.shutdown(wait=True)
 
-if __name__ == "__main__":
-    client = RpcCacheClient('dev-dsk-ahemf-cache-r5-12x-e48a86de.us-west-2.amazon.com', 4242, 6000, 5000, 32)
-    import time
-    kl = list(map(str, range(32)))
-    kl2 = kl + kl
-    kl4 = kl2 + kl2
-    kl8 = kl4 + kl4
-    kl16 = kl8 + kl8
 
-    iters = 5
-    s = time.time()
-    res = all([all([v is not None for v in client.get_batch(kl).values()]) for _ in range(iters)])
-    e = time.time() - s
-    print(len(kl), res, "%.3f" % (e / iters))
+class ConsistentHashRing:
+    def __init__(self, nodes: List, replicas=128):
+        self.nodes = list(nodes)
+        ring = sorted([(self.__key_hash__(str(node) + "#" + str(r)), i) for i, node in enumerate(self.nodes) for r in range(replicas)])
+        self.hashes = [h for h, _ in ring]
+        self.indices = [i for _, i in ring]
 
-    s = time.time()
-    res = all([all([v is not None for v in client.get_batch(kl2).values()]) for _ in range(iters)])
-    e = time.time() - s
-    print(len(kl2), res, "%.3f" % (e / iters))
+    def __key_hash__(self, key):
+        return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
 
-    s = time.time()
-    res = all([all([v is not None for v in client.get_batch(kl4).values()]) for _ in range(iters)])
-    e = time.time() - s
-    print(len(kl4), res, "%.3f" % (e / iters))
+    def __call__(self, key):
+        pos = bisect.bisect(self.hashes, self.__key_hash__(key)) % len(self.hashes)
+        return self.indices[pos]
 
-    s = time.time()
-    res = all([all([v is not None for v in client.get_batch(kl8).values()]) for _ in range(iters)])
-    e = time.time() - s
-    print(len(kl8), res, "%.3f" % (e / iters))
 
-    s = time.time()
-    res = all([all([v is not None for v in client.get_batch(kl16).values()]) for _ in range(iters)])
-    e = time.time() - s
-    print(len(kl16), res, "%.3f" % (e / iters))
+class ShardedRpcCacheClient:
+    """Same get/set interface as RpcCacheClient, keys are routed to one of many servers (see cache-sharded.py) by consistent hashing."""
+    def __init__(self, shards: List, pool_size=1, replicas=128, **kwargs):
+        self.shards = [RpcCacheClient(server, zrpc_port, None, None, pool_size, **kwargs) for server, zrpc_port in shards]
+        self.ring = ConsistentHashRing(["%s:%s" % s for s in shards], replicas)
+        self.pool = ThreadPoolExecutor(len(self.shards), thread_name_prefix='cache_shard_')
 
+    def __getitem__(self, item):
+        return self.shards[self.ring(item)][item]
 
+    def __setitem__(self, key, value):
+        self.shards[self.ring(key)][key] = value
 
+    def __partition__(self, keys):
+        parts = collections.defaultdict(list)
+        for k in keys:
+            parts[self.ring(k)].append(k)
+        return parts
 
+    def get_batch(self, items: List):
+        parts = self.__partition__(items)
+        results = self.pool.map(lambda p: self.shards[p[0]].get_batch(p[1]), parts.items())
+        return {k: v for d in results for k, v in d.items()}
+
+    def set_batch(self, item_dict: Dict):
+        parts = self.__partition__(item_dict.keys())
+        results = self.pool.map(lambda p: self.shards[p[0]].set_batch({k: item_dict[k] for k in p[1]}), parts.items())
+        results = all(results)
+        assert results
+        return results
+
+    def health_check(self):
+        return all([s.health_check() for s in self.shards])
+
+    def close(self):
+        for s in self.shards:
+            s.close()
+        self.pool.shutdown(wait=True)
+
+
+def benchmark(client: RpcCacheClient, n_keys, batch_sizes, iters, value_size):
+    keys = ["bench_%s" % i for i in range(n_keys)]
+    value = "x" * value_size
+    client.set_batch({k: value for k in keys})
+    print("batch_size,p50_ms,p99_ms,keys_per_sec,all_found")
+    for batch_size in batch_sizes:
+        latencies = []
+        found = True
+        for _ in range(iters):
+            batch = random.sample(keys, min(batch_size, n_keys))
+            s = time.perf_counter()
+            res = client.get_batch(batch)
+            latencies.append(time.perf_counter() - s)
+            found = found and all([v is not None for v in res.values()])
+        latencies = np.array(latencies)
+        print("%s,%.3f,%.3f,%.1f,%s" % (batch_size, np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000,
+                                        (batch_size * iters) / latencies.sum(), found))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark RpcCacheClient get_batch against a running cache server")
+    parser.add_argument("--server", default="127.0.0.1")
+    parser.add_argument("--zrpc_port", type=int, default=4242)
+    parser.add_argument("--mprpc_port", type=int, default=6000)
+    parser.add_argument("--http_port", type=int, default=5000)
+    parser.add_argument("--shards", type=int, default=1, help="Number of cache-sharded.py servers on consecutive ports from --zrpc_port")
+    parser.add_argument("--pool_size", type=int, default=8)
+    parser.add_argument("--in_flight", type=int, default=4)
+    parser.add_argument("--chunk_size", type=int, default=16)
+    parser.add_argument("--n_keys", type=int, default=4096)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[32, 64, 128, 256, 512])
+    parser.add_argument("--iters", type=int, default=100)
+    parser.add_argument("--value_size", type=int, default=1024)
+    a = parser.parse_args()
+    if a.shards > 1:
+        client = ShardedRpcCacheClient([(a.server, a.zrpc_port + i) for i in range(a.shards)], a.pool_size, in_flight=a.in_flight, chunk_size=a.chunk_size)
+    else:
+        client = RpcCacheClient(a.server, a.zrpc_port, a.mprpc_port, a.http_port, a.pool_size, in_flight=a.in_flight, chunk_size=a.chunk_size)
+    assert client.health_check(), "Cache server at %s:%s is not reachable" % (a.server, a.zrpc_port)
+    benchmark(client, a.n_keys, a.batch_sizes, a.iters, a.value_size)
+    client.close()
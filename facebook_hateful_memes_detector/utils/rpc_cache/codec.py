@@ -0,0 +1,247 @@
+import struct
+import pickle
+import json
+import time
+import warnings
+import argparse
+import numpy as np
+from typing import Dict, List
+
+# Wire format: MAGIC | kind | compression | stored dtype | original dtype | ndim | shape (uint32 x ndim) | raw buffer
+# Bytes values are MAGIC | kind | compression | 0 0 0 | payload. Structures (dict / list / tuple of arrays, str, numbers, None)
+# are MAGIC | kind | compression | 0 0 0 | json skeleton frame | one frame per encoded array the skeleton refers to.
+# Nothing is ever unpickled, values come from the network.
+MAGIC = b"FHC1"
+HEADER = struct.Struct("<4sBBBBB")
+KIND_NDARRAY, KIND_TENSOR, KIND_BYTES, KIND_STRUCT = 0, 1, 3, 4
+COMPRESSION_NONE, COMPRESSION_LZ4, COMPRESSION_ZSTD = 0, 1, 2
+COMPRESSIONS = {None: COMPRESSION_NONE, "none": COMPRESSION_NONE, "lz4": COMPRESSION_LZ4, "zstd": COMPRESSION_ZSTD}
+DTYPES = [np.dtype(d) for d in ["float32", "float16", "float64", "int64", "int32", "int16", "int8", "uint8", "bool"]]
+DTYPE_CODES = {d: i for i, d in enumerate(DTYPES)}
+FRAME = struct.Struct("<I")
+
+
+def __compress__(buf, compression):
+    if compression == COMPRESSION_LZ4:
+        import lz4.frame
+        return lz4.frame.compress(buf)
+    if compression == COMPRESSION_ZSTD:
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).compress(buf)
+    return buf
+
+
+def __decompress__(buf, compression):
+    if compression == COMPRESSION_LZ4:
+        import lz4.frame
+        return lz4.frame.decompress(buf)
+    if compression == COMPRESSION_ZSTD:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(buf)
+    return buf
+
+
+def is_encoded(buf):
+    return isinstance(buf, (bytes, bytearray, memoryview)) and bytes(buf[:4]) == MAGIC
+
+
+def __skeleton__(value, arrays):
+    # JSON structure with arrays, tensors and bytes replaced by references into `arrays`
+    if isinstance(value, (bytes, bytearray, memoryview, np.ndarray)) or (type(value).__module__.startswith("torch") and hasattr(value, "detach")):
+        arrays.append(value)
+        return {"__value__": len(arrays) - 1}
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    if isinstance(value, tuple):
+        return {"__tuple__": [__skeleton__(v, arrays) for v in value]}
+    if isinstance(value, list):
+        return [__skeleton__(v, arrays) for v in value]
+    if isinstance(value, dict) and all([isinstance(k, str) for k in value.keys()]):
+        if "__value__" in value or "__tuple__" in value:
+            raise TypeError("Reserved key in cache value")
+        return {k: __skeleton__(v, arrays) for k, v in value.items()}
+    raise TypeError("Cache codec can not encode %s, only arrays, tensors, bytes and json structures of them" % type(value))
+
+
+def __restore__(skeleton, values):
+    if isinstance(skeleton, list):
+        return [__restore__(v, values) for v in skeleton]
+    if isinstance(skeleton, dict):
+        if "__value__" in skeleton:
+            return values[skeleton["__value__"]]
+        if "__tuple__" in skeleton:
+            return tuple([__restore__(v, values) for v in skeleton["__tuple__"]])
+        return {k: __restore__(v, values) for k, v in skeleton.items()}
+    return skeleton
+
+
+def encode(value, compression=None, fp16=False) -> bytes:
+    assert compression in COMPRESSIONS
+    code = COMPRESSIONS[compression]
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return HEADER.pack(MAGIC, KIND_BYTES, code, 0, 0, 0) + __compress__(bytes(value), code)
+    kind = KIND_NDARRAY
+    if type(value).__module__.startswith("torch") and hasattr(value, "detach"):
+        kind = KIND_TENSOR
+        value = value.detach().cpu().numpy()
+    if not isinstance(value, np.ndarray):
+        arrays = []
+        skeleton = json.dumps(__skeleton__(value, arrays)).encode("utf-8")
+        frames = [FRAME.pack(len(skeleton)), skeleton]
+        for a in arrays:
+            a = encode(a, compression, fp16)
+            frames += [FRAME.pack(len(a)), a]
+        return HEADER.pack(MAGIC, KIND_STRUCT, code, 0, 0, 0) + b"".join(frames)
+    if value.dtype not in DTYPE_CODES or value.ndim > 255:
+        raise TypeError("Cache codec can not encode %s-d arrays of dtype %s" % (value.ndim, value.dtype))
+
+    original_dtype = value.dtype
+    if fp16 and value.dtype in (np.dtype("float32"), np.dtype("float64")):
+        value = value.astype(np.float16)
+    value = np.ascontiguousarray(value)
+    header = HEADER.pack(MAGIC, kind, code, DTYPE_CODES[value.dtype], DTYPE_CODES[original_dtype], value.ndim)
+    shape = struct.pack("<%sI" % value.ndim, *value.shape)
+    return header + shape + __compress__(value.data if code == COMPRESSION_NONE else value.tobytes(), code)
+
+
+def decode(buf, as_tensor=None, upcast=True):
+    """
+    Uncompressed arrays are returned as read-only views over `buf`, no copy is made.
+    `as_tensor=None` gives back whatever type was encoded, True/False forces torch/numpy.
+    Only array, bytes and structure kinds are decoded, anything else (e.g. pickles from older versions) raises ValueError.
+    """
+    if not is_encoded(buf):
+        return buf
+    buf = memoryview(buf)
+    _, kind, compression, dtype, original_dtype, ndim = HEADER.unpack_from(buf, 0)
+    offset = HEADER.size
+    if kind == KIND_BYTES:
+        return bytes(__decompress__(buf[offset:], compression))
+    if kind == KIND_STRUCT:
+        (length,) = FRAME.unpack_from(buf, offset)
+        offset += FRAME.size
+        skeleton = json.loads(bytes(buf[offset:offset + length]).decode("utf-8"))
+        offset += length
+        values = []
+        while offset < len(buf):
+            (length,) = FRAME.unpack_from(buf, offset)
+            offset += FRAME.size
+            values.append(decode(buf[offset:offset + length], as_tensor, upcast))
+            offset += length
+        return __restore__(skeleton, values)
+    if kind not in (KIND_NDARRAY, KIND_TENSOR) or dtype >= len(DTYPES) or original_dtype >= len(DTYPES):
+        raise ValueError("Unknown cache value kind %s" % kind)
+
+    shape = struct.unpack_from("<%sI" % ndim, buf, offset)
+    offset += 4 * ndim
+    payload = __decompress__(buf[offset:], compression)
+    array = np.frombuffer(payload, dtype=DTYPES[dtype]).reshape(shape)
+    if upcast and dtype != original_dtype:
+        array = array.astype(DTYPES[original_dtype])
+
+    as_tensor = kind == KIND_TENSOR if as_tensor is None else as_tensor
+    if as_tensor:
+        import torch
+        with warnings.catch_warnings():
+            # torch warns on non-writeable arrays, the cache values are never written to in place
+            warnings.simplefilter("ignore")
+            return torch.from_numpy(array)
+    return array
+
+
+def encode_batch(item_dict: Dict, compression=None, fp16=False) -> Dict:
+    return {k: encode(v, compression, fp16) for k, v in item_dict.items()}
+
+
+def __decode_or_miss__(v, as_tensor, upcast):
+    try:
+        return decode(v, as_tensor, upcast)
+    except ValueError:
+        # Values in a kind this codec does not decode are treated as missing and get recomputed
+        return None
+
+
+def decode_batch(item_dict: Dict, as_tensor=None, upcast=True) -> Dict:
+    return {k: None if v is None else __decode_or_miss__(v, as_tensor, upcast) for k, v in item_dict.items()}
+
+
+def pack_frames(item_dict: Dict) -> bytes:
+    """Length prefixed key/value frames, lets the http server move raw bytes without json/base64. Missing values have length 0xFFFFFFFF."""
+    parts = []
+    for k, v in item_dict.items():
+        k = k.encode("utf-8")
+        parts.append(FRAME.pack(len(k)))
+        parts.append(k)
+        if v is None:
+            parts.append(FRAME.pack(0xFFFFFFFF))
+        else:
+            parts.append(FRAME.pack(len(v)))
+            parts.append(v)
+    return b"".join(parts)
+
+
+def unpack_frames(buf) -> Dict:
+    buf = memoryview(buf)
+    offset = 0
+    results = dict()
+    while offset < len(buf):
+        (kl,) = FRAME.unpack_from(buf, offset)
+        offset += FRAME.size
+        k = bytes(buf[offset:offset + kl]).decode("utf-8")
+        offset += kl
+        (vl,) = FRAME.unpack_from(buf, offset)
+        offset += FRAME.size
+        if vl == 0xFFFFFFFF:
+            results[k] = None
+        else:
+            results[k] = buf[offset:offset + vl]
+            offset += vl
+    return results
+
+
+def __time_it__(fn, iters):
+    s = time.perf_counter()
+    for _ in range(iters):
+        r = fn()
+    return (time.perf_counter() - s) / iters * 1000, r
+
+
+def benchmark(shapes: List, iters):
+    import json
+    formats = dict(json=(lambda a: json.dumps(a.tolist()).encode("utf-8"), lambda b: np.array(json.loads(b), dtype=np.float32)),
+                   pickle=(lambda a: pickle.dumps(a, protocol=pickle.HIGHEST_PROTOCOL), pickle.loads))
+    try:
+        import msgpack
+        formats["msgpack"] = (lambda a: msgpack.packb(a.tolist()), lambda b: np.array(msgpack.unpackb(b), dtype=np.float32))
+    except ImportError:
+        print("msgpack not installed, skipping")
+    formats["codec"] = (lambda a: encode(a), lambda b: decode(b))
+    formats["codec_fp16"] = (lambda a: encode(a, fp16=True), lambda b: decode(b))
+    for compression in ["lz4", "zstd"]:
+        try:
+            encode(np.zeros(1, dtype=np.float32), compression=compression)
+        except ImportError:
+            print("%s not installed, skipping" % compression)
+            continue
+        formats["codec_%s" % compression] = (lambda a, c=compression: encode(a, compression=c), lambda b: decode(b))
+        formats["codec_fp16_%s" % compression] = (lambda a, c=compression: encode(a, compression=c, fp16=True), lambda b: decode(b))
+
+    print("shape,format,bytes,encode_ms,decode_ms,max_abs_err")
+    for shape in shapes:
+        # ROI features are post-ReLU activations, mostly small positives with many zeros
+        array = np.maximum(np.random.randn(*shape), 0).astype(np.float32)
+        for name, (enc, dec) in formats.items():
+            encode_ms, buf = __time_it__(lambda: enc(array), iters)
+            decode_ms, out = __time_it__(lambda: dec(buf), iters)
+            err = np.abs(np.asarray(out, dtype=np.float32) - array).max()
+            print("%s,%s,%s,%.3f,%.3f,%.5f" % ("x".join(map(str, shape)), name, len(buf), encode_ms, decode_ms, err))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare wire size and decode time of the cache value codec against json/msgpack/pickle")
+    parser.add_argument("--iters", type=int, default=20)
+    a = parser.parse_args()
+    # detectron fc6 (100x2048) and LXMERT roi features (36x2048)
+    benchmark([(100, 2048), (36, 2048)], a.iters)
@@ -390,3 +390,33 @@ class SampleList(OrderedDict):
                 sample_dict[field] = self[field]
 
         return sample_dict
+
+
+def columnar_collate(samples, pin_memory=False):
+    """Same ``SampleList`` as ``SampleList(samples)``, built a column at a time.
+
+    Every tensor field is stacked with one ``torch.stack`` into a buffer allocated for
+    the whole batch (pinned if ``pin_memory``), other fields stay as lists and
+    mapping fields are collated recursively.
+
+    Args:
+        samples (List[Sample]): Samples to collate, all with the same fields.
+        pin_memory (bool): Allocate tensor fields in page-locked memory. Only useful
+                           in the process that moves the batch to the GPU.
+
+    Returns:
+        SampleList: The collated batch.
+    """
+    columns = OrderedDict()
+    for field in samples[0].keys():
+        values = [sample[field] for sample in samples]
+        first = values[0]
+        if isinstance(first, torch.Tensor):
+            out = torch.empty((len(values), *first.size()), dtype=first.dtype, device=first.device,
+                              pin_memory=pin_memory and first.device.type == "cpu")
+            columns[field] = torch.stack(values, out=out)
+        elif isinstance(first, collections.abc.Mapping):
+            columns[field] = columnar_collate(values, pin_memory)
+        else:
+            columns[field] = values
+    return SampleList(columns)
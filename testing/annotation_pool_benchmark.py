@@ -0,0 +1,44 @@
+import argparse
+import time
+
+from facebook_hateful_memes_detector.utils import set_cpu_as_device
+from facebook_hateful_memes_detector.preprocessing import get_datasets
+from facebook_hateful_memes_detector.preprocessing.annotation_pool import AnnotationPool
+from facebook_hateful_memes_detector.models.text_models import LangFeaturesModel
+
+parser = argparse.ArgumentParser(description="LangFeaturesModel annotation throughput, in process vs AnnotationPool, docs/sec by worker count")
+parser.add_argument('--data_dir', default=None, help="Use train texts from here, synthetic captions if not given")
+parser.add_argument('--capabilities', nargs="+", default=["spacy", "nltk", "snlp"])
+parser.add_argument('--workers', type=int, nargs="+", default=[0, 1, 2, 4, 8])
+parser.add_argument('--n_docs', type=int, default=2000)
+parser.add_argument('--n_tokens_in', type=int, default=64)
+parser.add_argument('--chunk_size', type=int, default=64)
+args = parser.parse_args()
+
+if __name__ == "__main__":
+    set_cpu_as_device()
+    if args.data_dir is not None:
+        texts = get_datasets(args.data_dir, cache_images=False)["train"]["text"].tolist()[:args.n_docs]
+    else:
+        texts = ["when you see %s people at the store and they look at you like %s" % (i, i * 7) for i in range(args.n_docs)]
+
+    reference = None
+    print("%-8s %10s %10s %10s" % ("workers", "startup s", "docs/sec", "speedup"))
+    for n in args.workers:
+        ts = time.perf_counter()
+        if n == 0:
+            model = LangFeaturesModel(256, 2, 256, 0.0, 0.0, 256, 1, None, None, n_tokens_in=args.n_tokens_in, use_as_super=True,
+                                      capabilities=args.capabilities)
+            annotate = model.annotate
+        else:
+            pool = AnnotationPool(args.capabilities, args.n_tokens_in, n, args.chunk_size).start()
+            pool.annotate(texts[:n * args.chunk_size])  # wait for every worker to load its pipelines
+            annotate = pool.annotate
+        startup = time.perf_counter() - ts
+        ts = time.perf_counter()
+        annotate(texts)
+        rate = len(texts) / (time.perf_counter() - ts)
+        reference = rate if reference is None else reference
+        print("%-8s %10.1f %10.1f %9.1fx" % (n, startup, rate, rate / reference))
+        if n > 0:
+            pool.close()
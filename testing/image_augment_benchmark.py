@@ -0,0 +1,63 @@
+import argparse
+import time
+import numpy as np
+from PIL import Image
+from torchvision import transforms
+from albumentations import augmentations as alb
+
+from facebook_hateful_memes_detector.preprocessing import get_image_transforms_pytorch, get_image2torchvision_transforms, DefinedRotation
+from facebook_hateful_memes_detector.preprocessing import array_augment as aa
+
+parser = argparse.ArgumentParser(description="Per op and full pipeline time, PIL round trip vs array space image augmentation")
+parser.add_argument('--image', default=None, help="Image file, random 640x480 image if not given")
+parser.add_argument('--iters', type=int, default=200)
+args = parser.parse_args()
+
+image = Image.open(args.image).convert('RGB') if args.image else Image.fromarray(np.random.randint(0, 256, (480, 640, 3), dtype=np.uint8))
+arr = np.array(image)
+
+
+def pil_alb(aug):
+    return lambda im: Image.fromarray(aug(image=np.array(im, dtype=np.uint8))['image'])
+
+
+def pil_cutout(im):
+    cut = transforms.Compose([transforms.ToTensor(), transforms.RandomErasing(p=1.0, scale=(0.05, 0.25), value='random'), transforms.ToPILImage()])
+    for _ in range(3):
+        im = cut(im)
+    return im
+
+
+grid = alb.transforms.GridDropout(ratio=0.35, holes_number_x=16, holes_number_y=16, p=1.0)
+ops = [
+    ("grayscale", transforms.Grayscale(3), aa.grayscale),
+    ("hflip", transforms.RandomHorizontalFlip(1.0), aa.horizontal_flip),
+    ("perspective", transforms.RandomPerspective(0.25, p=1.0), aa.Perspective(0.25)),
+    ("color_jitter", transforms.ColorJitter(0.15, 0.15, 0.15, 0.15), aa.ColorJitter(0.15, 0.15, 0.15, 0.15)),
+    ("cutout x3", pil_cutout, aa.Cutout(1.0, (0.05, 0.25), max_count=3)),
+    ("grid_dropout", pil_alb(grid), aa.alb_op(grid)),
+    ("rotate_90", DefinedRotation(90), aa.rotate_90),
+    ("affine", transforms.RandomAffine(0, translate=(0.2, 0.2), scale=(0.5, 1.5), shear=25), aa.Affine(translate=(0.2, 0.2), scale=(0.5, 1.5), shear=25)),
+    ("resized_crop", transforms.RandomResizedCrop(640, scale=(0.6, 0.8)), aa.ResizedCrop(640, scale=(0.6, 0.8))),
+    ("to_tensor", get_image2torchvision_transforms(), aa.ArrayToTensor(224)),
+]
+
+
+def timeit(fn, x):
+    ts = time.perf_counter()
+    for _ in range(args.iters):
+        fn(x)
+    return (time.perf_counter() - ts) / args.iters * 1000
+
+
+print("%-14s %10s %10s %8s" % ("op", "pil ms", "array ms", "speedup"))
+for name, pil_op, array_op in ops:
+    tp, ta = timeit(pil_op, image), timeit(array_op, arr)
+    print("%-14s %10.3f %10.3f %7.1fx" % (name, tp, ta, tp / ta))
+
+to_torchvision = get_image2torchvision_transforms()
+for mode in ["easy", "hard"]:
+    pil_pipeline = get_image_transforms_pytorch(mode)
+    array_pipeline = get_image_transforms_pytorch(mode, array_pipeline=True)
+    tp, ta = timeit(lambda im: to_torchvision(pil_pipeline(im)), image), timeit(array_pipeline, image)
+    print("%-14s %10.3f %10.3f %7.1fx" % ("pipeline " + mode, tp, ta, tp / ta))
@@ -0,0 +1,42 @@
+import argparse
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+
+from facebook_hateful_memes_detector.utils.globals import set_global
+from facebook_hateful_memes_detector.utils import my_collate, maybe_clean_memory, memory_hygiene_step
+from facebook_hateful_memes_detector.utils.sample import Sample
+
+parser = argparse.ArgumentParser(description="Per step time of collate + forward/backward under each memory hygiene policy")
+parser.add_argument('--steps', type=int, default=200)
+parser.add_argument('--batch_size', type=int, default=32)
+parser.add_argument('--heap_objects', type=int, default=2000000, help="Python objects kept alive to mimic a large training process heap")
+parser.add_argument('--hot_path_calls', type=int, default=5, help="maybe_clean_memory calls per step, as in model get_vectors/forward")
+args = parser.parse_args()
+
+policy = dict(mode="always")
+set_global("memory_hygiene", policy)
+heap = [{"i": i} for i in range(args.heap_objects)]
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+model = nn.Sequential(nn.Linear(768, 768), nn.ReLU(), nn.Linear(768, 2)).to(device)
+optimizer = torch.optim.Adam(model.parameters())
+samples = [Sample({"text": "a meme caption", "label": i % 2, "numbers": torch.randn(768)}) for i in range(args.batch_size)]
+
+for p in [dict(mode="always"), dict(mode="every", steps=100), dict(mode="threshold", threshold=0.9), dict(mode="off")]:
+    policy.clear()
+    policy.update(p)
+    times = []
+    for step in range(args.steps):
+        ts = time.perf_counter()
+        batch = my_collate(samples)
+        for _ in range(args.hot_path_calls):
+            maybe_clean_memory()
+        loss = nn.functional.cross_entropy(model(batch.numbers.to(device)), torch.tensor(batch.label, device=device))
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        memory_hygiene_step()
+        times.append(time.perf_counter() - ts)
+    times = np.array(times) * 1000
+    print(p, "mean = %.2f ms" % times.mean(), "p50 = %.2f ms" % np.percentile(times, 50), "p99 = %.2f ms" % np.percentile(times, 99))